@@ -0,0 +1,177 @@
+
+"""Worker processes that assemble training batches ahead of the training loop."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+from six.moves import queue
+from six.moves import xrange # pylint: disable=redefined-builtin
+
+import data_utils
+
+try:
+  from multiprocessing import shared_memory
+except ImportError: # Python < 3.8
+  shared_memory = None
+
+
+def _to_shared_memory(array):
+  """Copy an array into a new shared memory block. Returns the block and a view of it."""
+  block = shared_memory.SharedMemory( create=True, size=max(array.nbytes, 1) )
+  view = np.ndarray( array.shape, dtype=array.dtype, buffer=block.buf )
+  view[...] = array
+  return block, view
+
+
+def _produce(blocks, shapes, dtype, sequence_keys, offsets, margin, actions, batch_size,
+             source_seq_len, target_seq_len, uniform_frames, batch_dtype, first_dim, seed, batches, stop):
+  """
+  Loop of a producer process: draw windows from the shared training set and
+  push the batches into this worker's queue until asked to stop.
+  """
+  # Never block the exit of the process on batches nobody will read
+  batches.cancel_join_thread()
+
+  data, velocity = [np.ndarray( shape, dtype=dtype, buffer=block.buf ) for block, shape in zip(blocks, shapes)]
+  arena = data_utils.SequenceArena.from_arrays( sequence_keys, data, velocity, offsets, margin, actions )
+  rng = np.random.RandomState( np.random.MT19937(seed) )
+  total_frames = source_seq_len + target_seq_len
+
+  while not stop.is_set():
+    starts = arena.sample_starts( batch_size, total_frames, uniform_frames, rng )
+    batch = tuple( x.astype(batch_dtype, copy=False)
+                   for x in arena.batch(starts, source_seq_len, target_seq_len, first_dim=first_dim) )
+
+    while not stop.is_set():
+      try:
+        batches.put( batch, timeout=0.1 )
+        break
+      except queue.Full:
+        continue
+
+
+
+class BatchProducer(object):
+  """
+  Assembles training batches in num_workers processes. The normalized training
+  set is copied once into shared memory and every worker reads it from there,
+  with its own random stream. Every worker fills a bounded queue, and get()
+  reads the queues in turn, so with a fixed seed the sequence of batches is
+  the same from run to run.
+  """
+
+  def __init__(self, arena, batch_size, source_seq_len, target_seq_len, num_workers,
+               prefetch=8, uniform_frames=False, seed=None, batch_dtype=np.float64, first_dim=0):
+    """
+    Start the workers.
+
+    Args
+      arena: data_utils.SequenceArena with the normalized training set
+      batch_size: number of windows in a batch
+      source_seq_len: length of the input sequence
+      target_seq_len: length of the target sequence
+      num_workers: number of producer processes
+      prefetch: maximum number of batches waiting, over all the workers
+      uniform_frames: draw every valid window with the same probability
+      seed: integer to make the batches reproducible. None draws fresh entropy
+      batch_dtype: numpy type of the batches
+      first_dim: first dimension of the sequences in the batches, see
+        data_utils.SequenceArena.batch
+    Raises
+      ValueError if shared memory is not available or num_workers < 1
+    """
+    # Set before anything can raise, for close() from __del__
+    self._processes = []
+    self._queues = []
+    self._blocks = []
+
+    if shared_memory is None:
+      raise ValueError("Batch producers need multiprocessing.shared_memory (Python 3.8+)")
+    if num_workers < 1:
+      raise ValueError("Need at least one batch producer, got {0}".format(num_workers))
+    if arena.velocity is None:
+      raise ValueError("The arena was built without velocities")
+
+    for array in (arena.data, arena.velocity):
+      block, _ = _to_shared_memory( array )
+      self._blocks.append( block )
+
+    self._stop = multiprocessing.Event()
+    maxsize = max( 1, int(np.ceil(prefetch / num_workers)) )
+    self._queues = [multiprocessing.Queue( maxsize ) for _ in xrange(num_workers)]
+
+    seeds = np.random.SeedSequence( seed ).spawn( num_workers )
+    for i in xrange( num_workers ):
+      process = multiprocessing.Process(
+        target=_produce,
+        args=(self._blocks, (arena.data.shape, arena.velocity.shape), arena.data.dtype,
+              arena.sequence_keys, arena.offsets, arena.margin, arena.actions, batch_size,
+              source_seq_len, target_seq_len, uniform_frames, batch_dtype, first_dim, seeds[i],
+              self._queues[i], self._stop),
+        name="batch_producer_{0}".format(i))
+      process.daemon = True
+      process.start()
+      self._processes.append( process )
+
+    self._next = 0
+
+  def get(self):
+    """
+    Returns
+      The tuple (encoder_inputs, decoder_inputs, decoder_outputs, all_poses),
+      like Seq2SeqModel.get_batch
+    Raises
+      RuntimeError if the worker died
+    """
+    batches = self._queues[ self._next ]
+    process = self._processes[ self._next ]
+    while True:
+      try:
+        batch = batches.get( timeout=1.0 )
+        break
+      except queue.Empty:
+        if not process.is_alive():
+          raise RuntimeError("Batch producer {0} exited with code {1}".format( self._next, process.exitcode ))
+
+    self._next = (self._next + 1) % len( self._queues )
+    return batch
+
+  def queue_depth(self):
+    """Number of batches ready to be consumed, or -1 where the platform cannot tell."""
+    try:
+      return sum( batches.qsize() for batches in self._queues )
+    except NotImplementedError: # macOS
+      return -1
+
+  def close(self):
+    """Stop the workers and release the shared memory."""
+    if self._processes:
+      # The workers put() with a timeout, so they all see the stop event soon
+      self._stop.set()
+      for process in self._processes:
+        process.join( timeout=5 )
+        if process.is_alive():
+          process.terminate()
+          process.join()
+      self._processes = []
+
+    for batches in self._queues:
+      batches.close()
+    self._queues = []
+    for block in self._blocks:
+      block.close()
+      block.unlink()
+    self._blocks = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __del__(self):
+    self.close()
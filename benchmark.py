@@ -0,0 +1,127 @@
+
+"""Graph size and step time of the DCGRU encoder-decoder, for the cell optimizations."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+from six.moves import xrange # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+from dcgru import DCGRUCell, DiffusionSupports, HoistedInputCell
+
+tf.app.flags.DEFINE_integer("batch_size", 16, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("size", 64, "Size of each model layer.")
+tf.app.flags.DEFINE_integer("num_layers", 1, "Number of layers in the model.")
+tf.app.flags.DEFINE_integer("num_nodes", 48, "Number of nodes of the graph, the input size of the model.")
+tf.app.flags.DEFINE_integer("seq_length_in", 50, "Number of frames to feed into the encoder.")
+tf.app.flags.DEFINE_integer("seq_length_out", 25, "Number of frames that the decoder has to predict.")
+tf.app.flags.DEFINE_integer("max_diffusion_step", 3, "Number of maximum diffusion steps in the model.")
+tf.app.flags.DEFINE_string("filter_type", "dual_random_walk", "laplacian/random_walk/dual_random_walk")
+tf.app.flags.DEFINE_integer("warmup", 5, "Steps run before timing.")
+tf.app.flags.DEFINE_integer("iterations", 20, "Timed steps.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def build_graph( shared_supports, stacked_polynomials=False, hoist_inputs=False, fused=False, sparse=False ):
+  """
+  Build the forward and backward generators of Seq2SeqModel, a training op
+  on their outputs and nothing else.
+
+  Args
+    shared_supports: whether all the cells read the same DiffusionSupports,
+      or every cell builds its own
+    stacked_polynomials: whether the cells use the stacked diffusion polynomials
+    hoist_inputs: whether the encoders diffuse their inputs before the recurrence.
+      Needs num_layers == 1
+    fused: whether the cells diffuse the inputs of a step once for both gates and candidate
+    sparse: whether the graph only links nodes at most 2 apart, with sparse supports
+  Returns
+    graph: the tf.Graph
+    inputs: tuple with the encoder and decoder input placeholders
+    train_op: op of a training step
+  Raises
+    ValueError if hoist_inputs is asked with more than one layer
+  """
+  if hoist_inputs and FLAGS.num_layers != 1:
+    raise ValueError("hoist_inputs needs a single layer model, got {0} layers".format(FLAGS.num_layers))
+
+  graph = tf.Graph()
+  with graph.as_default():
+    encoder_inputs = tf.placeholder( tf.float32, [None, FLAGS.seq_length_in-2, FLAGS.num_nodes], name="enc_in" )
+    decoder_inputs = tf.placeholder( tf.float32, [None, FLAGS.seq_length_out, FLAGS.num_nodes], name="dec_in" )
+    adj_mx = tf.get_variable( 'train_g_fw', shape=(FLAGS.num_nodes, FLAGS.num_nodes),
+                              initializer=tf.random_uniform_initializer(minval=0, maxval=1) )
+    mask = None
+    if sparse:
+      nodes = np.arange( FLAGS.num_nodes )
+      mask = np.abs( nodes[:, np.newaxis] - nodes[np.newaxis, :] ) <= 2
+    supports = DiffusionSupports( adj_mx, FLAGS.filter_type, mask=mask ) if shared_supports else None
+
+    def make_cell( num_proj ):
+      return DCGRUCell( FLAGS.size, adj_mx, max_diffusion_step=FLAGS.max_diffusion_step, num_nodes=FLAGS.num_nodes,
+                        filter_type=FLAGS.filter_type, num_proj=num_proj, supports=supports,
+                        stacked_polynomials=stacked_polynomials, fused=fused )
+
+    loss = 0
+    for name in ['train_g_fw', 'train_g_bw']:
+      cell = make_cell( 1 )
+      if FLAGS.num_layers == 2:
+        cell = tf.contrib.rnn.MultiRNNCell( [make_cell(None), cell] )
+      with tf.variable_scope( name ) as scope:
+        enc_cell, enc_inputs = cell, tf.unstack( encoder_inputs, axis=1 )
+        if hoist_inputs:
+          enc_cell, enc_inputs = HoistedInputCell( cell ), cell.hoist_inputs( enc_inputs )
+        _, enc_state = tf.contrib.rnn.static_rnn( enc_cell, enc_inputs, dtype=tf.float32, scope=scope )
+        scope.reuse_variables()
+        outputs, _ = tf.contrib.legacy_seq2seq.rnn_decoder( tf.unstack(decoder_inputs, axis=1), enc_state, cell,
+                                                           loop_function=lambda prev, i: prev, scope=scope )
+      loss += tf.reduce_mean( tf.square(tf.stack(outputs)) )
+
+    train_op = tf.train.GradientDescentOptimizer( 0.005 ).minimize( loss )
+  return graph, (encoder_inputs, decoder_inputs), train_op
+
+
+def time_steps( graph, inputs, train_op ):
+  """
+  Returns
+    seconds: mean time of a training step
+  """
+  rng = np.random.RandomState( 0 )
+  feed = dict( (x, rng.randn(FLAGS.batch_size, *x.get_shape().as_list()[1:]).astype(np.float32)) for x in inputs )
+  with graph.as_default(), tf.Session() as sess:
+    sess.run( tf.global_variables_initializer() )
+    for _ in xrange( FLAGS.warmup ):
+      sess.run( train_op, feed )
+    start = time.time()
+    for _ in xrange( FLAGS.iterations ):
+      sess.run( train_op, feed )
+    return (time.time() - start) / FLAGS.iterations
+
+
+def main(_):
+  variants = [("per-cell supports", dict(shared_supports=False)),
+              ("shared supports", dict(shared_supports=True)),
+              ("stacked polynomials", dict(shared_supports=True, stacked_polynomials=True)),
+              ("hoisted inputs", dict(shared_supports=True, stacked_polynomials=True, hoist_inputs=True)),
+              ("fused cell", dict(shared_supports=True, fused=True)),
+              ("fused, stacked, hoisted", dict(shared_supports=True, stacked_polynomials=True, hoist_inputs=True,
+                                               fused=True)),
+              ("sparse supports", dict(shared_supports=True, sparse=True))]
+  if FLAGS.num_layers != 1:
+    variants = [(name, options) for name, options in variants if not options.get('hoist_inputs')]
+
+  print("{0: <24} | {1: >8} | {2: >10}".format("variant", "ops", "step (ms)"))
+  for name, options in variants:
+    graph, inputs, train_op = build_graph( **options )
+    nops = len( graph.get_operations() )
+    seconds = time_steps( graph, inputs, train_op )
+    print("{0: <24} | {1: >8d} | {2: >10.1f}".format(name, nops, 1000 * seconds))
+
+
+if __name__ == "__main__":
+  tf.app.run()
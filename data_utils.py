@@ -7,7 +7,12 @@ from __future__ import print_function
 
 import numpy as np
 from six.moves import xrange # pylint: disable=redefined-builtin
-import copy
+import h5py
+import json
+import multiprocessing
+import os
+
+POSE_CODECS = ('int16', 'float16')
 
 def rotmat2euler( R ):
   """
@@ -123,6 +128,194 @@ def expmap2rotmat(r):
   return R
 
 
+def euler2rotmat( e ):
+  """
+  Converts Euler angles to a rotation matrix. Inverse of rotmat2euler:
+  R = (Rz(E3) Ry(E2) Rx(E1))^T
+
+  Args
+    e: a 3x1 Euler angle representation
+  Returns
+    R: 3x3 rotation matrix
+  """
+  c1, c2, c3 = np.cos( e )
+  s1, s2, s3 = np.sin( e )
+
+  Rx = np.array([[1, 0, 0], [0, c1, -s1], [0, s1, c1]])
+  Ry = np.array([[c2, 0, s2], [0, 1, 0], [-s2, 0, c2]])
+  Rz = np.array([[c3, -s3, 0], [s3, c3, 0], [0, 0, 1]])
+  R = Rz.dot( Ry ).dot( Rx ).T
+  return R
+
+
+# Batched versions of the conversions above. They take any number of leading
+# dimensions, e.g. (T, 32, 3) for the joints of a sequence, and give the same
+# results as the functions on a single rotation.
+
+def expmap2rotmat_batch( r ):
+  """
+  Batched expmap2rotmat.
+
+  Args
+    r: ...x3 exponential maps
+  Returns
+    R: ...x3x3 rotation matrices
+  """
+  theta = np.linalg.norm( r, axis=-1 )[..., np.newaxis, np.newaxis]
+  r0 = r / (theta[..., 0] + np.finfo(np.float32).eps)
+
+  r0x = np.zeros( r.shape[:-1] + (3, 3) )
+  r0x[..., 0, 1] = -r0[..., 2]
+  r0x[..., 0, 2] =  r0[..., 1]
+  r0x[..., 1, 2] = -r0[..., 0]
+  r0x = r0x - np.swapaxes( r0x, -1, -2 )
+
+  R = np.eye(3,3) + np.sin(theta)*r0x + (1-np.cos(theta))*np.matmul( r0x, r0x )
+  return R
+
+
+def rotmat2euler_batch( R ):
+  """
+  Batched rotmat2euler. The gimbal lock rotations, R[0,2] = +-1, are handled
+  with masks like the special case of rotmat2euler.
+
+  Args
+    R: ...x3x3 rotation matrices
+  Returns
+    eul: ...x3 Euler angles
+  """
+  R02 = R[..., 0, 2]
+  special = (R02 == 1) | (R02 == -1)
+
+  # Regular case, with cos(E2) set to 1 where it is not used
+  E2 = -np.arcsin( R02 )
+  cosE2 = np.where( special, 1, np.cos(E2) )
+  E1 = np.arctan2( R[..., 1, 2]/cosE2, R[..., 2, 2]/cosE2 )
+  E3 = np.arctan2( R[..., 0, 1]/cosE2, R[..., 0, 0]/cosE2 )
+
+  # Special case, with E3 set arbitrarily to 0
+  dlta = np.arctan2( R[..., 0, 1], R02 )
+  E1 = np.where( special, dlta, E1 )
+  E2 = np.where( special, np.where(R02 == -1, np.pi/2, -np.pi/2), E2 )
+  E3 = np.where( special, 0, E3 )
+
+  eul = np.stack( [E1, E2, E3], axis=-1 )
+  return eul
+
+
+def euler2rotmat_batch( e ):
+  """
+  Batched euler2rotmat.
+
+  Args
+    e: ...x3 Euler angles
+  Returns
+    R: ...x3x3 rotation matrices
+  """
+  c = np.cos( e )
+  s = np.sin( e )
+  zeros = np.zeros( e.shape[:-1] )
+  ones  = np.ones( e.shape[:-1] )
+
+  def rotation( rows ):
+    return np.stack( [np.stack(row, axis=-1) for row in rows], axis=-2 )
+
+  Rx = rotation([[ones, zeros, zeros], [zeros, c[..., 0], -s[..., 0]], [zeros, s[..., 0], c[..., 0]]])
+  Ry = rotation([[c[..., 1], zeros, s[..., 1]], [zeros, ones, zeros], [-s[..., 1], zeros, c[..., 1]]])
+  Rz = rotation([[c[..., 2], -s[..., 2], zeros], [s[..., 2], c[..., 2], zeros], [zeros, zeros, ones]])
+  R = np.swapaxes( np.matmul(np.matmul(Rz, Ry), Rx), -1, -2 )
+  return R
+
+
+def rotmat2quat_batch( R ):
+  """
+  Batched rotmat2quat.
+
+  Args
+    R: ...x3x3 rotation matrices
+  Returns
+    q: ...x4 quaternions
+  """
+  rotdiff = R - np.swapaxes( R, -1, -2 )
+
+  r = np.stack( [-rotdiff[..., 1, 2], rotdiff[..., 0, 2], -rotdiff[..., 0, 1]], axis=-1 )
+  rnorm = np.linalg.norm( r, axis=-1 )
+  sintheta = rnorm / 2
+  r0 = r / (rnorm + np.finfo(np.float32).eps)[..., np.newaxis]
+
+  costheta = (np.trace(R, axis1=-2, axis2=-1) - 1) / 2
+
+  theta = np.arctan2( sintheta, costheta )
+
+  q = np.concatenate( [np.cos(theta/2)[..., np.newaxis], r0*np.sin(theta/2)[..., np.newaxis]], axis=-1 )
+  return q
+
+
+def quat2expmap_batch( q ):
+  """
+  Batched quat2expmap.
+
+  Args
+    q: ...x4 quaternions
+  Returns
+    r: ...x3 exponential maps
+  Raises
+    ValueError if the l2 norm of a quaternion is not close to 1
+  """
+  if np.any( np.abs(np.linalg.norm(q, axis=-1)-1) > 1e-3 ):
+    raise ValueError("quat2expmap_batch: input quaternion is not norm 1")
+
+  sinhalftheta = np.linalg.norm( q[..., 1:], axis=-1 )
+  coshalftheta = q[..., 0]
+
+  r0    = q[..., 1:] / (sinhalftheta + np.finfo(np.float32).eps)[..., np.newaxis]
+  theta = 2 * np.arctan2( sinhalftheta, coshalftheta )
+  theta = np.mod( theta + 2*np.pi, 2*np.pi )
+
+  flip  = theta > np.pi
+  theta = np.where( flip, 2 * np.pi - theta, theta )
+  r0    = np.where( flip[..., np.newaxis], -r0, r0 )
+
+  r = r0 * theta[..., np.newaxis]
+  return r
+
+
+def rotmat2expmap_batch( R ):
+  return quat2expmap_batch( rotmat2quat_batch(R) )
+
+
+def expmap2euler_channels( channels ):
+  """
+  Converts the joint rotations of poses from exponential map to Euler angles,
+  leaving the global translation (first 3 entries) as it is.
+
+  Args
+    channels: ...x99 poses in exponential map
+  Returns
+    converted: copy of channels with the rotations in Euler angles
+  """
+  converted = np.array( channels )
+  rotations = converted[..., 3:99].reshape( converted.shape[:-1] + (-1, 3) )
+  converted[..., 3:99] = rotmat2euler_batch( expmap2rotmat_batch(rotations) ).reshape( converted.shape[:-1] + (-1,) )
+  return converted
+
+
+def euler2expmap_channels( channels ):
+  """
+  Converts the joint rotations of poses from Euler angles to exponential map,
+  leaving the global translation (first 3 entries) as it is.
+
+  Args
+    channels: ...x99 poses in Euler angles
+  Returns
+    converted: copy of channels with the rotations in exponential map
+  """
+  converted = np.array( channels )
+  rotations = converted[..., 3:99].reshape( converted.shape[:-1] + (-1, 3) )
+  converted[..., 3:99] = rotmat2expmap_batch( euler2rotmat_batch(rotations) ).reshape( converted.shape[:-1] + (-1,) )
+  return converted
+
+
 def unNormalizeData(normalizedData, data_mean, data_std, dimensions_to_ignore, actions, one_hot ):
   """Borrowed from SRNN code. Reads a csv file and returns a float32 matrix.
   https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/generateMotionData.py#L12
@@ -196,87 +389,458 @@ def revert_output_format(poses, poses_first_frame, data_mean, data_std, dim_to_i
   return poses_out_list
 
 
+def encode_poses( poses, codec='int16', delta=True ):
+  """
+  Compact encoding of a sequence of poses. Every dimension is mapped to
+  [-1, 1] with its own offset and scale, and stored as int16 or float16.
+  With int16, the quantized values can also be delta encoded in time: poses
+  change little from frame to frame, so the differences compress well, and
+  since they are integers they decode without drift.
+
+  Args
+    poses: nxd matrix with a sequence of poses
+    codec: 'int16' or 'float16'
+    delta: whether to store the differences of consecutive frames (int16 only)
+  Returns
+    encoded: dictionary with the nxd 'values', the d-long 'offset' and 'scale'
+      of every dimension, the 'codec' and whether 'delta' is used
+  Raises
+    ValueError if the codec is unknown, or delta is asked with float16
+  """
+  if codec not in POSE_CODECS:
+    raise ValueError("Unknown pose codec {0}".format(codec))
+  if delta and codec != 'int16':
+    raise ValueError("Delta encoding needs the int16 codec")
+
+  poses = np.asarray( poses, dtype=np.float64 )
+  lo, hi = poses.min( axis=0 ), poses.max( axis=0 )
+  offset = (lo + hi) / 2
+  scale  = (hi - lo) / 2
+  scale[ scale == 0 ] = 1 # constant dimensions are all stored as their offset
+
+  if codec == 'int16':
+    scale = scale / np.iinfo( np.int16 ).max
+    values = np.rint( (poses - offset) / scale ).astype( np.int16 )
+    if delta:
+      # Wraps around in int16, and so does the cumulative sum that decodes it
+      values[1:] = np.diff( values, axis=0 )
+  else:
+    values = ((poses - offset) / scale).astype( np.float16 )
+
+  return {'values': values, 'offset': offset, 'scale': scale, 'codec': codec, 'delta': bool(delta)}
+
+
+def decode_poses( encoded, dtype=np.float32 ):
+  """
+  Args
+    encoded: dictionary given by encode_poses
+    dtype: type of the decoded poses
+  Returns
+    poses: nxd matrix with the decoded poses
+  """
+  values = encoded['values']
+  if encoded['delta']:
+    values = np.cumsum( values, axis=0, dtype=np.int16 )
+  return (values * encoded['scale'] + encoded['offset']).astype( dtype )
+
+
+def pose_error_bound( encoded, dtype=np.float32 ):
+  """
+  Bound of the absolute error of decode_poses on every dimension: half a
+  quantization step for int16, the rounding of 11 significant bits for
+  float16, plus the rounding to dtype.
+
+  Args
+    encoded: dictionary given by encode_poses
+    dtype: type of the decoded poses
+  Returns
+    max_error: d-long vector with the bound of every dimension
+  """
+  scale = np.abs( encoded['scale'] )
+  if encoded['codec'] == 'int16':
+    quantization = scale / 2
+    magnitude = np.abs( encoded['offset'] ) + scale * np.iinfo( np.int16 ).max
+  else:
+    quantization = scale * 2.0**-11
+    magnitude = np.abs( encoded['offset'] ) + scale
+  return quantization + magnitude * np.finfo( dtype ).eps
+
+
+def write_encoded_poses( group, name, poses, codec=None, compression='gzip' ):
+  """
+  Save a sequence of poses in an HDF5 file, optionally in a compact encoding.
+  Encoded poses are chunked and compressed, and carry the attributes read_poses
+  needs to decode them.
+
+  Args
+    group: h5py File or Group to create the dataset in
+    name: name of the dataset
+    poses: nxd matrix with a sequence of poses
+    codec: None to store the poses as they are, or a codec of encode_poses
+    compression: HDF5 compression filter of encoded poses
+  Returns
+    max_error: d-long vector with the bound of the error of read_poses
+  """
+  if codec is None:
+    group.create_dataset( name, data=poses )
+    return np.zeros( poses.shape[1] )
+
+  encoded = encode_poses( poses, codec, delta=(codec == 'int16') )
+  max_error = pose_error_bound( encoded )
+  dataset = group.create_dataset( name, data=encoded['values'], chunks=True, compression=compression )
+  for key in ('codec', 'delta', 'offset', 'scale'):
+    dataset.attrs[ key ] = encoded[ key ]
+  dataset.attrs['max_error'] = max_error
+  return max_error
+
+
+def read_encoded_poses( dataset ):
+  """
+  Read encoded poses saved by write_encoded_poses, without decoding them.
+  Delta encoded values are summed back, so any frame can be decoded on its own.
+
+  Args
+    dataset: h5py Dataset with encoded poses
+  Returns
+    encoded: dictionary like the ones of encode_poses, without delta encoding
+  """
+  encoded = dict( (key, dataset.attrs[key]) for key in ('codec', 'offset', 'scale') )
+  encoded['values'] = dataset[:]
+  if dataset.attrs['delta']:
+    encoded['values'] = np.cumsum( encoded['values'], axis=0, dtype=np.int16 )
+  encoded['delta'] = False
+  return encoded
+
+
+def read_poses( dataset, dtype=np.float32 ):
+  """
+  Read poses saved by write_encoded_poses, decoding them if they are encoded.
+
+  Args
+    dataset: h5py Dataset
+    dtype: type of decoded poses
+  Returns
+    poses: nxd matrix with the poses
+  """
+  if 'codec' not in dataset.attrs:
+    return dataset[:]
+
+  return decode_poses( read_encoded_poses(dataset), dtype )
+
+
 def readCSVasFloat(filename):
   """
   Borrowed from SRNN code. Reads a csv and returns a float matrix.
   https://github.com/asheshjain399/NeuralModels/blob/master/neuralmodels/utils.py#L34
 
+  The whole file is parsed in a single vectorized call instead of converting
+  one token at a time.
+
   Args
     filename: string. Path to the csv file
   Returns
     returnArray: the read data in a float32 matrix
   """
-  returnArray = []
-  lines = open(filename).readlines()
-  for line in lines:
-    line = line.strip().split(',')
-    if len(line) > 0:
-      returnArray.append(np.array([np.float32(x) for x in line]))
+  with open(filename) as f:
+    text = f.read()
 
-  returnArray = np.array(returnArray)
+  ncols = text.split('\n', 1)[0].count(',') + 1
+  # whitespace in the separator also matches the line breaks
+  returnArray = np.fromstring( text.replace(',', ' '), dtype=np.float32, sep=' ' )
+  returnArray = returnArray.reshape( -1, ncols )
   return returnArray
 
 
-def load_data(path_to_dataset, subjects, actions, one_hot, euler):
+def _read_sequence( args ):
+  """Reads one txt file, and changes exp to euler if asked to. Runs in the ingestion workers."""
+  filename, euler = args
+  action_sequence = readCSVasFloat(filename)
+
+  if euler:
+    # the first three are positions, so could not change to euler angle
+    action_sequence = expmap2euler_channels( action_sequence )
+
+  return action_sequence
+
+
+def read_sequences(path_to_dataset, subjects, actions, euler, num_workers=0, keys=None):
+  """
+  Parse the txt files of the given subjects and actions one after the other,
+  without keeping them in memory.
+
+  Args
+    path_to_dataset: string. directory where the data resides
+    subjects: list of numbers. The subjects to read
+    actions: list of string. The actions to read
+    euler: whether to convert the angles to Euler angles
+    num_workers: number of processes parsing the files in parallel. 0 or 1 reads
+      them one at a time in this process
+    keys: optional list of (subject, action index, subaction) to read instead
+      of all the files that find_sequences finds
+  Yields
+    key: tuple (subject, action index, subaction)
+    action_sequence: nxd matrix with all the frames of the file
+  """
+  if keys is None:
+    # Every take on disk, like the binary store loads them
+    keys = find_sequences( path_to_dataset, subjects, actions )
+
+  jobs = [('{0}/S{1}/{2}_{3}.txt'.format( path_to_dataset, subj, actions[action_idx], subact), euler)
+          for subj, action_idx, subact in keys]
+
+  pool = None
+  if num_workers > 1:
+    print("Reading {0} files with {1} workers".format(len(jobs), num_workers))
+    pool = multiprocessing.Pool( num_workers )
+    # imap keeps the order of the files, so the results match the serial read
+    sequences = pool.imap( _read_sequence, jobs )
+  else:
+    sequences = (_read_sequence(job) for job in jobs)
+
+  try:
+    for (subj, action_idx, subact), action_sequence in zip(keys, sequences):
+      if pool is None:
+        print("Reading subject {0}, action {1}, subaction {2}".format(subj, actions[action_idx], subact))
+      yield (subj, action_idx, subact), action_sequence
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+
+def load_data(path_to_dataset, subjects, actions, euler, num_workers=0):
   """
   Borrowed from SRNN code. This is how the SRNN code reads the provided .txt files
   https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/processdata.py#L270
 
+  The sequences are kept without a one-hot encoding of the action. The action
+  is part of the key, and the encoding is added when batches are assembled.
+
   Args
     path_to_dataset: string. directory where the data resides
     subjects: list of numbers. The subjects to load
     actions: list of string. The actions to load
-    one_hot: Whether to add a one-hot encoding to the data
+    euler: whether to convert the angles to Euler angles
+    num_workers: number of processes parsing the files in parallel. 0 or 1 reads
+      them one at a time in this process
   Returns
     trainData: dictionary with k:v
       k=(subject, action, subaction, 'even'), v=(nxd) un-normalized data
-    completeData: nxd matrix with all the data. Used to normlization stats
+    completeData: NormalizationAccumulator with the running mean and variance
+      of all the data. Used to normlization stats
   """
-  nactions = len( actions )
-
   trainData = {}
-  completeData = []
+  completeData = NormalizationAccumulator()
+
+  for (subj, action_idx, subact), action_sequence in read_sequences( path_to_dataset, subjects, actions, euler, num_workers ):
+
+    action = actions[ action_idx ]
+
+    n, d = action_sequence.shape
+    even_list = range(0, n, 2)
+
+    trainData[(subj, action, subact, 'even')] = action_sequence[even_list, :]
+
+    completeData.update( action_sequence )
+
+  return trainData, completeData # all changed to euler other than the first three
+
+
+def find_sequences(path_to_dataset, subjects, actions):
+  """
+  Find the txt files of the given subjects and actions, with any subaction
+  number, in the S{subject}/{action}_{subaction}.txt layout.
+
+  Args
+    path_to_dataset: string. directory where the data resides
+    subjects: list of numbers. The subjects to look for
+    actions: list of string. The actions to look for
+  Returns
+    keys: sorted list of (subject, action index, subaction) of the files found
+  """
+  keys = []
   for subj in subjects:
-    for action_idx in np.arange(len(actions)):
+    for name in os.listdir( '{0}/S{1}'.format(path_to_dataset, subj) ):
+      stem, ext = os.path.splitext( name )
+      action, _, subact = stem.rpartition( '_' )
+      if ext == '.txt' and action in actions and subact.isdigit():
+        keys.append( (subj, actions.index(action), int(subact)) )
+  return sorted( keys )
 
-      action = actions[ action_idx ]
 
-      for subact in [1, 2]:  # subactions
+def store_directory(cache_dir, euler):
+  """Directory of the binary store of the expmap or Euler data in cache_dir"""
+  return os.path.join( cache_dir, 'euler' if euler else 'expmap' )
 
-        print("Reading subject {0}, action {1}, subaction {2}".format(subj, action, subact))
 
-        filename = '{0}/S{1}/{2}_{3}.txt'.format( path_to_dataset, subj, action, subact)
-        action_sequence = readCSVasFloat(filename)
+def _store_filename(store_dir, subj, action, subact, codec=None):
+  # Raw sequences are memory-mapped .npy files, encoded ones chunked and compressed .h5 files
+  return os.path.join( store_dir, 'S{0}_{1}_{2}.{3}'.format(subj, action, subact, 'h5' if codec else 'npy') )
 
-        n, d = action_sequence.shape
-        even_list = range(0, n, 2)
 
-        # Change exp to euler
-        if euler:
-          for j in range(0, n):
-            for k in np.arange(3, 97, 3): # the first three are positions, so could not change to euler angle
-              action_sequence[j, k:k + 3] = rotmat2euler(
-                expmap2rotmat(action_sequence[j, k:k + 3]))
+def _read_manifest(store_dir):
+  filename = os.path.join( store_dir, 'manifest.json' )
+  if not os.path.isfile( filename ):
+    return {}
+  with open( filename ) as f:
+    return json.load( f )
 
-        if one_hot:
-          # Add a one-hot encoding at the end of the representation
-          the_sequence = np.zeros( (len(even_list), d + nactions), dtype=float )
-          the_sequence[ :, 0:d ] = action_sequence[even_list, :]
-          the_sequence[ :, d+action_idx ] = 1
-          trainData[(subj, action, subact, 'even')] = the_sequence
-        else:
-          trainData[(subj, action, subact, 'even')] = action_sequence[even_list, :]
 
+def _write_manifest(store_dir, manifest):
+  filename = os.path.join( store_dir, 'manifest.json' )
+  with open( filename + '.tmp', 'w' ) as f:
+    json.dump( manifest, f )
+  os.rename( filename + '.tmp', filename )
 
-        if len(completeData) == 0:
-          completeData = copy.deepcopy(action_sequence)
+
+def _stored_stats(manifest, names):
+  """NormalizationAccumulator merged from the stats of the given manifest entries"""
+  completeData = NormalizationAccumulator()
+  for name in names:
+    entry = manifest[ name ]
+    stats = NormalizationAccumulator()
+    stats.count = entry['count']
+    stats.mean  = np.array( entry['mean'] )
+    stats.m2    = np.array( entry['m2'] )
+    stats.dtype = np.dtype( entry['dtype'] )
+    completeData.merge( stats )
+  return completeData
+
+
+def ingest_data(path_to_dataset, subjects, actions, euler, store_dir, num_workers=0, codec=None):
+  """
+  Bring a binary store up to date with the txt files. Only the files that are
+  new or changed since they were last converted are parsed. Every sequence is
+  saved as a .npy file, or encoded by write_encoded_poses in a chunked and
+  compressed .h5 file,
+  and the manifest of the store keeps the size and mtime of its txt file and
+  the sufficient statistics (count, mean and sum of squared deviations) of its
+  frames, so the stats of any set of files are a merge. The stats are always
+  computed on the frames before encoding.
+
+  Args
+    path_to_dataset: string. directory where the data resides
+    subjects: list of numbers. The subjects to ingest
+    actions: list of string. The actions to ingest
+    euler: whether to convert the angles to Euler angles
+    store_dir: directory of the binary store
+    num_workers: number of processes parsing the txt files
+    codec: None to store the sequences as they are, or a codec of encode_poses.
+      Files stored with another codec are converted again
+  Returns
+    converted: list of (subject, action, subaction) of the converted files
+    before: NormalizationAccumulator over the stored files of the subjects and
+      actions before the call
+    after: NormalizationAccumulator over all their files after the call
+  """
+  if not os.path.isdir( store_dir ):
+    os.makedirs( store_dir )
+  manifest = _read_manifest( store_dir )
+
+  keys = find_sequences( path_to_dataset, subjects, actions )
+  names = ['S{0}/{1}/{2}'.format(subj, actions[action_idx], subact) for subj, action_idx, subact in keys]
+  before = _stored_stats( manifest, [name for name in names if name in manifest] )
+
+  stale = {}
+  for key, name in zip( keys, names ):
+    subj, action_idx, subact = key
+    stat = os.stat( '{0}/S{1}/{2}_{3}.txt'.format(path_to_dataset, subj, actions[action_idx], subact) )
+    entry = manifest.get( name )
+    if (entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime or
+        entry.get('codec') != codec or
+        not os.path.isfile( _store_filename(store_dir, subj, actions[action_idx], subact, codec) )):
+      stale[ key ] = (name, stat)
+
+  converted = []
+  for key, action_sequence in read_sequences( path_to_dataset, subjects, actions, euler, num_workers, sorted(stale) ):
+    subj, action_idx, subact = key
+    name, stat = stale[ key ]
+
+    # np.save appends its extension to names without it
+    filename = _store_filename( store_dir, subj, actions[action_idx], subact, codec )
+    root, ext = os.path.splitext( filename )
+    max_error = 0.0
+    if codec is None:
+      np.save( root + '.tmp' + ext, action_sequence[0::2, :] )
+    else:
+      with h5py.File( root + '.tmp' + ext, 'w' ) as f:
+        max_error = float( np.max(write_encoded_poses( f, 'poses', action_sequence[0::2, :], codec )) )
+    os.rename( root + '.tmp' + ext, filename )
+
+    # Remove the file written with a previous codec, or an earlier .npz encoding
+    for previous in (root + '.npy', root + '.npz', root + '.h5'):
+      if previous != filename and os.path.isfile( previous ):
+        os.remove( previous )
+
+    stats = NormalizationAccumulator()
+    stats.update( action_sequence )
+    manifest[ name ] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'count': stats.count,
+                        'mean': stats.mean.tolist(), 'm2': stats.m2.tolist(), 'dtype': np.dtype(stats.dtype).str,
+                        'codec': codec, 'max_error': max_error}
+    converted.append( (subj, actions[action_idx], subact) )
+
+  if converted:
+    _write_manifest( store_dir, manifest )
+
+  return converted, before, _stored_stats( manifest, names )
+
+
+def load_data_cached(path_to_dataset, subjects, actions, euler, cache_dir, num_workers=0, codec=None, decode=True):
+  """
+  Same as load_data, but reads the sequences memory-mapped from a binary store
+  in cache_dir. New or changed txt files are ingested into the store first,
+  and the stats are merged from the stats stored for every file. All the
+  subactions found on disk are loaded.
+
+  Args
+    path_to_dataset: string. directory where the data resides
+    subjects: list of numbers. The subjects to load
+    actions: list of string. The actions to load
+    euler: whether to convert the angles to Euler angles
+    cache_dir: directory holding the binary stores
+    num_workers: number of processes parsing the txt files that are ingested
+    codec: None to keep raw sequences in the store, or a codec of encode_poses
+      to keep them encoded
+    decode: with a codec, whether to decode the sequences into float arrays.
+      Otherwise they stay encoded, as given by read_encoded_poses, to be
+      decoded a window at a time by an EncodedArena
+  Returns
+    trainData: dictionary with k:v
+      k=(subject, action, subaction, 'even'), v=(nxd) un-normalized data
+    stats: tuple (data_mean, data_std, dimensions_to_ignore, dimensions_to_use)
+      computed on all the frames of the passed subjects
+  """
+  store_dir = store_directory( cache_dir, euler )
+  converted, _, completeData = ingest_data( path_to_dataset, subjects, actions, euler, store_dir, num_workers, codec )
+  if converted:
+    print("Converted {0} files of subjects {1} into binary store {2}".format(len(converted), subjects, store_dir))
+
+  keys = find_sequences( path_to_dataset, subjects, actions )
+  if codec is not None:
+    manifest = _read_manifest( store_dir )
+    max_error = max( manifest['S{0}/{1}/{2}'.format(subj, actions[action_idx], subact)]['max_error']
+                     for subj, action_idx, subact in keys )
+    print("Loading {0} sequences of subjects {1} stored with {2}, max error {3:.2e}".format(
+      len(keys), subjects, codec, max_error))
+
+  trainData = {}
+  for subj, action_idx, subact in keys:
+
+    action = actions[ action_idx ]
+    filename = _store_filename( store_dir, subj, action, subact, codec )
+    if codec is None:
+      trainData[(subj, action, subact, 'even')] = np.load( filename, mmap_mode='r' )
+    else:
+      with h5py.File( filename, 'r' ) as f:
+        if decode:
+          trainData[(subj, action, subact, 'even')] = read_poses( f['poses'], completeData.dtype )
         else:
-          completeData = np.append(completeData, action_sequence, axis=0)
+          trainData[(subj, action, subact, 'even')] = read_encoded_poses( f['poses'] )
 
-  return trainData, completeData # all changed to euler other than the first three
+  return trainData, normalization_stats( completeData )
 
 
-def normalize_data( data, data_mean, data_std, dim_to_use, actions, one_hot ):
+def normalize_data( data, data_mean, data_std, dim_to_use, dtype=None ):
   """
   Normalize input data by removing unused dimensions, subtracting the mean and
   dividing by the standard deviation
@@ -286,45 +850,113 @@ def normalize_data( data, data_mean, data_std, dim_to_use, actions, one_hot ):
     data_mean: vector of mean used to normalize the data
     data_std: vector of standard deviation used to normalize the data
     dim_to_use: vector with dimensions used by the model
-    actions: list of strings with the encoded actions
-    one_hot: whether the data comes with one-hot encoding
+    dtype: if given, e.g. np.float32, every sequence is copied once into an
+      array of this type and normalized in place, without temporaries
   Returns
     data_out: the passed data matrix, but normalized
   """
   data_out = {}
-  nactions = len(actions)
 
-  if not one_hot:
-    # No one-hot encoding... no need to do anything special
+  if dtype is not None:
+    dim_to_use = np.asarray( dim_to_use )
+    mean_to_use = data_mean[ dim_to_use ].astype( dtype )
+    std_to_use  = data_std[ dim_to_use ].astype( dtype )
+
     for key in data.keys():
-      data_out[ key ] = np.divide( (data[key] - data_mean), data_std )
-      data_out[ key ] = data_out[ key ][ :, dim_to_use ]
+      the_sequence = data[key][ :, dim_to_use ].astype( dtype, copy=False )
+      the_sequence -= mean_to_use
+      the_sequence /= std_to_use
+      data_out[ key ] = the_sequence
 
   else:
-    # TODO hard-coding 99 dimensions for un-normalized human poses
     for key in data.keys():
-      data_out[ key ] = np.divide( (data[key][:, 0:99] - data_mean), data_std )
+      data_out[ key ] = np.divide( (data[key] - data_mean), data_std )
       data_out[ key ] = data_out[ key ][ :, dim_to_use ]
-      data_out[ key ] = np.hstack( (data_out[key], data[key][:,-nactions:]) )
 
   return data_out
 
 
+class NormalizationAccumulator(object):
+  """
+  Streaming per-dimension mean and variance, so the normalization stats can be
+  computed without keeping all the frames in memory. Batches of frames are
+  merged with the parallel form of Welford's update (Chan et al.).
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.mean  = None
+    self.m2    = None
+    self.dtype = None
+
+  def update(self, data):
+    """
+    Add a batch of frames to the running stats.
+
+    Args
+      data: nxd matrix with frames
+    """
+    if data.shape[0] == 0:
+      return
+    if self.dtype is None:
+      self.dtype = data.dtype
+
+    batch = np.asarray( data, dtype=np.float64 )
+    batch_mean = np.mean( batch, axis=0 )
+    batch_m2   = np.sum( np.square(batch - batch_mean), axis=0 )
+    self._combine( batch.shape[0], batch_mean, batch_m2 )
+
+  def merge(self, other):
+    """Add the frames summarized by another accumulator to the running stats."""
+    if other.count == 0:
+      return
+    if self.dtype is None:
+      self.dtype = other.dtype
+    self._combine( other.count, other.mean, other.m2 )
+
+  def _combine(self, count, mean, m2):
+    if self.count == 0:
+      self.count = count
+      self.mean  = np.array( mean, dtype=np.float64 )
+      self.m2    = np.array( m2, dtype=np.float64 )
+      return
+
+    total = self.count + count
+    delta = mean - self.mean
+    self.mean = self.mean + delta * (count / total)
+    self.m2   = self.m2 + m2 + np.square(delta) * (self.count * count / total)
+    self.count = total
+
+  @property
+  def variance(self):
+    return self.m2 / self.count
+
+  @property
+  def std(self):
+    return np.sqrt( self.variance )
+
+
 def normalization_stats(completeData):
   """"
   Also borrowed for SRNN code. Computes mean, stdev and dimensions to ignore.
   https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/processdata.py#L33
 
   Args
-    completeData: nx99 matrix with data to normalize
+    completeData: nx99 matrix with data to normalize, or a NormalizationAccumulator
+      that has seen that data
   Returns
     data_mean: vector of mean used to normalize the data
     data_std: vector of standard deviation used to normalize the data
     dimensions_to_ignore: vector with dimensions not used by the model
     dimensions_to_use: vector with dimensions used by the model
   """
-  data_mean = np.mean(completeData, axis=0)
-  data_std  =  np.std(completeData, axis=0)
+  if isinstance( completeData, NormalizationAccumulator ):
+    # Same dtype as the one np.mean and np.std give on the data itself
+    data_mean = completeData.mean.astype( completeData.dtype )
+    data_std  = completeData.std.astype( completeData.dtype )
+  else:
+    data_mean = np.mean(completeData, axis=0)
+    data_std  =  np.std(completeData, axis=0)
 
   dimensions_to_ignore = []
   dimensions_to_use    = []
@@ -335,3 +967,329 @@ def normalization_stats(completeData):
   data_std[dimensions_to_ignore] = 1.0
 
   return data_mean, data_std, dimensions_to_ignore, dimensions_to_use
+
+
+class SequenceArena(object):
+  """
+  The sequences of a data dictionary stored back to back in one contiguous
+  array, with an offset table and a cached index of the valid window starts.
+  Drawing a batch of windows is then one vectorized draw plus a gather.
+
+  The first differences of every sequence are computed once at construction,
+  so batches in velocity format are gathered directly instead of subtracting
+  the frames of every window again.
+
+  The sequences hold no one-hot encoding of the action. The arena keeps the
+  action id of every sequence and writes the encoding into the batches.
+  """
+
+  def __init__(self, data, margin=16, velocity=True, actions=None):
+    """
+    Args
+      data: dictionary with k:v, k=(subject, action, subaction, 'even'),
+        v=nxd matrix with a sequence of poses
+      margin: number of frames skipped at the beginning of every sequence
+        when sampling windows
+      velocity: whether to precompute the first differences of the sequences
+      actions: list of strings with the actions of the one-hot encoding, or
+        None for batches without one
+    """
+    self.sequence_keys = list( data.keys() )
+    self.margin = margin
+    self._set_actions( actions )
+    self.lengths = np.array( [data[key].shape[0] for key in self.sequence_keys], dtype=np.int64 )
+    self.offsets = np.zeros( len(self.sequence_keys) + 1, dtype=np.int64 )
+    self.offsets[1:] = np.cumsum( self.lengths )
+
+    first = data[ self.sequence_keys[0] ]
+    self.data = np.empty( (self.offsets[-1], first.shape[1]), dtype=first.dtype )
+    for i, key in enumerate( self.sequence_keys ):
+      self.data[ self.offsets[i]:self.offsets[i+1], : ] = data[ key ]
+
+    # velocity[t] = data[t+1] - data[t]. The last frame of every sequence would
+    # subtract across two sequences and is zeroed; no window ever reads it
+    self.velocity = None
+    if velocity:
+      self.velocity = np.empty_like( self.data )
+      np.subtract( self.data[1:], self.data[:-1], out=self.velocity[:-1] )
+      self.velocity[ self.offsets[1:] - 1 ] = 0
+
+    self._positions = dict( (key, i) for i, key in enumerate(self.sequence_keys) )
+    self._window_starts = {}
+
+  @classmethod
+  def from_arrays(cls, sequence_keys, data, velocity, offsets, margin=16, actions=None):
+    """
+    Arena over arrays that already hold concatenated sequences, e.g. views of
+    shared memory. The arrays are used as they are, without copying them.
+
+    Args
+      sequence_keys: keys of the sequences, in storage order
+      data: nxd array with the sequences back to back
+      velocity: nxd array with their first differences, or None
+      offsets: (len(sequence_keys)+1)-long vector with the start of every sequence
+      margin: number of frames skipped at the beginning of every sequence
+      actions: list of strings with the actions of the one-hot encoding, or None
+    Returns
+      arena: a SequenceArena
+    """
+    arena = cls.__new__( cls )
+    arena.sequence_keys = list( sequence_keys )
+    arena.margin = margin
+    arena._set_actions( actions )
+    arena.offsets = np.asarray( offsets, dtype=np.int64 )
+    arena.lengths = np.diff( arena.offsets )
+    arena.data = data
+    arena.velocity = velocity
+    arena._positions = dict( (key, i) for i, key in enumerate(arena.sequence_keys) )
+    arena._window_starts = {}
+    return arena
+
+  def _set_actions(self, actions):
+    self.actions = None if actions is None else list( actions )
+    self.nactions = 0 if actions is None else len( actions )
+    self.action_ids = None
+    if actions is not None:
+      self.action_ids = np.array( [self.actions.index(key[1]) for key in self.sequence_keys], dtype=np.int64 )
+
+  def set_one_hot(self, poses, starts):
+    """
+    Write the one-hot encoding of the actions into the last nactions columns
+    of a batch of windows.
+
+    Args
+      poses: len(starts) x total_frames x (d+nactions) array
+      starts: vector with the window starts of its rows
+    """
+    poses[ :, :, poses.shape[2]-self.nactions: ] = 0
+    sequence_idx = np.searchsorted( self.offsets, starts, side='right' ) - 1
+    columns = poses.shape[2] - self.nactions + self.action_ids[ sequence_idx ]
+    poses[ np.arange(len(starts)), :, columns ] = 1
+
+  def keys(self):
+    return list( self.sequence_keys )
+
+  def __len__(self):
+    return len( self.sequence_keys )
+
+  def __contains__(self, key):
+    return key in self._positions
+
+  def __getitem__(self, key):
+    """A view of the sequence stored under key"""
+    i = self._positions[ key ]
+    return self.data[ self.offsets[i]:self.offsets[i+1], : ]
+
+  def window_starts(self, total_frames):
+    """
+    Index of all the valid window starts for windows of total_frames frames.
+    These are the same positions np.random.randint( margin, n-total_frames )
+    picks from in every sequence. The index is computed once per window length.
+
+    Args
+      total_frames: number of frames in a window
+    Returns
+      starts: vector with the start of every valid window in self.data
+    """
+    if total_frames not in self._window_starts:
+      starts = [np.arange( self.offsets[i] + self.margin, self.offsets[i] + self.lengths[i] - total_frames )
+                for i in range( len(self.sequence_keys) )]
+      self._window_starts[ total_frames ] = np.concatenate( starts )
+    return self._window_starts[ total_frames ]
+
+  def sample_starts(self, batch_size, total_frames, uniform_frames=False, rng=np.random):
+    """
+    Draw the starts of a batch of windows.
+
+    Args
+      batch_size: number of windows to draw
+      total_frames: number of frames in a window
+      uniform_frames: if True, every valid window is equally likely, regardless
+        of the length of its sequence. Otherwise pick a sequence at random and
+        then a window inside of it, like Seq2SeqModel.get_batch does on dicts
+      rng: np.random or a np.random.RandomState
+    Returns
+      starts: batch_size-long vector with the window starts in self.data
+    """
+    if uniform_frames:
+      starts = self.window_starts( total_frames )
+      return starts[ rng.randint( 0, len(starts), batch_size ) ]
+
+    chosen = rng.randint( 0, len(self.sequence_keys), batch_size )
+    low  = self.offsets[ chosen ] + self.margin
+    high = self.offsets[ chosen ] + self.lengths[ chosen ] - total_frames
+    if np.any( high <= low ):
+      raise ValueError("Sequences must be longer than {0} frames".format( total_frames + self.margin ))
+    return low + (rng.random_sample( batch_size ) * (high - low)).astype( np.int64 )
+
+  def gather(self, starts, total_frames):
+    """
+    Args
+      starts: vector with window starts in self.data
+      total_frames: number of frames in a window
+    Returns
+      windows: len(starts) x total_frames x d array with the windows
+    """
+    return self.data[ starts[:, None] + np.arange(total_frames) ]
+
+  def batch(self, starts, source_seq_len, target_seq_len, out=None, first_dim=0):
+    """
+    Assemble a batch of windows in the velocity format of Seq2SeqModel.get_batch,
+    gathering from the precomputed first differences. With actions, the
+    one-hot columns are zero in the velocities and encode the action in the poses.
+
+    Args
+      starts: vector with window starts in self.data
+      source_seq_len: length of the input sequence
+      target_seq_len: length of the target sequence
+      out: optional tuple of four arrays to write the batch into
+      first_dim: first dimension of the sequences in the batch. The gather
+        skips the ones before it, so the batch is contiguous without them
+    Returns
+      The tuple (encoder_inputs, decoder_inputs, decoder_outputs, all_poses)
+    """
+    if self.velocity is None:
+      raise ValueError("The arena was built without velocities")
+
+    total_frames = source_seq_len + target_seq_len
+    rows = starts[:, None] + np.arange( total_frames )
+    velocity, data = self.velocity[:, first_dim:], self.data[:, first_dim:]
+    sources = ((velocity, rows[:, 0:source_seq_len-2]),
+               (velocity, rows[:, source_seq_len-2:total_frames-2]),
+               (velocity, rows[:, source_seq_len-1:total_frames-1]),
+               (data, rows))
+
+    if out is None and not self.nactions:
+      return tuple( np.take(source, idx, axis=0) for source, idx in sources )
+
+    ndims = data.shape[1]
+    if out is None:
+      out = tuple( np.empty(idx.shape + (ndims + self.nactions,), dtype=source.dtype) for source, idx in sources )
+
+    for (source, idx), buf in zip( sources, out ):
+      if not self.nactions and buf.dtype == source.dtype:
+        np.take( source, idx, axis=0, out=buf )
+      else:
+        buf[ :, :, :ndims ] = np.take( source, idx, axis=0 )
+
+    if self.nactions:
+      for buf in out[:3]:
+        buf[ :, :, ndims: ] = 0
+      self.set_one_hot( out[3], starts )
+    return out
+
+
+def window_batch(windows, source_seq_len, target_seq_len, out=None):
+  """
+  Batch in the format of SequenceArena.batch from gathered windows, with the
+  velocities computed on the windows. For arenas that read or decode the
+  windows as they are gathered, and keep no precomputed velocities.
+
+  Args
+    windows: batch_size x total_frames x d array of windows
+    source_seq_len: length of the input sequence
+    target_seq_len: length of the target sequence
+    out: optional tuple of four arrays to write the batch into
+  Returns
+    The tuple (encoder_inputs, decoder_inputs, decoder_outputs, all_poses)
+  """
+  total_frames = source_seq_len + target_seq_len
+  velocity = windows[:, 1:, :] - windows[:, :-1, :]
+
+  batch = (velocity[:, 0:source_seq_len-2, :],
+           velocity[:, source_seq_len-2:total_frames-2, :],
+           velocity[:, source_seq_len-1:total_frames-1, :],
+           windows)
+
+  if out is None:
+    return batch
+  for source, buf in zip( batch, out ):
+    buf[...] = source
+  return out
+
+
+class EncodedArena(SequenceArena):
+  """
+  SequenceArena over sequences that stay in the compact encoding of
+  encode_poses. The used dimensions of all the sequences are kept back to
+  back in one int16 or float16 array, and only the gathered windows are
+  decoded and normalized, with the offset and scale of their sequence. The
+  training set takes a quarter of the memory of float64 data, half of float32.
+  """
+
+  def __init__(self, encoded, data_mean, data_std, dim_to_use, margin=16, dtype=np.float32, actions=None):
+    """
+    Args
+      encoded: dictionary with k:v, k=(subject, action, subaction, 'even'),
+        v=dictionary given by read_encoded_poses, without delta encoding
+      data_mean: vector of mean used to normalize the data
+      data_std: vector of standard deviation used to normalize the data
+      dim_to_use: vector with dimensions used by the model
+      margin: number of frames skipped at the beginning of every sequence
+        when sampling windows
+      dtype: type of the decoded windows
+      actions: list of strings with the actions of the one-hot encoding, or
+        None for batches without one
+    Raises
+      ValueError if a sequence is delta encoded
+    """
+    self.sequence_keys = list( encoded.keys() )
+    self.margin = margin
+    self._set_actions( actions )
+    self.lengths = np.array( [encoded[key]['values'].shape[0] for key in self.sequence_keys], dtype=np.int64 )
+    self.offsets = np.zeros( len(self.sequence_keys) + 1, dtype=np.int64 )
+    self.offsets[1:] = np.cumsum( self.lengths )
+
+    # Decoding and normalizing is one affine map per sequence and dimension:
+    # (values * scale + offset - mean) / std, kept as values * self.norm_scale + self.norm_offset
+    dim_to_use = np.asarray( dim_to_use )
+    mean_to_use, std_to_use = data_mean[ dim_to_use ], data_std[ dim_to_use ]
+    first = encoded[ self.sequence_keys[0] ]['values']
+    self.values = np.empty( (self.offsets[-1], len(dim_to_use)), dtype=first.dtype )
+    self.norm_scale = np.empty( (len(self.sequence_keys), len(dim_to_use)), dtype=dtype )
+    self.norm_offset = np.empty( (len(self.sequence_keys), len(dim_to_use)), dtype=dtype )
+    for i, key in enumerate( self.sequence_keys ):
+      if encoded[ key ]['delta']:
+        raise ValueError("Delta encoded values cannot be gathered, read them with read_encoded_poses")
+      self.values[ self.offsets[i]:self.offsets[i+1], : ] = encoded[ key ]['values'][ :, dim_to_use ]
+      self.norm_scale[ i ] = encoded[ key ]['scale'][ dim_to_use ] / std_to_use
+      self.norm_offset[ i ] = (encoded[ key ]['offset'][ dim_to_use ] - mean_to_use) / std_to_use
+
+    self.dtype = dtype
+    self.data = None
+    self.velocity = None
+    self._positions = dict( (key, i) for i, key in enumerate(self.sequence_keys) )
+    self._window_starts = {}
+
+  def __getitem__(self, key):
+    """The decoded and normalized sequence stored under key"""
+    i = self._positions[ key ]
+    return self.values[ self.offsets[i]:self.offsets[i+1], : ] * self.norm_scale[ i ] + self.norm_offset[ i ]
+
+  def gather(self, starts, total_frames):
+    """
+    Args
+      starts: vector with window starts in the arena
+      total_frames: number of frames in a window
+    Returns
+      windows: len(starts) x total_frames x d array with the decoded and
+        normalized windows, and the one-hot encoding of their action
+    """
+    ndims = self.values.shape[1]
+    windows = np.empty( (len(starts), total_frames, ndims + self.nactions), dtype=self.dtype )
+    sequence_idx = np.searchsorted( self.offsets, starts, side='right' ) - 1
+    decoded = windows[ :, :, :ndims ]
+    np.multiply( self.values[ starts[:, None] + np.arange(total_frames) ], self.norm_scale[ sequence_idx ][:, None, :],
+                 out=decoded )
+    decoded += self.norm_offset[ sequence_idx ][:, None, :]
+
+    if self.nactions:
+      self.set_one_hot( windows, starts )
+    return windows
+
+  def batch(self, starts, source_seq_len, target_seq_len, out=None, first_dim=0):
+    """
+    Same as SequenceArena.batch, with the velocities computed on the decoded windows.
+    """
+    windows = self.gather( starts, source_seq_len + target_seq_len )
+    return window_batch( windows[:, :, first_dim:], source_seq_len, target_seq_len, out )
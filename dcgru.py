@@ -11,6 +11,173 @@ import tensorflow as tf
 from tensorflow.contrib.rnn import RNNCell
 
 
+def magnitude_mask(adj_mx, sparsity, mask=None):
+    """Sparsity pattern keeping the largest entries of an adjacency matrix in magnitude.
+
+    The largest entry of every row and of every column is always kept, so no
+    degree of the random walk supports is zero.
+
+    :param adj_mx: (num_nodes, num_nodes) numpy array.
+    :param sparsity: fraction of the entries to remove, in [0, 1).
+    :param mask: optional boolean (num_nodes, num_nodes) sparsity pattern the graph
+        already has. Only its entries are ranked and can be kept, and sparsity is
+        a fraction of them.
+    :return: boolean (num_nodes, num_nodes) mask.
+    :raises ValueError: when sparsity is out of range.
+    """
+    if not 0 <= sparsity < 1:
+        raise ValueError("The sparsity must be in [0, 1), got {0}".format(sparsity))
+    if mask is None:
+        mask = np.ones(adj_mx.shape, dtype=bool)
+    # Entries out of the mask rank below all the others, and are never kept
+    magnitude = np.where(mask, np.abs(adj_mx), -1.)
+    keep = int(np.ceil((1 - sparsity) * np.sum(mask)))
+    pruned = magnitude >= np.sort(magnitude, axis=None)[-keep]
+    nodes = np.arange(magnitude.shape[0])
+    pruned[nodes, np.argmax(magnitude, axis=1)] = True
+    pruned[np.argmax(magnitude, axis=0), nodes] = True
+    return pruned & mask
+
+
+class DiffusionSupports(object):
+    """Diffusion supports of an adjacency matrix, built once and shared.
+
+    The supports are normalized from adj_mx and cast to the type of the cells a
+    single time, so every cell, direction and unrolled timestep that is given
+    the same instance reads the same tensors, which the graph computes once
+    per session.run.
+
+    With a mask, only the entries of adj_mx in the mask are edges of the graph,
+    and the supports are tf.SparseTensor, applied in O(edges) instead of
+    O(num_nodes^2).
+    """
+
+    def __init__(self, adj_mx, filter_type="laplacian", dtype=tf.float32, mask=None):
+        """
+
+        :param adj_mx: (num_nodes, num_nodes) adjacency matrix, a tensor or a variable.
+        :param filter_type: "laplacian", "random_walk", "dual_random_walk".
+        :param dtype: type of the supports, the type of the cells using them.
+        :param mask: optional boolean (num_nodes, num_nodes) numpy array, the sparsity
+            pattern of the graph.
+        """
+        self.filter_type = filter_type
+        self.dtype = dtype
+        self.supports = []
+        self.sparse = mask is not None
+        self._polynomial_stacks = {}
+        with tf.name_scope("diffusion_supports"):
+            adj_mx = tf.cast(adj_mx, dtype=dtype)
+            self._num_nodes = tf.shape(adj_mx)[0]
+            if self.sparse:
+                self.supports = self._sparse_supports(adj_mx, np.asarray(mask, dtype=bool), filter_type)
+            elif filter_type == "random_walk":
+                self.supports.append(tf.transpose(self.calculate_random_walk_matrix(adj_mx), [1, 0]))
+            elif filter_type == "dual_random_walk":
+                self.supports.append(tf.transpose(self.calculate_random_walk_matrix(adj_mx), [1, 0]))
+                self.supports.append(tf.transpose(self.calculate_random_walk_matrix(tf.transpose(adj_mx, [1, 0])), [1, 0]))
+            else:
+                self.supports.append(self.calculate_scaled_laplacian(adj_mx))
+
+    def __len__(self):
+        return len(self.supports)
+
+    def __iter__(self):
+        return iter(self.supports)
+
+    @staticmethod
+    def _sparse_supports(adj_mx, mask, filter_type, lambda_max=2):
+        """The supports of the constructor, from the entries of adj_mx in mask only."""
+        num_nodes = mask.shape[0]
+        shape = np.array(mask.shape, dtype=np.int64)
+
+        def sparse(indices, values):
+            return tf.sparse_reorder(tf.SparseTensor(indices, values, shape))
+
+        if filter_type in ("random_walk", "dual_random_walk"):
+            indices = np.argwhere(mask)
+            rows, cols = indices[:, 0], indices[:, 1]
+            values = tf.gather_nd(adj_mx, indices)
+            # Transposed D^-1 A: entry (i, j) of A, divided by the degree of row i, goes to (j, i)
+            d = tf.unsorted_segment_sum(tf.abs(values), rows, num_nodes)
+            supports = [sparse(indices[:, ::-1], values / tf.gather(d, rows))]
+            if filter_type == "dual_random_walk":
+                # Transposed D^-1 A^T: entry (i, j) of A, divided by the degree of column j, stays at (i, j)
+                d = tf.unsorted_segment_sum(tf.abs(values), cols, num_nodes)
+                supports.append(sparse(indices, values / tf.gather(d, cols)))
+            return supports
+
+        # Symmetrized, with the diagonal the identity of the laplacian lives on
+        indices = np.argwhere(mask | mask.T | np.eye(num_nodes, dtype=bool))
+        rows, cols = indices[:, 0], indices[:, 1]
+        # Entries added by the symmetrization or the diagonal are zeros of the masked adj_mx
+        in_mask = tf.constant(mask[rows, cols].astype(np.float64), dtype=adj_mx.dtype)
+        transposed_in_mask = tf.constant(mask[cols, rows].astype(np.float64), dtype=adj_mx.dtype)
+        values = tf.maximum(tf.gather_nd(adj_mx, indices) * in_mask,
+                            tf.gather_nd(adj_mx, indices[:, ::-1]) * transposed_in_mask)
+        d = tf.unsorted_segment_sum(values, rows, num_nodes)
+        d_inv_sqrt = tf.where(d > 0, tf.rsqrt(d), tf.zeros_like(d))
+        normalized = tf.gather(d_inv_sqrt, rows) * values * tf.gather(d_inv_sqrt, cols)
+        identity = tf.constant((rows == cols).astype(np.float64), dtype=values.dtype)
+        return [sparse(indices, (2. / lambda_max) * (identity - normalized) - identity)]
+
+    @staticmethod
+    def matmul(support, x):
+        """support times the 2D x, for dense and sparse supports."""
+        if isinstance(support, tf.SparseTensor):
+            return tf.sparse_tensor_dense_matmul(support, x)
+        return tf.matmul(support, x)
+
+    def polynomial_stack(self, max_diffusion_step):
+        """Operators of all the diffusion terms of DCGRUCell._gconv, stacked.
+
+        The recurrence of _gconv is run on the identity instead of the
+        activations, carrying x0 and x1 from one support to the next like it
+        does, so term i of _gconv is block i of the stack times its input.
+
+        :param max_diffusion_step: number of diffusion steps of every support.
+        :return: (num_matrices * num_nodes, num_nodes) tensor, with
+            num_matrices = len(supports) * max_diffusion_step + 1.
+        """
+        if max_diffusion_step not in self._polynomial_stacks:
+            with tf.name_scope("diffusion_polynomials"):
+                x0 = tf.eye(self._num_nodes, dtype=self.dtype)
+                terms = [x0]
+                if max_diffusion_step > 0:
+                    for support in self.supports:
+                        x1 = self.matmul(support, x0)
+                        terms.append(x1)
+
+                        for k in range(2, max_diffusion_step + 1):
+                            x2 = 2 * self.matmul(support, x1) - x0
+                            terms.append(x2)
+                            x1, x0 = x2, x1
+                self._polynomial_stacks[max_diffusion_step] = tf.concat(terms, axis=0)
+        return self._polynomial_stacks[max_diffusion_step]
+
+    @staticmethod
+    def calculate_random_walk_matrix(adj_mx):
+        # D^-1 A, with the degrees of the rows
+        d = tf.reduce_sum(tf.abs(adj_mx), 1)
+        d_inv = tf.div(tf.ones_like(d), d)
+        return tf.expand_dims(d_inv, 1) * adj_mx
+
+    @staticmethod
+    def calculate_reverse_random_walk_matrix(adj_mx):
+        return DiffusionSupports.calculate_random_walk_matrix(tf.transpose(adj_mx, [1, 0]))
+
+    @staticmethod
+    def calculate_scaled_laplacian(adj_mx, lambda_max=2):
+        # 2 L / lambda_max - I, L = I - D^-1/2 A D^-1/2 of the symmetrized graph
+        adj_mx = tf.maximum(adj_mx, tf.transpose(adj_mx, [1, 0]))
+        d = tf.reduce_sum(adj_mx, 1)
+        d_inv_sqrt = tf.where(d > 0, tf.rsqrt(d), tf.zeros_like(d))
+        normalized = tf.expand_dims(d_inv_sqrt, 1) * adj_mx * tf.expand_dims(d_inv_sqrt, 0)
+        identity = tf.eye(tf.shape(adj_mx)[0], dtype=adj_mx.dtype)
+        laplacian = identity - normalized
+        return (2. / lambda_max) * laplacian - identity
+
+
 class DCGRUCell(RNNCell):
     """Graph Convolution Gated Recurrent Unit cell.
     """
@@ -22,7 +189,8 @@ class DCGRUCell(RNNCell):
         pass
 
     def __init__(self, num_units, adj_mx, max_diffusion_step, num_nodes, num_proj=None,
-                 activation=tf.nn.tanh, reuse=None, filter_type="laplacian", use_gc_for_ru=True):
+                 activation=tf.nn.tanh, reuse=None, filter_type="laplacian", use_gc_for_ru=True,
+                 supports=None, stacked_polynomials=False, fused=False):
         """
 
         :param num_units:
@@ -35,6 +203,14 @@ class DCGRUCell(RNNCell):
         :param reuse:
         :param filter_type: "laplacian", "random_walk", "dual_random_walk".
         :param use_gc_for_ru: whether to use Graph convolution to calculate the reset and update gates.
+        :param supports: DiffusionSupports shared with other cells. When None, the
+            cell builds its own from adj_mx and filter_type.
+        :param stacked_polynomials: whether to apply all the diffusion terms with one
+            matmul against the stacked polynomials of the supports, instead of running
+            the recurrence on the activations at every call.
+        :param fused: whether every step diffuses its inputs once, for both the gates
+            and the candidate, instead of once per graph convolution. The variables
+            are the same.
         """
         super(DCGRUCell, self).__init__(_reuse=reuse)
         self._activation = activation
@@ -42,18 +218,15 @@ class DCGRUCell(RNNCell):
         self._num_proj = num_proj
         self._num_units = num_units
         self._max_diffusion_step = max_diffusion_step
-        self._supports = []
         self._use_gc_for_ru = use_gc_for_ru
-        supports = []
-        if filter_type == "random_walk":
-            supports.append(tf.transpose(self.calculate_random_walk_matrix(adj_mx), [1, 0]))
-        elif filter_type == "dual_random_walk":
-            supports.append(tf.transpose(self.calculate_random_walk_matrix(adj_mx), [1, 0]))
-            supports.append(tf.transpose(self.calculate_random_walk_matrix(tf.transpose(adj_mx, [1, 0])), [1, 0]))
-        else:
-            supports.append(self.calculate_scaled_laplacian(adj_mx))
-        for support in supports:
-            self._supports.append(support)
+        if fused and not use_gc_for_ru:
+            raise ValueError("The fused cell needs the graph convolution gates, use_gc_for_ru must be True")
+        self._fused = fused
+        if supports is None:
+            supports = DiffusionSupports(adj_mx, filter_type)
+        self._supports = list(supports)
+        self._sparse = supports.sparse
+        self._polynomials = supports.polynomial_stack(max_diffusion_step) if stacked_polynomials else None
 
     @staticmethod
     def _build_sparse_matrix(L):
@@ -82,20 +255,42 @@ class DCGRUCell(RNNCell):
         - New state: Either a single `2-D` tensor, or a tuple of tensors matching
             the arity and shapes of `state`
         """
+        if self._fused:
+            # The input half of both graph convolutions, from one diffusion of the inputs
+            inputs = self.hoist_inputs([inputs], scope)[0]
+            return self._step(inputs, state, scope, hoisted=True)
+        return self._step(inputs, state, scope)
+
+    def _step(self, inputs, state, scope=None, hoisted=False):
+        """One step of the cell.
+
+        :param inputs: (B, num_nodes * input_dim), or when hoisted the
+            (B, num_nodes * 3 * num_units) input terms made by hoist_inputs.
+        :param hoisted: whether the inputs are already diffused and weighted, so
+            only the state is diffused here.
+        """
         with tf.variable_scope(scope or "dcgru_cell"):
+            if hoisted:
+                inputs = tf.reshape(inputs, (-1, self._num_nodes, 3 * self._num_units))
+                gates_inputs, candidate_inputs = tf.split(inputs, [2 * self._num_units, self._num_units], axis=-1)
             with tf.variable_scope("gates"):  # Reset gate and update gate.
                 output_size = 2 * self._num_units
-                if self._use_gc_for_ru:
-                    fn = self._gconv
+                if hoisted:
+                    value = self._gconv_hoisted(gates_inputs, state, output_size, bias_start=1.0)
+                elif self._use_gc_for_ru:
+                    value = self._gconv(inputs, state, output_size, bias_start=1.0)
                 else:
-                    fn = self._fc
-                value = tf.nn.sigmoid(fn(inputs, state, output_size, bias_start=1.0))
+                    value = self._fc(inputs, state, output_size, bias_start=1.0)
+                value = tf.nn.sigmoid(value)
                 value = tf.reshape(value, (-1, self._num_nodes, output_size))
                 r, u = tf.split(value=value, num_or_size_splits=2, axis=-1)
                 r = tf.reshape(r, (-1, self._num_nodes * self._num_units))
                 u = tf.reshape(u, (-1, self._num_nodes * self._num_units))
             with tf.variable_scope("candidate"):
-                c = self._gconv(inputs, r * state, self._num_units)
+                if hoisted:
+                    c = self._gconv_hoisted(candidate_inputs, r * state, self._num_units)
+                else:
+                    c = self._gconv(inputs, r * state, self._num_units)
                 if self._activation is not None:
                     c = self._activation(c)
             output = new_state = u * state + (1 - u) * c
@@ -107,10 +302,41 @@ class DCGRUCell(RNNCell):
                     output = tf.reshape(tf.matmul(output, w), shape=(-1, self.output_size))
         return output, new_state
 
-    @staticmethod
-    def _concat(x, x_):
-        x_ = tf.expand_dims(x_, 0)
-        return tf.concat([x, x_], axis=0)
+    def hoist_inputs(self, inputs, scope=None):
+        """Diffuse and weight the inputs of a whole known sequence at once.
+
+        The graph convolutions of the cell are linear in the concatenation of
+        inputs and state, so their input half is the diffusion of the inputs
+        times the input rows of the weights. This computes it for all the
+        timesteps with one diffusion and one matmul; HoistedInputCell then only
+        diffuses the state at every step. Must be called in the variable scope
+        the steps run in, it reads (or creates) the same variables.
+
+        :param inputs: list of T (B, num_nodes * input_dim) tensors.
+        :param scope: variable scope of the cell, like in __call__.
+        :return: list of T (B, num_nodes * 3 * num_units) tensors, the input terms
+            of the gates and the candidate of every step.
+        :raises ValueError: when the gates are not graph convolutions.
+        """
+        if not self._use_gc_for_ru:
+            raise ValueError("Only the graph convolution gates can be hoisted, use_gc_for_ru must be True")
+        input_dim = inputs[0].get_shape()[1].value // self._num_nodes
+        input_size = input_dim + self._num_units
+        dtype = inputs[0].dtype
+        weights = []
+        with tf.variable_scope(scope or "dcgru_cell"):
+            for name, output_size in [("gates", 2 * self._num_units), ("candidate", self._num_units)]:
+                with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+                    w = self._gconv_weights(input_size, output_size, dtype)
+                    # Rows of the input features, ordered (input_dim, num_matrices) like the diffused inputs
+                    w = tf.reshape(w, [input_size, -1, output_size])[:input_dim]
+                    weights.append(tf.reshape(w, [-1, output_size]))
+
+        steps = len(inputs)
+        x = tf.reshape(tf.stack(inputs), (-1, self._num_nodes, input_dim))  # (T * B, num_nodes, input_dim)
+        x = tf.matmul(self._diffuse(x), tf.concat(weights, axis=1))  # (T * B * num_nodes, 3 * num_units)
+        x = tf.reshape(x, [steps, -1, self._num_nodes * 3 * self._num_units])
+        return tf.unstack(x, num=steps)
 
     def _fc(self, inputs, state, output_size, bias_start=0.0):
         dtype = inputs.dtype
@@ -148,49 +374,132 @@ class DCGRUCell(RNNCell):
         input_size = inputs_and_state.get_shape()[2].value
         dtype = inputs.dtype
 
-        x = inputs_and_state
-        x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, total_arg_size, batch_size)
-        x0 = tf.reshape(x0, shape=[self._num_nodes, -1])
-        x = tf.expand_dims(x0, axis=0)
-
         scope = tf.get_variable_scope()
         with tf.variable_scope(scope, reuse=tf.AUTO_REUSE):
-            if self._max_diffusion_step == 0:
-                pass
-            else:
-                for support in self._supports:
-                    support = tf.cast(support, dtype=tf.float32)
-                    x1 = tf.matmul(support, x0)
-                    x = self._concat(x, x1)
+            x = self._diffuse(inputs_and_state)
+            weights = self._gconv_weights(input_size, output_size, dtype)
+            x = tf.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
 
-                    for k in range(2, self._max_diffusion_step + 1):
-                        x2 = 2 * tf.matmul(support, x1) - x0
-                        x = self._concat(x, x2)
-                        x1, x0 = x2, x1
+            biases = tf.get_variable("biases", [output_size], dtype=dtype,
+                                     initializer=tf.constant_initializer(bias_start, dtype=dtype))
+            x = tf.nn.bias_add(x, biases)
+        # Reshape res back to 2D: (batch_size, num_node, state_dim) -> (batch_size, num_node * state_dim)
+        return tf.reshape(x, [-1, self._num_nodes * output_size])
 
-            num_matrices = len(self._supports) * self._max_diffusion_step + 1
-            x = tf.reshape(x, shape=[num_matrices, self._num_nodes, input_size, -1])
-            x = tf.transpose(x, perm=[3, 1, 2, 0])  # (batch_size, num_nodes, input_size, order)
-            x = tf.reshape(x, shape=[-1, input_size * num_matrices])
+    def _gconv_hoisted(self, inputs, state, output_size, bias_start=0.0):
+        """_gconv with the input half given, diffused and weighted by hoist_inputs.
 
-            weights = tf.get_variable(
-                'weights', [input_size * num_matrices, output_size], dtype=dtype,
-                initializer=tf.contrib.layers.xavier_initializer())
-            x = tf.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
+        :param inputs: (batch_size, num_nodes, output_size) input terms.
+        :param state: (batch_size, num_nodes * state_dim)
+        :return: (batch_size, num_nodes * output_size), what _gconv returns.
+        """
+        state_dim = state.get_shape()[1].value // self._num_nodes
+        state = tf.reshape(state, (-1, self._num_nodes, state_dim))
+        dtype = state.dtype
+
+        scope = tf.get_variable_scope()
+        with tf.variable_scope(scope, reuse=tf.AUTO_REUSE):
+            weights = tf.get_variable('weights', dtype=dtype)
+            num_matrices = len(self._supports) * self._max_diffusion_step + 1
+            # Rows of the state features, the last state_dim of every (input_size, num_matrices) row block
+            weights = tf.reshape(weights, [-1, num_matrices, output_size])[-state_dim:]
+            weights = tf.reshape(weights, [state_dim * num_matrices, output_size])
+            x = tf.matmul(self._diffuse(state), weights) + tf.reshape(inputs, [-1, output_size])
 
             biases = tf.get_variable("biases", [output_size], dtype=dtype,
                                      initializer=tf.constant_initializer(bias_start, dtype=dtype))
             x = tf.nn.bias_add(x, biases)
-        # Reshape res back to 2D: (batch_size, num_node, state_dim) -> (batch_size, num_node * state_dim)
         return tf.reshape(x, [-1, self._num_nodes * output_size])
 
-    def calculate_random_walk_matrix(self, adj_mx):
-      d = tf.reduce_sum(tf.abs(adj_mx), 1)
-      d_inv = tf.div(tf.ones_like(d), d)
-      d_mat_inv = tf.matrix_diag(d_inv)
-      random_walk_mx = tf.matmul(d_mat_inv, adj_mx)
-      return random_walk_mx
+    def _gconv_weights(self, input_size, output_size, dtype):
+        num_matrices = len(self._supports) * self._max_diffusion_step + 1
+        return tf.get_variable(
+            'weights', [input_size * num_matrices, output_size], dtype=dtype,
+            initializer=tf.contrib.layers.xavier_initializer())
+
+    def _diffuse(self, x):
+        """All the diffusion terms of the features of every node.
+
+        The activations stay batch-major: the supports are applied to the node
+        axis with einsum, and the terms are stacked once on a last order axis,
+        which is already the row layout of the weights. Sparse supports only
+        multiply 2D tensors, so they diffuse a node-major copy instead.
+
+        :param x: (batch_size, num_nodes, input_size)
+        :return: (batch_size * num_nodes, input_size * num_matrices), the features
+            of every node ordered (input_size, num_matrices).
+        """
+        input_size = x.get_shape()[2].value
+        num_matrices = len(self._supports) * self._max_diffusion_step + 1
+
+        if self._polynomials is not None:
+            x = tf.einsum('pn,bnf->bpf', self._polynomials, x)  # (batch_size, num_matrices * num_nodes, input_size)
+            x = tf.reshape(x, [-1, num_matrices, self._num_nodes, input_size])
+            x = tf.transpose(x, perm=[0, 2, 3, 1])  # (batch_size, num_nodes, input_size, order)
+        elif self._sparse:
+            x0 = tf.reshape(tf.transpose(x, perm=[1, 0, 2]), [self._num_nodes, -1])  # (num_nodes, batch_size * input_size)
+            terms = [x0]
+            if self._max_diffusion_step > 0:
+                for support in self._supports:
+                    x1 = tf.sparse_tensor_dense_matmul(support, x0)
+                    terms.append(x1)
+
+                    for k in range(2, self._max_diffusion_step + 1):
+                        x2 = 2 * tf.sparse_tensor_dense_matmul(support, x1) - x0
+                        terms.append(x2)
+                        x1, x0 = x2, x1
+            x = tf.reshape(tf.stack(terms, axis=-1), [self._num_nodes, -1, input_size, num_matrices])
+            x = tf.transpose(x, perm=[1, 0, 2, 3])  # (batch_size, num_nodes, input_size, order)
+        else:
+            x0 = x
+            terms = [x0]
+            if self._max_diffusion_step > 0:
+                for support in self._supports:
+                    x1 = tf.einsum('nm,bmf->bnf', support, x0)
+                    terms.append(x1)
 
+                    for k in range(2, self._max_diffusion_step + 1):
+                        x2 = 2 * tf.einsum('nm,bmf->bnf', support, x1) - x0
+                        terms.append(x2)
+                        x1, x0 = x2, x1
+            x = tf.stack(terms, axis=-1)  # (batch_size, num_nodes, input_size, order)
+        return tf.reshape(x, shape=[-1, input_size * num_matrices])
+
+    def calculate_random_walk_matrix(self, adj_mx):
+        return DiffusionSupports.calculate_random_walk_matrix(adj_mx)
 
     def calculate_reverse_random_walk_matrix(self, adj_mx):
-      return self.calculate_random_walk_matrix(tf.transpose(adj_mx, [1, 0]))
+        return DiffusionSupports.calculate_reverse_random_walk_matrix(adj_mx)
+
+
+class HoistedInputCell(RNNCell):
+    """Steps of a DCGRUCell over inputs already diffused by its hoist_inputs.
+
+    Runs in the same variable scopes as the wrapped cell, so both share their
+    variables, and checkpoints do not depend on the mode.
+    """
+
+    def call(self, inputs, **kwargs):
+        pass
+
+    def compute_output_shape(self, input_shape):
+        pass
+
+    def __init__(self, cell):
+        """
+
+        :param cell: the DCGRUCell whose hoist_inputs made the inputs.
+        """
+        super(HoistedInputCell, self).__init__()
+        self._cell = cell
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def __call__(self, inputs, state, scope=None):
+        return self._cell._step(inputs, state, scope, hoisted=True)
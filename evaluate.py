@@ -21,6 +21,7 @@ def evaluate():
   seq_length_out = 25
   # Load all the data
   parent, offset, rotInd, expmapInd = forward_kinematics._some_variables()
+  tree = forward_kinematics.KinematicTree( parent, offset, rotInd, expmapInd )
 
 
   with h5py.File('samples.h5', 'r') as h5f:
@@ -33,29 +34,22 @@ def evaluate():
       # Compute and save the errors here
       mean_errors=[]
       for i in np.arange(8):
-          srnn_pred = h5f['expmap/preds/' + action + '_' + str(i)][:seq_length_out, :]
-          srnn_gts = h5f['expmap/gt/' + action + '_' + str(i)][:seq_length_out, :]
+          srnn_pred = data_utils.read_poses( h5f['expmap/preds/' + action + '_' + str(i)] )[:seq_length_out, :]
+          srnn_gts = data_utils.read_poses( h5f['expmap/gt/' + action + '_' + str(i)] )[:seq_length_out, :]
 
           rotation_pred = forward_kinematics.revert_coordinate_space(srnn_pred, np.eye(3), np.zeros(3))
           rotation_gt = forward_kinematics.revert_coordinate_space(srnn_gts, np.eye(3), np.zeros(3))
-          xyz_gt_tmp, xyz_pred_tmp = np.zeros((seq_length_out, 96)), np.zeros((seq_length_out, 96))
 
-          # Compute 3d points for each frame
-          for j in range(seq_length_out):
-              xyz_gt_tmp[j, :] = forward_kinematics.fkl(rotation_gt[j, :], parent, offset, rotInd, expmapInd)
-          for j in range(seq_length_out):
-              xyz_pred_tmp[j, :] = forward_kinematics.fkl(rotation_pred[j, :], parent, offset, rotInd, expmapInd)
+          # Compute 3d points for all the frames
+          xyz_gt_tmp = tree.fkl(rotation_gt)
+          xyz_pred_tmp = tree.fkl(rotation_pred)
 
           xyz_gt.append(xyz_gt_tmp)
           xyz_pred.append(xyz_pred_tmp)
 
           # change back to euler to evaluate MAE
-          for j in np.arange(srnn_pred.shape[0]):
-              for k in np.arange(3, 97, 3):
-                  srnn_gts[j, k:k + 3] = data_utils.rotmat2euler(
-                      data_utils.expmap2rotmat(srnn_gts[j, k:k + 3]))
-                  srnn_pred[j, k:k + 3] = data_utils.rotmat2euler(
-                      data_utils.expmap2rotmat(srnn_pred[j, k:k + 3]))
+          srnn_gts = data_utils.expmap2euler_channels(srnn_gts)
+          srnn_pred = data_utils.expmap2euler_channels(srnn_pred)
 
 
           srnn_pred[:, 0:6] = 0
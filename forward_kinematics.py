@@ -2,12 +2,8 @@ from __future__ import division
 
 import numpy as np
 import h5py
-import matplotlib
-import matplotlib.pyplot as plt
-import viz
 import copy
 import data_utils
-import tensorflow as tf
 import os
 
 def fkl( angles, parent, offset, rotInd, expmapInd ):
@@ -61,16 +57,115 @@ def fkl( angles, parent, offset, rotInd, expmapInd ):
 
   return np.reshape( xyz, [-1] )
 
-def revert_coordinate_space(channels, R0, T0):
+
+class KinematicTree(object):
+  """
+  Forward kinematics of fkl over whole sequences. The traversal of the tree
+  is worked out once: the joints are grouped by depth, so every level is a
+  batched matrix product with the level of its parents.
+  """
+
+  def __init__(self, parent, offset, rotInd, expmapInd):
+    """
+    Args
+      parent: 32-long vector with parent-child relationships in the kinematic tree
+      offset: 96-long vector with bone lenghts
+      rotInd: 32-long list with indices into angles
+      expmapInd: 32-long list with indices into expmap angles
+    Raises
+      ValueError if the root is not the first joint, or a joint comes before its parent
+    """
+    njoints = len( parent )
+    if parent[0] != -1 or np.any( parent[1:] >= np.arange(1, njoints) ) or np.any( parent[1:] < 0 ):
+      raise ValueError("The root must be the first joint and every parent must come before its children")
+
+    self.parent = np.asarray( parent )
+    self.offset = np.reshape( offset, (njoints, 3) )
+    self.expmapInd = np.array( expmapInd )
+
+    # Joints without a position take it from an extra column of zeros, at index 99
+    self.positionInd = np.array( [[k-1 for k in ind] if ind else [99, 99, 99] for ind in rotInd] )
+
+    depth = np.zeros( njoints, dtype=np.int64 )
+    for i in range( 1, njoints ):
+      depth[i] = depth[ parent[i] ] + 1
+    self.levels = [np.where( depth == d )[0] for d in range( 1, depth.max() + 1 )]
+
+  def fkl(self, angles):
+    """
+    Same as fkl, on many frames at once.
+
+    Args
+      angles: nx99 matrix with 3d position and 3d joint angles in expmap format
+    Returns
+      xyz: nx96 matrix with the 3d points of the 32 joints of every frame
+    """
+    angles = np.asarray( angles )
+    n = angles.shape[0]
+    padded = np.concatenate( [angles, np.zeros((n, 1), dtype=angles.dtype)], axis=1 )
+
+    rotations = data_utils.expmap2rotmat_batch( angles[:, self.expmapInd] )
+    positions = self.offset + padded[:, self.positionInd]
+
+    xyz = np.zeros( (n, len(self.parent), 3) )
+    xyz[:, 0] = positions[:, 0]
+    for joints in self.levels:
+      parents = self.parent[ joints ]
+      parent_rotations = rotations[:, parents]
+      xyz[:, joints] = np.matmul( positions[:, joints, np.newaxis, :], parent_rotations )[:, :, 0, :] + xyz[:, parents]
+      rotations[:, joints] = np.matmul( rotations[:, joints], parent_rotations )
+
+    xyz = xyz[:, :, [0,2,1]]
+    return np.reshape( xyz, [n, -1] )
+
+def _prefix_products(D, chunk_size=64):
+  """
+  Cumulative products of rotations, P[k] = D[k] D[k-1] ... D[0]. The sequence
+  is cut in chunks; the products within all the chunks are scanned together in
+  log2(chunk_size) batched steps, then every chunk is brought after the
+  product of the chunks before it.
+
+  Args
+    D: nx3x3 rotation matrices
+    chunk_size: number of frames in a chunk
+  Returns
+    P: nx3x3 cumulative products
+  """
+  n = D.shape[0]
+  nchunks = -(-n // chunk_size)
+  P = np.tile( np.eye(3), (nchunks * chunk_size, 1, 1) )
+  P[:n] = D
+  P = P.reshape( nchunks, chunk_size, 3, 3 )
+
+  # Scan within the chunks
+  step = 1
+  while step < chunk_size:
+    P[:, step:] = np.matmul( P[:, step:], P[:, :-step] )
+    step *= 2
+
+  # Carry the product of the previous chunks
+  for c in range( 1, nchunks ):
+    P[c] = np.matmul( P[c], P[c-1, -1] )
+
+  return P.reshape( -1, 3, 3 )[:n]
+
+
+def revert_coordinate_space(channels, R0, T0, chunk_size=64):
   """
   Bring a series of poses to a canonical form so they are facing the camera when they start.
   Adapted from
   https://github.com/asheshjain399/RNNexp/blob/7fc5a53292dc0f232867beb66c3a9ef845d705cb/structural_rnn/CRFProblems/H3.6m/dataParser/Utils/revertCoordinateSpace.m
 
+  The root rotation of every frame is the product of the rotation differences
+  so far, R[k] = R_diff[k] R[k-1] starting from R0, and the translation the sum
+  of the position differences turned by the previous rotation. Both are done
+  for all the frames at once.
+
   Args
     channels: n-by-99 matrix of poses
     R0: 3x3 rotation for the first frame
     T0: 1x3 position for the first frame
+    chunk_size: number of frames in a chunk of the cumulative rotation products
   Returns
     channels_rec: The passed poses, but the first has T0 and R0, and the
                   rest of the sequence is modified accordingly.
@@ -78,20 +173,15 @@ def revert_coordinate_space(channels, R0, T0):
   n, d = channels.shape
 
   channels_rec = copy.copy(channels)
-  R_prev = R0
-  T_prev = T0
   rootRotInd = np.arange(3,6)
 
-  # Loop through the passed posses
-  for ii in range(n):
-    R_diff = data_utils.expmap2rotmat( channels[ii, rootRotInd] )
-    R = R_diff.dot( R_prev )
+  R_diff = data_utils.expmap2rotmat_batch( channels[:, rootRotInd] )
+  R = np.matmul( _prefix_products(R_diff, chunk_size), R0 )
+  R_prev = np.concatenate( [np.reshape(R0, (1, 3, 3)), R[:-1]] )
 
-    channels_rec[ii, rootRotInd] = data_utils.rotmat2expmap(R)
-    T = T_prev + ((R_prev.T).dot( np.reshape(channels[ii,:3],[3,1]))).reshape(-1)
-    channels_rec[ii,:3] = T
-    T_prev = T
-    R_prev = R
+  channels_rec[:, rootRotInd] = data_utils.rotmat2expmap_batch( R )
+  T = np.reshape(T0, (1, 3)) + np.cumsum( np.einsum('nji,nj->ni', R_prev, channels[:, :3]), axis=0 )
+  channels_rec[:, :3] = T
 
   return channels_rec
 
@@ -152,13 +242,51 @@ def _some_variables():
 
   return parent, offset, rotInd, expmapInd
 
+def skeleton_adjacency( dim_to_use, number_of_actions=0 ):
+  """
+  Sparsity pattern of the graph of the model inputs, from the kinematic tree.
+  The dimensions of a joint are connected with each other and with those of
+  its parent and children, and every dimension with itself. Joints without a
+  dimension in use are skipped, so their children connect to the closest
+  ancestor in use. The one-hot action nodes connect with all the pose nodes.
+
+  Args
+    dim_to_use: dimensions of the 99 that the data keeps. The model sees them
+      from the 7th on, after the root position and rotation
+    number_of_actions: number of one-hot nodes after the pose nodes, 0 without one-hot
+  Returns
+    mask: boolean nxn matrix, n = len(dim_to_use) - 6 + number_of_actions
+  """
+  parent = _some_variables()[0]
+
+  # Dimensions 3i+3 to 3i+5 are the angles of joint i, the root position goes with the root
+  joints = ( np.maximum(np.asarray(dim_to_use)[6:], 3) - 3 ) // 3
+  used = set( joints )
+  closest = np.array( parent )
+  for i in range( len(parent) ):
+    while closest[i] != -1 and closest[i] not in used:
+      closest[i] = parent[ closest[i] ]
+  ancestors = closest[ joints ]
+
+  npose = len( joints )
+  mask = np.ones( (npose + number_of_actions, npose + number_of_actions), dtype=bool )
+  mask[:npose, :npose] = ( (joints[:, np.newaxis] == joints[np.newaxis, :]) |
+                           (ancestors[:, np.newaxis] == joints[np.newaxis, :]) |
+                           (joints[:, np.newaxis] == ancestors[np.newaxis, :]) )
+  mask[npose:, npose:] = np.eye( number_of_actions, dtype=bool )
+  return mask
+
 def main():
+    # Only the animation needs the plotting modules
+    import matplotlib.pyplot as plt
+    import viz
+
     # Load all the data
     parent, offset, rotInd, expmapInd = _some_variables()
 
     with h5py.File('samples.h5', 'r') as h5f:
-        expmap_gt = h5f['expmap/gt/walking_0'][:]
-        expmap_pred = h5f['expmap/preds/walking_0'][:]
+        expmap_gt = data_utils.read_poses( h5f['expmap/gt/walking_0'] )
+        expmap_pred = data_utils.read_poses( h5f['expmap/preds/walking_0'] )
 
     nframes_gt, nframes_pred = expmap_gt.shape[0], expmap_pred.shape[0]
 
@@ -167,12 +295,9 @@ def main():
     expmap_gt = expmap_all[:nframes_gt, :]
     expmap_pred = expmap_all[nframes_gt:, :]
 
-    # Compute 3d points for each frame
-    xyz_gt, xyz_pred = np.zeros((nframes_gt, 96)), np.zeros((nframes_pred, 96))
-    for i in range(nframes_gt):
-        xyz_gt[i, :] = fkl(expmap_gt[i, :], parent, offset, rotInd, expmapInd)
-    for i in range(nframes_pred):
-        xyz_pred[i, :] = fkl(expmap_pred[i, :], parent, offset, rotInd, expmapInd)
+    # Compute 3d points for all the frames
+    tree = KinematicTree(parent, offset, rotInd, expmapInd)
+    xyz_gt, xyz_pred = tree.fkl(expmap_gt), tree.fkl(expmap_pred)
 
     # === Plot and animate ===
     fig = plt.figure()
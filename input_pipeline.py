@@ -0,0 +1,110 @@
+
+"""tf.data input pipeline that cuts the training windows in the graph."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+
+class WindowPipeline(object):
+  """
+  Training batches as a tf.data.Dataset over the window starts of a
+  data_utils.SequenceArena. The sequences are fed once when the iterator is
+  initialized; windowing, the one-hot encoding of the actions and velocity
+  differencing then run in the graph and batches are prefetched while the
+  model trains. The windows are drawn like SequenceArena.sample_starts draws
+  them: a sequence and then a window inside of it, or uniformly over frames.
+  """
+
+  def __init__(self, arena, source_seq_len, target_seq_len, batch_size, first_dim=6,
+               prefetch=2, seed=None, dtype=tf.float32, uniform_frames=False):
+    """
+    Build the dataset and its iterator.
+
+    Args
+      arena: data_utils.SequenceArena with the normalized training set
+      source_seq_len: length of the input sequence
+      target_seq_len: length of the target sequence
+      batch_size: number of windows in a batch
+      first_dim: first dimension given to the model; the global translation and
+        rotation before it are dropped, as in the training loop
+      prefetch: number of batches prepared ahead
+      seed: seed of the shuffling or the draws of the windows
+      dtype: type of the batches
+      uniform_frames: if True, every valid window is shuffled in once per epoch,
+        so windows are uniform over frames. Otherwise every window picks a
+        sequence at random and then a start inside of it
+    Raises
+      ValueError if windows are drawn per sequence and a sequence is too short
+    """
+    self._arena = arena
+    self._window_ends = None
+    total_frames = source_seq_len + target_seq_len
+    if uniform_frames:
+      self._window_starts = arena.window_starts( total_frames )
+      self._window_actions = np.zeros( len(self._window_starts), dtype=np.int64 )
+      if arena.nactions:
+        sequence_idx = np.searchsorted( arena.offsets, self._window_starts, side='right' ) - 1
+        self._window_actions = arena.action_ids[ sequence_idx ]
+    else:
+      # Range of the valid starts of every sequence
+      self._window_starts = arena.offsets[:-1] + arena.margin
+      self._window_ends = arena.offsets[:-1] + arena.lengths - total_frames
+      if np.any( self._window_ends <= self._window_starts ):
+        raise ValueError("Sequences must be longer than {0} frames".format( total_frames + arena.margin ))
+      self._window_actions = np.zeros( len(self._window_starts), dtype=np.int64 )
+      if arena.nactions:
+        self._window_actions = np.asarray( arena.action_ids, dtype=np.int64 )
+
+    with tf.name_scope("input_pipeline"):
+      self._data = tf.placeholder( tf.as_dtype(arena.data.dtype), shape=arena.data.shape, name="data" )
+      self._starts = tf.placeholder( tf.int64, shape=[None], name="window_starts" )
+      self._actions = tf.placeholder( tf.int64, shape=[None], name="window_actions" )
+      self._ends = tf.placeholder( tf.int64, shape=[None], name="window_ends" )
+      data = self._data
+
+      def windows( starts, actions ):
+        frames = tf.gather( data, tf.expand_dims(starts, 1) + tf.range(total_frames, dtype=tf.int64) )
+        frames = tf.cast( frames[:, :, first_dim:], dtype )
+        if arena.nactions:
+          # Constant over a window, so the one-hot columns of the velocities are zero
+          one_hot = tf.one_hot( actions, arena.nactions, dtype=dtype )
+          frames = tf.concat( [frames, tf.tile(tf.expand_dims(one_hot, 1), [1, total_frames, 1])], axis=2 )
+        velocity = frames[:, 1:, :] - frames[:, :-1, :]
+
+        encoder_inputs  = velocity[:, 0:source_seq_len-2, :]
+        decoder_inputs  = velocity[:, source_seq_len-2:total_frames-2, :]
+        decoder_outputs = velocity[:, source_seq_len-1:total_frames-1, :]
+        return encoder_inputs, decoder_inputs, decoder_outputs, frames
+
+      def draw( _ ):
+        """A batch of sequences, and a window start in each, like sample_starts"""
+        sequences = tf.random_uniform( [batch_size], 0, tf.shape(self._starts, out_type=tf.int64)[0],
+                                       dtype=tf.int64, seed=seed )
+        low, high = tf.gather( self._starts, sequences ), tf.gather( self._ends, sequences )
+        fraction = tf.random_uniform( [batch_size], dtype=tf.float64, seed=None if seed is None else seed + 1 )
+        starts = low + tf.cast( fraction * tf.cast(high - low, tf.float64), tf.int64 )
+        return starts, tf.gather( self._actions, sequences )
+
+      if uniform_frames:
+        # Every valid window once per epoch, in random order
+        dataset = tf.data.Dataset.from_tensor_slices( (self._starts, self._actions) )
+        dataset = dataset.shuffle( len(self._window_starts), seed=seed ).repeat()
+        dataset = dataset.batch( batch_size, drop_remainder=True )
+      else:
+        dataset = tf.data.Dataset.from_tensors( 0 ).repeat().map( draw )
+      dataset = dataset.map( windows )
+      dataset = dataset.prefetch( prefetch )
+
+      self.iterator = dataset.make_initializable_iterator()
+      self.next_batch = self.iterator.get_next()
+
+  def initialize(self, session):
+    """Feed the sequences and the window index, or the start ranges of the sequences, to the iterator."""
+    feed = {self._data: self._arena.data, self._starts: self._window_starts, self._actions: self._window_actions}
+    if self._window_ends is not None:
+      feed[ self._ends ] = self._window_ends
+    session.run( self.iterator.initializer, feed )
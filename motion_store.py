@@ -0,0 +1,316 @@
+
+"""Chunked HDF5 motion store for training on more data than fits in memory."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+
+import h5py
+import numpy as np
+
+import data_utils
+
+
+class MotionStoreWriter(object):
+  """
+  Appends sequences one at a time to a store file, so a collection is
+  converted without ever holding more than one sequence in memory.
+
+  The file holds one `poses` dataset with all the sequences back to back,
+  chunked along the frames and optionally compressed, the offset table of
+  the sequences and their keys. The running normalization stats are saved
+  as attributes when the writer is closed.
+  """
+
+  def __init__(self, filename, ndims, action_names, chunk_frames=1024, compression=None, dtype=np.float32,
+               euler=False, subjects=()):
+    """
+    Args
+      filename: path of the store to create. It is written to filename.tmp and
+        renamed when closed, so an interrupted conversion leaves no store behind
+      ndims: number of dimensions of a frame
+      action_names: list of strings with the actions of the collection
+      chunk_frames: number of frames in a chunk of the poses dataset
+      compression: None, "gzip" or "lzf"
+      dtype: type the poses are stored in
+      euler: whether the angles are Euler angles, or exponential maps
+      subjects: list of numbers with the subjects of the collection
+    """
+    self.filename = filename
+    self._tmp_filename = filename + '.tmp'
+    self._file = h5py.File( self._tmp_filename, 'w' )
+    self._poses = self._file.create_dataset( 'poses', shape=(0, ndims), maxshape=(None, ndims),
+      chunks=(chunk_frames, ndims), compression=compression, dtype=dtype )
+    self._file.attrs['chunk_frames'] = chunk_frames
+    self._file.attrs['action_names'] = json.dumps( list(action_names) )
+    self._file.attrs['euler'] = bool( euler )
+    self._file.attrs['subjects'] = json.dumps( [int(subj) for subj in subjects] )
+
+    self.action_names = list( action_names )
+    self.stats = data_utils.NormalizationAccumulator()
+    self._offsets = [0]
+    self._keys = []
+
+  def append(self, subject, action, subaction, sequence, stats_frames=None):
+    """
+    Add a sequence at the end of the store.
+
+    Args
+      subject: subject number
+      action: string with the action of the sequence
+      subaction: subaction number
+      sequence: nxd matrix with the poses to store
+      stats_frames: frames the normalization stats are computed on. Defaults
+        to the stored sequence
+    """
+    n = sequence.shape[0]
+    end = self._offsets[-1] + n
+    self._poses.resize( end, axis=0 )
+    self._poses[ self._offsets[-1]:end ] = sequence
+
+    self._offsets.append( end )
+    self._keys.append( (subject, self.action_names.index(action), subaction) )
+    self.stats.update( sequence if stats_frames is None else stats_frames )
+
+  def close(self):
+    """Write the offsets, keys and stats, and move the store into place."""
+    keys = np.array( self._keys, dtype=np.int64 ).reshape( -1, 3 )
+    self._file.create_dataset( 'offsets', data=np.array(self._offsets, dtype=np.int64) )
+    self._file.create_dataset( 'keys', data=keys )
+
+    self._file.attrs['count'] = self.stats.count
+    self._file.attrs['mean']  = self.stats.mean
+    self._file.attrs['m2']    = self.stats.m2
+    self._file.attrs['stats_dtype'] = np.dtype( self.stats.dtype ).str
+    self._file.close()
+    os.rename( self._tmp_filename, self.filename )
+
+
+def convert_to_store(path_to_dataset, subjects, actions, euler, filename,
+                     chunk_frames=1024, compression=None, num_workers=0):
+  """
+  Stream the txt files of a collection into a store. Like load_data, the
+  even frames are stored and the stats are computed on all the frames.
+
+  Args
+    path_to_dataset: string. directory where the data resides
+    subjects: list of numbers. The subjects to convert
+    actions: list of string. The actions to convert
+    euler: whether to convert the angles to Euler angles
+    filename: path of the store to create
+    chunk_frames: number of frames in a chunk of the store
+    compression: None, "gzip" or "lzf"
+    num_workers: number of processes parsing the txt files
+  """
+  writer = None
+  for (subj, action_idx, subact), action_sequence in data_utils.read_sequences(
+      path_to_dataset, subjects, actions, euler, num_workers ):
+    if writer is None:
+      writer = MotionStoreWriter( filename, action_sequence.shape[1], actions, chunk_frames, compression,
+        euler=euler, subjects=subjects )
+    writer.append( subj, actions[action_idx], subact, action_sequence[0::2, :], stats_frames=action_sequence )
+  writer.close()
+
+
+def store_mismatch(filename, subjects, actions, euler):
+  """
+  How a store differs from the collection it is asked to hold.
+
+  Args
+    filename: path of a store written by MotionStoreWriter
+    subjects: list of numbers with the subjects of the collection
+    actions: list of strings with the actions of the collection
+    euler: whether the collection is in Euler angles
+  Returns
+    reason: string describing the first difference, None if the store matches.
+      Stores written before the angle format and subjects were recorded never match
+  """
+  with h5py.File( filename, 'r' ) as f:
+    attrs = f.attrs
+    if 'euler' not in attrs or 'subjects' not in attrs:
+      return "it does not record its angle format and subjects"
+    if bool( attrs['euler'] ) != bool( euler ):
+      return "it holds {0} angles".format( "Euler" if attrs['euler'] else "exponential map" )
+    if sorted( json.loads(attrs['subjects']) ) != sorted( int(subj) for subj in subjects ):
+      return "it holds subjects {0}".format( json.loads(attrs['subjects']) )
+    if sorted( json.loads(attrs['action_names']) ) != sorted( actions ):
+      return "it holds actions {0}".format( json.loads(attrs['action_names']) )
+  return None
+
+
+class MotionStore(data_utils.SequenceArena):
+  """
+  Training windows read from a store file as they are sampled. The sequences
+  are normalized a chunk at a time, and the normalized chunks are kept in an
+  LRU cache, so memory use is bounded by the cache and not by the size of the
+  collection. Sampling and batches follow data_utils.SequenceArena, so the
+  store can be passed to Seq2SeqModel.get_batch in place of an arena.
+  """
+
+  def __init__(self, filename, actions, one_hot, cache_mb=256, margin=16, dtype=np.float32,
+               euler=None, subjects=None):
+    """
+    Args
+      filename: path of a store written by MotionStoreWriter
+      actions: list of strings with the actions of the one-hot encoding
+      one_hot: whether to append the one-hot encoding of the action to the poses
+      cache_mb: size of the cache of normalized chunks, in megabytes
+      margin: number of frames skipped at the beginning of every sequence
+        when sampling windows
+      dtype: type of the normalized poses
+      euler: when given, whether the store must hold Euler angles. The
+        subjects and actions of the store are then checked too
+      subjects: list of numbers with the subjects the store must hold, with euler
+    Raises
+      ValueError if the store holds actions that are not in actions, or does
+      not match euler, subjects and actions when euler is given
+    """
+    if euler is not None:
+      reason = store_mismatch( filename, subjects, actions, euler )
+      if reason is not None:
+        raise ValueError("The store {0} does not match the training set: {1}".format(filename, reason))
+
+    self._file = h5py.File( filename, 'r' )
+    self._poses = self._file['poses']
+    attrs = self._file.attrs
+
+    action_names = json.loads( attrs['action_names'] )
+    unknown = [name for name in action_names if name not in actions]
+    if unknown:
+      raise ValueError("The store holds actions that are not trained on: {0}".format(unknown))
+
+    keys = self._file['keys'][:]
+    self.action_ids = np.array( [actions.index(action_names[k]) for k in keys[:, 1]], dtype=np.int64 )
+    self.sequence_keys = [(subj, action_names[action], subact, 'even') for subj, action, subact in keys]
+    self.margin = margin
+    self.offsets = self._file['offsets'][:]
+    self.lengths = np.diff( self.offsets )
+    self.data = None
+    self.velocity = None
+    self._positions = dict( (key, i) for i, key in enumerate(self.sequence_keys) )
+    self._window_starts = {}
+
+    # Stats of the whole collection, as normalization_stats gives them
+    completeData = data_utils.NormalizationAccumulator()
+    completeData.count = int( attrs['count'] )
+    completeData.mean  = attrs['mean']
+    completeData.m2    = attrs['m2']
+    completeData.dtype = np.dtype( attrs['stats_dtype'] )
+    self.stats = data_utils.normalization_stats( completeData )
+    data_mean, data_std, _, dim_to_use = self.stats
+
+    self.dtype = dtype
+    self.actions = list( actions ) if one_hot else None
+    self.nactions = len( actions ) if one_hot else 0
+    self._dim_to_use = np.asarray( dim_to_use )
+    self._mean_to_use = data_mean[ self._dim_to_use ].astype( dtype )
+    self._std_to_use  = data_std[ self._dim_to_use ].astype( dtype )
+
+    self.chunk_frames = int( attrs['chunk_frames'] )
+    chunk_bytes = self.chunk_frames * len( self._dim_to_use ) * np.dtype( dtype ).itemsize
+    self.cache_chunks = max( 1, int(cache_mb * 2**20 // chunk_bytes) )
+    self._cache = collections.OrderedDict()
+    self.reads = 0
+
+  def close(self):
+    self._file.close()
+
+  def _normalize(self, frames):
+    frames = frames[:, self._dim_to_use].astype( self.dtype, copy=False )
+    frames -= self._mean_to_use
+    frames /= self._std_to_use
+    return frames
+
+  def _chunks(self, chunk_ids):
+    """
+    Normalized chunks of the poses, from the cache or read from the file.
+    Runs of consecutive missing chunks are read together.
+
+    Args
+      chunk_ids: sorted vector with the indices of distinct chunks
+    Returns
+      chunks: dictionary with k:v, k=chunk index, v=normalized chunk
+    """
+    chunks = {}
+    missing = []
+    for c in chunk_ids:
+      # Remove and add back to move the chunk to the recent end
+      chunk = self._cache.pop( c, None )
+      if chunk is None:
+        missing.append( c )
+      else:
+        chunks[ c ] = self._cache[ c ] = chunk
+
+    if missing:
+      runs = np.split( missing, np.where(np.diff(missing) != 1)[0] + 1 )
+      for run in runs:
+        first = run[0] * self.chunk_frames
+        frames = self._normalize( self._poses[ first:(run[-1] + 1) * self.chunk_frames ] )
+        self.reads += 1
+        for c in run:
+          begin = c * self.chunk_frames - first
+          chunks[ c ] = self._cache[ c ] = frames[ begin:begin + self.chunk_frames ].copy()
+
+    while len( self._cache ) > self.cache_chunks:
+      self._cache.popitem( last=False )
+    return chunks
+
+  def __getitem__(self, key):
+    """The normalized sequence stored under key, read from the file"""
+    i = self._positions[ key ]
+    return self._normalize( self._poses[ self.offsets[i]:self.offsets[i+1] ] )
+
+  def sample_starts(self, batch_size, total_frames, uniform_frames=False, rng=np.random):
+    """
+    Same as SequenceArena.sample_starts. Uniform draws go through the number
+    of windows of every sequence instead of an index of all the windows.
+    """
+    if not uniform_frames:
+      return super(MotionStore, self).sample_starts( batch_size, total_frames, False, rng )
+
+    counts = np.maximum( self.lengths - total_frames - self.margin, 0 )
+    cumulative = np.cumsum( counts )
+    draws = rng.randint( 0, cumulative[-1], batch_size )
+    sequence_idx = np.searchsorted( cumulative, draws, side='right' )
+    within = draws - (cumulative[ sequence_idx ] - counts[ sequence_idx ])
+    return self.offsets[ sequence_idx ] + self.margin + within
+
+  def gather(self, starts, total_frames):
+    """
+    Args
+      starts: vector with window starts in the store
+      total_frames: number of frames in a window
+    Returns
+      windows: len(starts) x total_frames x d array with the normalized windows
+    """
+    ndims = len( self._dim_to_use )
+    windows = np.zeros( (len(starts), total_frames, ndims + self.nactions), dtype=self.dtype )
+
+    first_chunks = starts // self.chunk_frames
+    last_chunks  = (starts + total_frames - 1) // self.chunk_frames
+    chunk_ids = np.unique( np.concatenate(
+      [np.arange(first, last + 1) for first, last in zip(first_chunks, last_chunks)] ) )
+    chunks = self._chunks( chunk_ids )
+
+    for i, start in enumerate( starts ):
+      t = 0
+      while t < total_frames:
+        c, row = divmod( start + t, self.chunk_frames )
+        n = min( total_frames - t, self.chunk_frames - row )
+        windows[ i, t:t+n, :ndims ] = chunks[ c ][ row:row+n ]
+        t += n
+
+    if self.nactions:
+      self.set_one_hot( windows, starts )
+    return windows
+
+  def batch(self, starts, source_seq_len, target_seq_len, out=None, first_dim=0):
+    """
+    Same as SequenceArena.batch, with the velocities computed on the read windows.
+    """
+    windows = self.gather( starts, source_seq_len + target_seq_len )
+    return data_utils.window_batch( windows[:, :, first_dim:], source_seq_len, target_seq_len, out )
@@ -16,7 +16,7 @@ from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 import data_utils
 import copy
-from dcgru import DCGRUCell
+from dcgru import DCGRUCell, DiffusionSupports, HoistedInputCell
 
 class Seq2SeqModel(object):
   """Sequence-to-sequence model for human motion prediction"""
@@ -36,7 +36,13 @@ class Seq2SeqModel(object):
                filter_type,
                one_hot=True,
                eval_pose=False,
-               dtype=tf.float32):
+               dtype=tf.float32,
+               data_dtype=np.float64,
+               input_batch=None,
+               stacked_diffusion=False,
+               hoist_inputs=False,
+               fused_cell=False,
+               adjacency_mask=None):
     """Create the model.
 
     Args:
@@ -55,9 +61,30 @@ class Seq2SeqModel(object):
       one_hot: whether to use one_hot encoding during train/test (sup models).
       eval_pose: whether to evaluate on poses.
       dtype: the data type to use to store internal variables.
+      data_dtype: numpy type of the batches built by get_batch and get_batch_srnn.
+      input_batch: optional (encoder_inputs, decoder_inputs, decoder_outputs, poses)
+        tensors of an input pipeline. load_batch copies a batch of them into the
+        model, and the inputs are only fed when step is given arrays.
+      stacked_diffusion: whether the cells apply the diffusion polynomials of the
+        graph precomputed and stacked, with one matmul per graph convolution.
+      hoist_inputs: whether the encoders and the supervised discriminator passes
+        diffuse their whole known input sequence before the recurrence, and only
+        the state at every step. Needs num_layers == 1.
+      fused_cell: whether the cells diffuse the inputs of a step once for both the
+        gates and the candidate.
+      adjacency_mask: optional boolean input_size x input_size numpy array. Only
+        the entries of the learned adjacency in the mask are edges, and the
+        diffusion uses sparse supports.
+    Raises
+      ValueError if hoist_inputs is asked with more than one layer
     """
+    if hoist_inputs and num_layers != 1:
+      # The inputs of the upper layer of a MultiRNNCell come out of the recurrence
+      raise ValueError("hoist_inputs needs a single layer model, got {0} layers".format(num_layers))
+
     self.input_size_target = 54 + number_of_actions if one_hot else 54
     self.input_size = 48 + number_of_actions if one_hot else 48
+    self.one_hot = one_hot
 
     print( "One hot is ", one_hot )
     print( "Input size is %d" % self.input_size )
@@ -68,18 +95,38 @@ class Seq2SeqModel(object):
 
     self.source_seq_len = source_seq_len
     self.target_seq_len = target_seq_len
+    self.hoist_inputs = hoist_inputs
     self.rnn_size = rnn_size
     self.batch_size = batch_size
+    self.data_dtype = data_dtype
+    self._batch_buffers = None
     self.learning_rate = tf.Variable( float(learning_rate), trainable=False, dtype=dtype )
     self.learning_rate_decay_op = self.learning_rate.assign( self.learning_rate * learning_rate_decay_factor )
     self.global_step = tf.Variable(0, trainable=False)
 
     # === Transform the inputs ===
     with tf.name_scope("inputs"):
-      act_pre_fw = tf.placeholder(dtype, shape=[None, source_seq_len-2, self.input_size], name="act_pre_fw")
-      act_post_in_fw = tf.placeholder(dtype, shape=[None, target_seq_len, self.input_size], name="act_post_in_fw")
-      act_post_out_fw = tf.placeholder(dtype, shape=[None, target_seq_len, self.input_size], name="act_post_out_fw")
-      act_pose_fw = tf.placeholder(dtype, shape=[None, source_seq_len + target_seq_len, self.input_size], name="act_pose_fw")
+      input_shapes = [[None, source_seq_len-2, self.input_size],
+                      [None, target_seq_len, self.input_size],
+                      [None, target_seq_len, self.input_size],
+                      [None, source_seq_len + target_seq_len, self.input_size]]
+      input_names = ["act_pre_fw", "act_post_in_fw", "act_post_out_fw", "act_pose_fw"]
+
+      self.load_batch_op = None
+      if input_batch is None:
+        inputs = [tf.placeholder(dtype, shape=shape, name=name) for shape, name in zip(input_shapes, input_names)]
+      else:
+        # The batch of the pipeline is cached in local variables, so the several
+        # session.run calls of a training step all see the same batch. Feeding
+        # the inputs (sampling, validation) overrides the cache.
+        cached = [tf.Variable(tf.zeros([batch_size] + shape[1:], dtype=dtype), trainable=False,
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name + "_cache")
+                  for shape, name in zip(input_shapes, input_names)]
+        self.load_batch_op = tf.group(*[var.assign(tf.cast(tensor, dtype)) for var, tensor in zip(cached, input_batch)])
+        inputs = [tf.placeholder_with_default(var.value(), shape=shape, name=name)
+                  for var, shape, name in zip(cached, input_shapes, input_names)]
+
+      act_pre_fw, act_post_in_fw, act_post_out_fw, act_pose_fw = inputs
       outputs_fake_fw_fix = tf.placeholder(dtype, shape=[None, target_seq_len, self.input_size], name="outputs_fake_regroup")
 
       self.action_prefix_fw = act_pre_fw
@@ -132,16 +179,24 @@ class Seq2SeqModel(object):
     print('rnn_size = {0}'.format(rnn_size))
     adj_mx = tf.get_variable('train_g_fw', shape=(self.input_size, self.input_size),
                              initializer=tf.random_uniform_initializer(minval=0, maxval=1))
+    self.adj_mx = adj_mx
+    self.adjacency_mask = adjacency_mask
+    # Normalized once, and read by every cell at every step
+    supports = DiffusionSupports(adj_mx, filter_type, dtype, mask=adjacency_mask)
     cell_fw = DCGRUCell(self.rnn_size, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=self.input_size,
-                        filter_type=filter_type, num_proj=1)
+                        filter_type=filter_type, num_proj=1, supports=supports, stacked_polynomials=stacked_diffusion,
+                        fused=fused_cell)
     cell_bw = DCGRUCell(self.rnn_size, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=self.input_size,
-                        filter_type=filter_type, num_proj=1)
+                        filter_type=filter_type, num_proj=1, supports=supports, stacked_polynomials=stacked_diffusion,
+                        fused=fused_cell)
 
     if num_layers == 2:
       cell_fw_no_projection = DCGRUCell(self.rnn_size, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=self.input_size,
-                                        filter_type=filter_type)
+                                        filter_type=filter_type, supports=supports, stacked_polynomials=stacked_diffusion,
+                                        fused=fused_cell)
       cell_bw_no_projection = DCGRUCell(self.rnn_size, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=self.input_size,
-                                        filter_type=filter_type)
+                                        filter_type=filter_type, supports=supports, stacked_polynomials=stacked_diffusion,
+                                        fused=fused_cell)
       cell_fw = tf.contrib.rnn.MultiRNNCell([cell_fw_no_projection] + [cell_fw] )
       cell_bw = tf.contrib.rnn.MultiRNNCell([cell_bw_no_projection] + [cell_bw])
 
@@ -243,228 +298,23 @@ class Seq2SeqModel(object):
     # Keep track of the learning rate
     self.learning_rate_summary = tf.summary.scalar('learning_rate/learning_rate', self.learning_rate)
 
-    # === variables for loss in Euler Angles -- for each action
-    with tf.name_scope( "euler_error_walking" ):
-      self.walking_err80   = tf.placeholder( tf.float32, name="walking_srnn_seeds_0080" )
-      self.walking_err160  = tf.placeholder( tf.float32, name="walking_srnn_seeds_0160" )
-      self.walking_err320  = tf.placeholder( tf.float32, name="walking_srnn_seeds_0320" )
-      self.walking_err400  = tf.placeholder( tf.float32, name="walking_srnn_seeds_0400" )
-      self.walking_err560  = tf.placeholder( tf.float32, name="walking_srnn_seeds_0560" )
-      self.walking_err1000 = tf.placeholder( tf.float32, name="walking_srnn_seeds_1000" )
-
-      self.walking_err80_summary   = tf.summary.scalar( 'euler_error_walking/srnn_seeds_0080', self.walking_err80 )
-      self.walking_err160_summary  = tf.summary.scalar( 'euler_error_walking/srnn_seeds_0160', self.walking_err160 )
-      self.walking_err320_summary  = tf.summary.scalar( 'euler_error_walking/srnn_seeds_0320', self.walking_err320 )
-      self.walking_err400_summary  = tf.summary.scalar( 'euler_error_walking/srnn_seeds_0400', self.walking_err400 )
-      self.walking_err560_summary  = tf.summary.scalar( 'euler_error_walking/srnn_seeds_0560', self.walking_err560 )
-      self.walking_err1000_summary = tf.summary.scalar( 'euler_error_walking/srnn_seeds_1000', self.walking_err1000 )
-    with tf.name_scope( "euler_error_eating" ):
-      self.eating_err80   = tf.placeholder( tf.float32, name="eating_srnn_seeds_0080" )
-      self.eating_err160  = tf.placeholder( tf.float32, name="eating_srnn_seeds_0160" )
-      self.eating_err320  = tf.placeholder( tf.float32, name="eating_srnn_seeds_0320" )
-      self.eating_err400  = tf.placeholder( tf.float32, name="eating_srnn_seeds_0400" )
-      self.eating_err560  = tf.placeholder( tf.float32, name="eating_srnn_seeds_0560" )
-      self.eating_err1000 = tf.placeholder( tf.float32, name="eating_srnn_seeds_1000" )
-
-      self.eating_err80_summary   = tf.summary.scalar( 'euler_error_eating/srnn_seeds_0080', self.eating_err80 )
-      self.eating_err160_summary  = tf.summary.scalar( 'euler_error_eating/srnn_seeds_0160', self.eating_err160 )
-      self.eating_err320_summary  = tf.summary.scalar( 'euler_error_eating/srnn_seeds_0320', self.eating_err320 )
-      self.eating_err400_summary  = tf.summary.scalar( 'euler_error_eating/srnn_seeds_0400', self.eating_err400 )
-      self.eating_err560_summary  = tf.summary.scalar( 'euler_error_eating/srnn_seeds_0560', self.eating_err560 )
-      self.eating_err1000_summary = tf.summary.scalar( 'euler_error_eating/srnn_seeds_1000', self.eating_err1000 )
-    with tf.name_scope( "euler_error_smoking" ):
-      self.smoking_err80   = tf.placeholder( tf.float32, name="smoking_srnn_seeds_0080" )
-      self.smoking_err160  = tf.placeholder( tf.float32, name="smoking_srnn_seeds_0160" )
-      self.smoking_err320  = tf.placeholder( tf.float32, name="smoking_srnn_seeds_0320" )
-      self.smoking_err400  = tf.placeholder( tf.float32, name="smoking_srnn_seeds_0400" )
-      self.smoking_err560  = tf.placeholder( tf.float32, name="smoking_srnn_seeds_0560" )
-      self.smoking_err1000 = tf.placeholder( tf.float32, name="smoking_srnn_seeds_1000" )
-
-      self.smoking_err80_summary   = tf.summary.scalar( 'euler_error_smoking/srnn_seeds_0080', self.smoking_err80 )
-      self.smoking_err160_summary  = tf.summary.scalar( 'euler_error_smoking/srnn_seeds_0160', self.smoking_err160 )
-      self.smoking_err320_summary  = tf.summary.scalar( 'euler_error_smoking/srnn_seeds_0320', self.smoking_err320 )
-      self.smoking_err400_summary  = tf.summary.scalar( 'euler_error_smoking/srnn_seeds_0400', self.smoking_err400 )
-      self.smoking_err560_summary  = tf.summary.scalar( 'euler_error_smoking/srnn_seeds_0560', self.smoking_err560 )
-      self.smoking_err1000_summary = tf.summary.scalar( 'euler_error_smoking/srnn_seeds_1000', self.smoking_err1000 )
-    with tf.name_scope( "euler_error_discussion" ):
-      self.discussion_err80   = tf.placeholder( tf.float32, name="discussion_srnn_seeds_0080" )
-      self.discussion_err160  = tf.placeholder( tf.float32, name="discussion_srnn_seeds_0160" )
-      self.discussion_err320  = tf.placeholder( tf.float32, name="discussion_srnn_seeds_0320" )
-      self.discussion_err400  = tf.placeholder( tf.float32, name="discussion_srnn_seeds_0400" )
-      self.discussion_err560  = tf.placeholder( tf.float32, name="discussion_srnn_seeds_0560" )
-      self.discussion_err1000 = tf.placeholder( tf.float32, name="discussion_srnn_seeds_1000" )
-
-      self.discussion_err80_summary   = tf.summary.scalar( 'euler_error_discussion/srnn_seeds_0080', self.discussion_err80 )
-      self.discussion_err160_summary  = tf.summary.scalar( 'euler_error_discussion/srnn_seeds_0160', self.discussion_err160 )
-      self.discussion_err320_summary  = tf.summary.scalar( 'euler_error_discussion/srnn_seeds_0320', self.discussion_err320 )
-      self.discussion_err400_summary  = tf.summary.scalar( 'euler_error_discussion/srnn_seeds_0400', self.discussion_err400 )
-      self.discussion_err560_summary  = tf.summary.scalar( 'euler_error_discussion/srnn_seeds_0560', self.discussion_err560 )
-      self.discussion_err1000_summary = tf.summary.scalar( 'euler_error_discussion/srnn_seeds_1000', self.discussion_err1000 )
-    with tf.name_scope( "euler_error_directions" ):
-      self.directions_err80   = tf.placeholder( tf.float32, name="directions_srnn_seeds_0080" )
-      self.directions_err160  = tf.placeholder( tf.float32, name="directions_srnn_seeds_0160" )
-      self.directions_err320  = tf.placeholder( tf.float32, name="directions_srnn_seeds_0320" )
-      self.directions_err400  = tf.placeholder( tf.float32, name="directions_srnn_seeds_0400" )
-      self.directions_err560  = tf.placeholder( tf.float32, name="directions_srnn_seeds_0560" )
-      self.directions_err1000 = tf.placeholder( tf.float32, name="directions_srnn_seeds_1000" )
-
-      self.directions_err80_summary   = tf.summary.scalar( 'euler_error_directions/srnn_seeds_0080', self.directions_err80 )
-      self.directions_err160_summary  = tf.summary.scalar( 'euler_error_directions/srnn_seeds_0160', self.directions_err160 )
-      self.directions_err320_summary  = tf.summary.scalar( 'euler_error_directions/srnn_seeds_0320', self.directions_err320 )
-      self.directions_err400_summary  = tf.summary.scalar( 'euler_error_directions/srnn_seeds_0400', self.directions_err400 )
-      self.directions_err560_summary  = tf.summary.scalar( 'euler_error_directions/srnn_seeds_0560', self.directions_err560 )
-      self.directions_err1000_summary = tf.summary.scalar( 'euler_error_directions/srnn_seeds_1000', self.directions_err1000 )
-    with tf.name_scope( "euler_error_greeting" ):
-      self.greeting_err80   = tf.placeholder( tf.float32, name="greeting_srnn_seeds_0080" )
-      self.greeting_err160  = tf.placeholder( tf.float32, name="greeting_srnn_seeds_0160" )
-      self.greeting_err320  = tf.placeholder( tf.float32, name="greeting_srnn_seeds_0320" )
-      self.greeting_err400  = tf.placeholder( tf.float32, name="greeting_srnn_seeds_0400" )
-      self.greeting_err560  = tf.placeholder( tf.float32, name="greeting_srnn_seeds_0560" )
-      self.greeting_err1000 = tf.placeholder( tf.float32, name="greeting_srnn_seeds_1000" )
-
-      self.greeting_err80_summary   = tf.summary.scalar( 'euler_error_greeting/srnn_seeds_0080', self.greeting_err80 )
-      self.greeting_err160_summary  = tf.summary.scalar( 'euler_error_greeting/srnn_seeds_0160', self.greeting_err160 )
-      self.greeting_err320_summary  = tf.summary.scalar( 'euler_error_greeting/srnn_seeds_0320', self.greeting_err320 )
-      self.greeting_err400_summary  = tf.summary.scalar( 'euler_error_greeting/srnn_seeds_0400', self.greeting_err400 )
-      self.greeting_err560_summary  = tf.summary.scalar( 'euler_error_greeting/srnn_seeds_0560', self.greeting_err560 )
-      self.greeting_err1000_summary = tf.summary.scalar( 'euler_error_greeting/srnn_seeds_1000', self.greeting_err1000 )
-    with tf.name_scope( "euler_error_phoning" ):
-      self.phoning_err80   = tf.placeholder( tf.float32, name="phoning_srnn_seeds_0080" )
-      self.phoning_err160  = tf.placeholder( tf.float32, name="phoning_srnn_seeds_0160" )
-      self.phoning_err320  = tf.placeholder( tf.float32, name="phoning_srnn_seeds_0320" )
-      self.phoning_err400  = tf.placeholder( tf.float32, name="phoning_srnn_seeds_0400" )
-      self.phoning_err560  = tf.placeholder( tf.float32, name="phoning_srnn_seeds_0560" )
-      self.phoning_err1000 = tf.placeholder( tf.float32, name="phoning_srnn_seeds_1000" )
-
-      self.phoning_err80_summary   = tf.summary.scalar( 'euler_error_phoning/srnn_seeds_0080', self.phoning_err80 )
-      self.phoning_err160_summary  = tf.summary.scalar( 'euler_error_phoning/srnn_seeds_0160', self.phoning_err160 )
-      self.phoning_err320_summary  = tf.summary.scalar( 'euler_error_phoning/srnn_seeds_0320', self.phoning_err320 )
-      self.phoning_err400_summary  = tf.summary.scalar( 'euler_error_phoning/srnn_seeds_0400', self.phoning_err400 )
-      self.phoning_err560_summary  = tf.summary.scalar( 'euler_error_phoning/srnn_seeds_0560', self.phoning_err560 )
-      self.phoning_err1000_summary = tf.summary.scalar( 'euler_error_phoning/srnn_seeds_1000', self.phoning_err1000 )
-    with tf.name_scope( "euler_error_posing" ):
-      self.posing_err80   = tf.placeholder( tf.float32, name="posing_srnn_seeds_0080" )
-      self.posing_err160  = tf.placeholder( tf.float32, name="posing_srnn_seeds_0160" )
-      self.posing_err320  = tf.placeholder( tf.float32, name="posing_srnn_seeds_0320" )
-      self.posing_err400  = tf.placeholder( tf.float32, name="posing_srnn_seeds_0400" )
-      self.posing_err560  = tf.placeholder( tf.float32, name="posing_srnn_seeds_0560" )
-      self.posing_err1000 = tf.placeholder( tf.float32, name="posing_srnn_seeds_1000" )
-
-      self.posing_err80_summary   = tf.summary.scalar( 'euler_error_posing/srnn_seeds_0080', self.posing_err80 )
-      self.posing_err160_summary  = tf.summary.scalar( 'euler_error_posing/srnn_seeds_0160', self.posing_err160 )
-      self.posing_err320_summary  = tf.summary.scalar( 'euler_error_posing/srnn_seeds_0320', self.posing_err320 )
-      self.posing_err400_summary  = tf.summary.scalar( 'euler_error_posing/srnn_seeds_0400', self.posing_err400 )
-      self.posing_err560_summary  = tf.summary.scalar( 'euler_error_posing/srnn_seeds_0560', self.posing_err560 )
-      self.posing_err1000_summary = tf.summary.scalar( 'euler_error_posing/srnn_seeds_1000', self.posing_err1000 )
-    with tf.name_scope( "euler_error_purchases" ):
-      self.purchases_err80   = tf.placeholder( tf.float32, name="purchases_srnn_seeds_0080" )
-      self.purchases_err160  = tf.placeholder( tf.float32, name="purchases_srnn_seeds_0160" )
-      self.purchases_err320  = tf.placeholder( tf.float32, name="purchases_srnn_seeds_0320" )
-      self.purchases_err400  = tf.placeholder( tf.float32, name="purchases_srnn_seeds_0400" )
-      self.purchases_err560  = tf.placeholder( tf.float32, name="purchases_srnn_seeds_0560" )
-      self.purchases_err1000 = tf.placeholder( tf.float32, name="purchases_srnn_seeds_1000" )
-
-      self.purchases_err80_summary   = tf.summary.scalar( 'euler_error_purchases/srnn_seeds_0080', self.purchases_err80 )
-      self.purchases_err160_summary  = tf.summary.scalar( 'euler_error_purchases/srnn_seeds_0160', self.purchases_err160 )
-      self.purchases_err320_summary  = tf.summary.scalar( 'euler_error_purchases/srnn_seeds_0320', self.purchases_err320 )
-      self.purchases_err400_summary  = tf.summary.scalar( 'euler_error_purchases/srnn_seeds_0400', self.purchases_err400 )
-      self.purchases_err560_summary  = tf.summary.scalar( 'euler_error_purchases/srnn_seeds_0560', self.purchases_err560 )
-      self.purchases_err1000_summary = tf.summary.scalar( 'euler_error_purchases/srnn_seeds_1000', self.purchases_err1000 )
-    with tf.name_scope( "euler_error_sitting" ):
-      self.sitting_err80   = tf.placeholder( tf.float32, name="sitting_srnn_seeds_0080" )
-      self.sitting_err160  = tf.placeholder( tf.float32, name="sitting_srnn_seeds_0160" )
-      self.sitting_err320  = tf.placeholder( tf.float32, name="sitting_srnn_seeds_0320" )
-      self.sitting_err400  = tf.placeholder( tf.float32, name="sitting_srnn_seeds_0400" )
-      self.sitting_err560  = tf.placeholder( tf.float32, name="sitting_srnn_seeds_0560" )
-      self.sitting_err1000 = tf.placeholder( tf.float32, name="sitting_srnn_seeds_1000" )
-
-      self.sitting_err80_summary   = tf.summary.scalar( 'euler_error_sitting/srnn_seeds_0080', self.sitting_err80 )
-      self.sitting_err160_summary  = tf.summary.scalar( 'euler_error_sitting/srnn_seeds_0160', self.sitting_err160 )
-      self.sitting_err320_summary  = tf.summary.scalar( 'euler_error_sitting/srnn_seeds_0320', self.sitting_err320 )
-      self.sitting_err400_summary  = tf.summary.scalar( 'euler_error_sitting/srnn_seeds_0400', self.sitting_err400 )
-      self.sitting_err560_summary  = tf.summary.scalar( 'euler_error_sitting/srnn_seeds_0560', self.sitting_err560 )
-      self.sitting_err1000_summary = tf.summary.scalar( 'euler_error_sitting/srnn_seeds_1000', self.sitting_err1000 )
-    with tf.name_scope( "euler_error_sittingdown" ):
-      self.sittingdown_err80   = tf.placeholder( tf.float32, name="sittingdown_srnn_seeds_0080" )
-      self.sittingdown_err160  = tf.placeholder( tf.float32, name="sittingdown_srnn_seeds_0160" )
-      self.sittingdown_err320  = tf.placeholder( tf.float32, name="sittingdown_srnn_seeds_0320" )
-      self.sittingdown_err400  = tf.placeholder( tf.float32, name="sittingdown_srnn_seeds_0400" )
-      self.sittingdown_err560  = tf.placeholder( tf.float32, name="sittingdown_srnn_seeds_0560" )
-      self.sittingdown_err1000 = tf.placeholder( tf.float32, name="sittingdown_srnn_seeds_1000" )
-
-      self.sittingdown_err80_summary   = tf.summary.scalar( 'euler_error_sittingdown/srnn_seeds_0080', self.sittingdown_err80 )
-      self.sittingdown_err160_summary  = tf.summary.scalar( 'euler_error_sittingdown/srnn_seeds_0160', self.sittingdown_err160 )
-      self.sittingdown_err320_summary  = tf.summary.scalar( 'euler_error_sittingdown/srnn_seeds_0320', self.sittingdown_err320 )
-      self.sittingdown_err400_summary  = tf.summary.scalar( 'euler_error_sittingdown/srnn_seeds_0400', self.sittingdown_err400 )
-      self.sittingdown_err560_summary  = tf.summary.scalar( 'euler_error_sittingdown/srnn_seeds_0560', self.sittingdown_err560 )
-      self.sittingdown_err1000_summary = tf.summary.scalar( 'euler_error_sittingdown/srnn_seeds_1000', self.sittingdown_err1000 )
-    with tf.name_scope( "euler_error_takingphoto" ):
-      self.takingphoto_err80   = tf.placeholder( tf.float32, name="takingphoto_srnn_seeds_0080" )
-      self.takingphoto_err160  = tf.placeholder( tf.float32, name="takingphoto_srnn_seeds_0160" )
-      self.takingphoto_err320  = tf.placeholder( tf.float32, name="takingphoto_srnn_seeds_0320" )
-      self.takingphoto_err400  = tf.placeholder( tf.float32, name="takingphoto_srnn_seeds_0400" )
-      self.takingphoto_err560  = tf.placeholder( tf.float32, name="takingphoto_srnn_seeds_0560" )
-      self.takingphoto_err1000 = tf.placeholder( tf.float32, name="takingphoto_srnn_seeds_1000" )
-
-      self.takingphoto_err80_summary   = tf.summary.scalar( 'euler_error_takingphoto/srnn_seeds_0080', self.takingphoto_err80 )
-      self.takingphoto_err160_summary  = tf.summary.scalar( 'euler_error_takingphoto/srnn_seeds_0160', self.takingphoto_err160 )
-      self.takingphoto_err320_summary  = tf.summary.scalar( 'euler_error_takingphoto/srnn_seeds_0320', self.takingphoto_err320 )
-      self.takingphoto_err400_summary  = tf.summary.scalar( 'euler_error_takingphoto/srnn_seeds_0400', self.takingphoto_err400 )
-      self.takingphoto_err560_summary  = tf.summary.scalar( 'euler_error_takingphoto/srnn_seeds_0560', self.takingphoto_err560 )
-      self.takingphoto_err1000_summary = tf.summary.scalar( 'euler_error_takingphoto/srnn_seeds_1000', self.takingphoto_err1000 )
-    with tf.name_scope( "euler_error_waiting" ):
-      self.waiting_err80   = tf.placeholder( tf.float32, name="waiting_srnn_seeds_0080" )
-      self.waiting_err160  = tf.placeholder( tf.float32, name="waiting_srnn_seeds_0160" )
-      self.waiting_err320  = tf.placeholder( tf.float32, name="waiting_srnn_seeds_0320" )
-      self.waiting_err400  = tf.placeholder( tf.float32, name="waiting_srnn_seeds_0400" )
-      self.waiting_err560  = tf.placeholder( tf.float32, name="waiting_srnn_seeds_0560" )
-      self.waiting_err1000 = tf.placeholder( tf.float32, name="waiting_srnn_seeds_1000" )
-
-      self.waiting_err80_summary   = tf.summary.scalar( 'euler_error_waiting/srnn_seeds_0080', self.waiting_err80 )
-      self.waiting_err160_summary  = tf.summary.scalar( 'euler_error_waiting/srnn_seeds_0160', self.waiting_err160 )
-      self.waiting_err320_summary  = tf.summary.scalar( 'euler_error_waiting/srnn_seeds_0320', self.waiting_err320 )
-      self.waiting_err400_summary  = tf.summary.scalar( 'euler_error_waiting/srnn_seeds_0400', self.waiting_err400 )
-      self.waiting_err560_summary  = tf.summary.scalar( 'euler_error_waiting/srnn_seeds_0560', self.waiting_err560 )
-      self.waiting_err1000_summary = tf.summary.scalar( 'euler_error_waiting/srnn_seeds_1000', self.waiting_err1000 )
-    with tf.name_scope( "euler_error_walkingdog" ):
-      self.walkingdog_err80   = tf.placeholder( tf.float32, name="walkingdog_srnn_seeds_0080" )
-      self.walkingdog_err160  = tf.placeholder( tf.float32, name="walkingdog_srnn_seeds_0160" )
-      self.walkingdog_err320  = tf.placeholder( tf.float32, name="walkingdog_srnn_seeds_0320" )
-      self.walkingdog_err400  = tf.placeholder( tf.float32, name="walkingdog_srnn_seeds_0400" )
-      self.walkingdog_err560  = tf.placeholder( tf.float32, name="walkingdog_srnn_seeds_0560" )
-      self.walkingdog_err1000 = tf.placeholder( tf.float32, name="walkingdog_srnn_seeds_1000" )
-
-      self.walkingdog_err80_summary   = tf.summary.scalar( 'euler_error_walkingdog/srnn_seeds_0080', self.walkingdog_err80 )
-      self.walkingdog_err160_summary  = tf.summary.scalar( 'euler_error_walkingdog/srnn_seeds_0160', self.walkingdog_err160 )
-      self.walkingdog_err320_summary  = tf.summary.scalar( 'euler_error_walkingdog/srnn_seeds_0320', self.walkingdog_err320 )
-      self.walkingdog_err400_summary  = tf.summary.scalar( 'euler_error_walkingdog/srnn_seeds_0400', self.walkingdog_err400 )
-      self.walkingdog_err560_summary  = tf.summary.scalar( 'euler_error_walkingdog/srnn_seeds_0560', self.walkingdog_err560 )
-      self.walkingdog_err1000_summary = tf.summary.scalar( 'euler_error_walkingdog/srnn_seeds_1000', self.walkingdog_err1000 )
-    with tf.name_scope( "euler_error_walkingtogether" ):
-      self.walkingtogether_err80   = tf.placeholder( tf.float32, name="walkingtogether_srnn_seeds_0080" )
-      self.walkingtogether_err160  = tf.placeholder( tf.float32, name="walkingtogether_srnn_seeds_0160" )
-      self.walkingtogether_err320  = tf.placeholder( tf.float32, name="walkingtogether_srnn_seeds_0320" )
-      self.walkingtogether_err400  = tf.placeholder( tf.float32, name="walkingtogether_srnn_seeds_0400" )
-      self.walkingtogether_err560  = tf.placeholder( tf.float32, name="walkingtogether_srnn_seeds_0560" )
-      self.walkingtogether_err1000 = tf.placeholder( tf.float32, name="walkingtogether_srnn_seeds_1000" )
-
-      self.walkingtogether_err80_summary   = tf.summary.scalar( 'euler_error_walkingtogether/srnn_seeds_0080', self.walkingtogether_err80 )
-      self.walkingtogether_err160_summary  = tf.summary.scalar( 'euler_error_walkingtogether/srnn_seeds_0160', self.walkingtogether_err160 )
-      self.walkingtogether_err320_summary  = tf.summary.scalar( 'euler_error_walkingtogether/srnn_seeds_0320', self.walkingtogether_err320 )
-      self.walkingtogether_err400_summary  = tf.summary.scalar( 'euler_error_walkingtogether/srnn_seeds_0400', self.walkingtogether_err400 )
-      self.walkingtogether_err560_summary  = tf.summary.scalar( 'euler_error_walkingtogether/srnn_seeds_0560', self.walkingtogether_err560 )
-      self.walkingtogether_err1000_summary = tf.summary.scalar( 'euler_error_walkingtogether/srnn_seeds_1000', self.walkingtogether_err1000 )
-
     self.saver = tf.train.Saver( tf.global_variables(), max_to_keep=10 )
 
 
+  def load_batch(self, session):
+    """Copy the next batch of the input pipeline into the model inputs."""
+    if self.load_batch_op is None:
+      raise ValueError("The model was not built with an input pipeline")
+    session.run(self.load_batch_op)
+
   def step(self, session, action_prefix_fw, action_postfix_input_fw, action_postfix_output_fw, action_pose_fw,
              forward_only, srnn_seeds=False ):  # train or evaluate
     """Run a step of the model feeding the given inputs.
 
     Args
       session: tensorflow session to use.
-      encoder_inputs: list of numpy vectors to feed as encoder inputs.
+      encoder_inputs: list of numpy vectors to feed as encoder inputs, or None to
+        use the batch copied from the input pipeline by load_batch.
       decoder_inputs: list of numpy vectors to feed as decoder inputs.
       decoder_outputs: list of numpy vectors that are the expected decoder outputs.
       forward_only: whether to do the backward step or only forward.
@@ -476,10 +326,18 @@ class Seq2SeqModel(object):
       ValueError: if length of encoder_inputs, decoder_inputs, or
         target_weights disagrees with bucket size for the specified bucket_id.
     """
-    input_feed = {self.action_prefix_fw: action_prefix_fw,
-                  self.action_postfix_input_fw: action_postfix_input_fw,
-                  self.action_postfix_output_fw: action_postfix_output_fw,
-                  self.action_pose_fw: action_pose_fw}
+    if action_prefix_fw is None:
+      # Use the batch copied from the input pipeline by load_batch
+      input_feed = {}
+    else:
+      # The batches of get_batch and get_batch_srnn with first_dim=6 are contiguous,
+      # and with a data_dtype of the placeholder type this is a no-op. Other
+      # inputs are converted once, not by every session.run call below
+      feed_dtype = self.action_prefix_fw.dtype.as_numpy_dtype
+      input_feed = {self.action_prefix_fw: np.ascontiguousarray(action_prefix_fw, dtype=feed_dtype),
+                    self.action_postfix_input_fw: np.ascontiguousarray(action_postfix_input_fw, dtype=feed_dtype),
+                    self.action_postfix_output_fw: np.ascontiguousarray(action_postfix_output_fw, dtype=feed_dtype),
+                    self.action_pose_fw: np.ascontiguousarray(action_pose_fw, dtype=feed_dtype)}
 
     # Output feed: depends on whether we do a backward step or not.
     if not srnn_seeds:
@@ -549,16 +407,25 @@ class Seq2SeqModel(object):
 
 
 
-  def get_batch( self, data, actions ):
+  def get_batch( self, data, actions, uniform_frames=False, first_dim=0 ):
     """Get a random batch of data from the specified bucket, prepare for step.
 
     Args
-      data: a list of sequences of size n-by-d to fit the model to.
-      actions: a list of the actions we are using
+      data: a list of sequences of size n-by-d to fit the model to, or a
+        data_utils.SequenceArena holding them.
+      actions: a list of the actions we are using. With one-hot encoding, the
+        encoding of the action of every sequence is added to the poses
+      uniform_frames: with a SequenceArena, draw every valid window with the
+        same probability instead of first drawing a sequence.
+      first_dim: first dimension of the sequences in the batch. With 6, the
+        global translation and rotation are left out and the batch can be
+        fed to step as it is
     Returns
       The tuple (encoder_inputs, decoder_inputs, decoder_outputs);
       the constructed batches have the proper format to call step(...) later.
     """
+    if isinstance( data, data_utils.SequenceArena ):
+      return self._get_batch_arena( data, uniform_frames, first_dim )
 
     # Select entries at random
     all_keys    = list(data.keys())
@@ -566,10 +433,11 @@ class Seq2SeqModel(object):
     # How many frames in total do we need?
     total_frames = self.source_seq_len + self.target_seq_len
 
-    encoder_inputs  = np.zeros((self.batch_size, self.source_seq_len-2, self.input_size_target), dtype=float)
-    decoder_inputs  = np.zeros((self.batch_size, self.target_seq_len, self.input_size_target), dtype=float)
-    decoder_outputs = np.zeros((self.batch_size, self.target_seq_len, self.input_size_target), dtype=float)
-    all_poses = np.zeros((self.batch_size, total_frames, self.input_size_target), dtype=float)
+    input_size = self.input_size_target - first_dim
+    encoder_inputs  = np.zeros((self.batch_size, self.source_seq_len-2, input_size), dtype=self.data_dtype)
+    decoder_inputs  = np.zeros((self.batch_size, self.target_seq_len, input_size), dtype=self.data_dtype)
+    decoder_outputs = np.zeros((self.batch_size, self.target_seq_len, input_size), dtype=self.data_dtype)
+    all_poses = np.zeros((self.batch_size, total_frames, input_size), dtype=self.data_dtype)
 
 
     for i in xrange( self.batch_size ):
@@ -583,17 +451,40 @@ class Seq2SeqModel(object):
       idx = np.random.randint( 16, n-total_frames )
 
       # Select the data around the sampled points
-      data_sel = data[ the_key ][idx:idx+total_frames ,:]
+      data_sel = data[ the_key ][idx:idx+total_frames, first_dim:]
 
-      # Add the data
-      encoder_inputs[i,:,0:self.input_size_target] = data_sel[1:self.source_seq_len-1, :] - data_sel[0:self.source_seq_len-2, :]
-      decoder_inputs[i,:,0:self.input_size_target] = data_sel[self.source_seq_len-1:self.source_seq_len+self.target_seq_len-1, :] - data_sel[self.source_seq_len-2:self.source_seq_len+self.target_seq_len-2, :]
-      decoder_outputs[i,:,0:self.input_size_target] = data_sel[self.source_seq_len:, 0:self.input_size_target] - data_sel[self.source_seq_len-1:-1, 0:self.input_size_target]
-      all_poses[i, :, 0:self.input_size_target] = data_sel[:, 0:self.input_size_target]
+      # Add the data. The one-hot columns of the velocities stay zero
+      d = data_sel.shape[1]
+      encoder_inputs[i,:,0:d] = data_sel[1:self.source_seq_len-1, :] - data_sel[0:self.source_seq_len-2, :]
+      decoder_inputs[i,:,0:d] = data_sel[self.source_seq_len-1:self.source_seq_len+self.target_seq_len-1, :] - data_sel[self.source_seq_len-2:self.source_seq_len+self.target_seq_len-2, :]
+      decoder_outputs[i,:,0:d] = data_sel[self.source_seq_len:, :] - data_sel[self.source_seq_len-1:-1, :]
+      all_poses[i, :, 0:d] = data_sel
+      if self.one_hot:
+        all_poses[i, :, d + actions.index( the_key[1] )] = 1
 
     return encoder_inputs, decoder_inputs, decoder_outputs, all_poses
 
 
+  def _get_batch_arena( self, arena, uniform_frames, first_dim ):
+    """
+    Same as get_batch, but with one vectorized draw from a SequenceArena and a
+    gather of its precomputed velocities. The batch is written into buffers
+    that are reused, so the returned arrays are overwritten by the next call.
+    """
+    total_frames = self.source_seq_len + self.target_seq_len
+    starts = arena.sample_starts( self.batch_size, total_frames, uniform_frames )
+
+    input_size = self.input_size_target - first_dim
+    if self._batch_buffers is None or self._batch_buffers[0].shape[::2] != (self.batch_size, input_size):
+      self._batch_buffers = (
+        np.empty((self.batch_size, self.source_seq_len-2, input_size), dtype=self.data_dtype),
+        np.empty((self.batch_size, self.target_seq_len, input_size), dtype=self.data_dtype),
+        np.empty((self.batch_size, self.target_seq_len, input_size), dtype=self.data_dtype),
+        np.empty((self.batch_size, total_frames, input_size), dtype=self.data_dtype))
+
+    return arena.batch( starts, self.source_seq_len, self.target_seq_len, self._batch_buffers, first_dim )
+
+
   def find_indices_srnn( self, data, action ):
     """
     Find the same action indices as in SRNN.
@@ -624,7 +515,7 @@ class Seq2SeqModel(object):
     idx.append( rng.randint( 16,T2-prefix-suffix ))
     return idx
 
-  def get_batch_srnn(self, data, action, velocity ):
+  def get_batch_srnn(self, data, action, velocity, actions=None, first_dim=0 ):
     """
     Get a random batch of data from the specified bucket, prepare for step.
 
@@ -632,17 +523,22 @@ class Seq2SeqModel(object):
       data: dictionary with k:v, k=((subject, action, subsequence, 'even')),
         v=nxd matrix with a sequence of poses
       action: the action to load data from
+      velocity: whether to build the inputs and outputs in velocity format
+      actions: the list of actions of the one-hot encoding. Needed with one-hot
+      first_dim: first dimension of the sequences in the batch, as in get_batch
     Returns
       The tuple (encoder_inputs, decoder_inputs, decoder_outputs);
       the constructed batches have the proper format to call step(...) later.
     """
 
-    actions = ["directions", "discussion", "eating", "greeting", "phoning",
-              "posing", "purchases", "sitting", "sittingdown", "smoking",
-              "takingphoto", "waiting", "walking", "walkingdog", "walkingtogether"]
+    all_actions = ["directions", "discussion", "eating", "greeting", "phoning",
+                   "posing", "purchases", "sitting", "sittingdown", "smoking",
+                   "takingphoto", "waiting", "walking", "walkingdog", "walkingtogether"]
 
-    if not action in actions:
+    if not action in all_actions:
       raise ValueError("Unrecognized action {0}".format(action))
+    if self.one_hot and actions is None:
+      raise ValueError("The one-hot encoding needs the list of actions")
 
     frames = {}
     frames[ action ] = self.find_indices_srnn( data, action )
@@ -656,13 +552,14 @@ class Seq2SeqModel(object):
 
     # Compute the number of frames needed
     total_frames = source_seq_len + target_seq_len
+    input_size = self.input_size_target - first_dim
     if velocity:
-      encoder_inputs  = np.zeros((batch_size, source_seq_len-2, self.input_size_target), dtype=float)
-      all_poses = np.zeros((batch_size, total_frames, self.input_size_target), dtype=float)
+      encoder_inputs  = np.zeros((batch_size, source_seq_len-2, input_size), dtype=self.data_dtype)
+      all_poses = np.zeros((batch_size, total_frames, input_size), dtype=self.data_dtype)
     else:
-      encoder_inputs = np.zeros((batch_size, source_seq_len - 1, self.input_size_target), dtype=float)
-    decoder_inputs  = np.zeros( (batch_size, target_seq_len, self.input_size_target), dtype=float )
-    decoder_outputs = np.zeros( (batch_size, target_seq_len, self.input_size_target), dtype=float )
+      encoder_inputs = np.zeros((batch_size, source_seq_len - 1, input_size), dtype=self.data_dtype)
+    decoder_inputs  = np.zeros( (batch_size, target_seq_len, input_size), dtype=self.data_dtype )
+    decoder_outputs = np.zeros( (batch_size, target_seq_len, input_size), dtype=self.data_dtype )
 
     # Reproducing SRNN's sequence subsequence selection as done in
     # https://github.com/asheshjain399/RNNexp/blob/master/structural_rnn/CRFProblems/H3.6m/processdata.py#L343
@@ -673,17 +570,23 @@ class Seq2SeqModel(object):
 
       data_sel = data[ (subject, action, subsequence, 'even') ]
 
-      data_sel = data_sel[(idx-source_seq_len):(idx+target_seq_len) ,:]
+      data_sel = data_sel[(idx-source_seq_len):(idx+target_seq_len), first_dim:]
+      d = data_sel.shape[1]
 
       if velocity:
-        encoder_inputs[i, :, :]  = data_sel[1:source_seq_len-1, :] - data_sel[0:source_seq_len-2, :]
-        decoder_inputs[i, :, :]  = data_sel[source_seq_len-1:source_seq_len+target_seq_len-1, :] - data_sel[source_seq_len-2:source_seq_len+target_seq_len-2, :]
-        decoder_outputs[i, :, :] = data_sel[source_seq_len:, :] - data_sel[source_seq_len-1:-1, :]
-        all_poses[i, :, :] = data_sel[:, 0: self.input_size_target]
+        encoder_inputs[i, :, 0:d]  = data_sel[1:source_seq_len-1, :] - data_sel[0:source_seq_len-2, :]
+        decoder_inputs[i, :, 0:d]  = data_sel[source_seq_len-1:source_seq_len+target_seq_len-1, :] - data_sel[source_seq_len-2:source_seq_len+target_seq_len-2, :]
+        decoder_outputs[i, :, 0:d] = data_sel[source_seq_len:, :] - data_sel[source_seq_len-1:-1, :]
+        all_poses[i, :, 0:d] = data_sel
+        if self.one_hot:
+          all_poses[i, :, d + actions.index( action )] = 1
       else:
-        encoder_inputs[i, :, :] = data_sel[0:source_seq_len-1, :]
-        decoder_inputs[i, :, :] = data_sel[source_seq_len-1:(source_seq_len + target_seq_len-1), :]
-        decoder_outputs[i, :, :] = data_sel[source_seq_len:, :]
+        encoder_inputs[i, :, 0:d] = data_sel[0:source_seq_len-1, :]
+        decoder_inputs[i, :, 0:d] = data_sel[source_seq_len-1:(source_seq_len + target_seq_len-1), :]
+        decoder_outputs[i, :, 0:d] = data_sel[source_seq_len:, :]
+        if self.one_hot:
+          for batch in (encoder_inputs, decoder_inputs, decoder_outputs):
+            batch[i, :, d + actions.index( action )] = 1
 
     if velocity:
       return encoder_inputs, decoder_inputs, decoder_outputs, all_poses
@@ -704,7 +607,8 @@ class Seq2SeqModel(object):
     with tf.variable_scope(name) as scope:
       if reuse:
         tf.get_variable_scope().reuse_variables()
-      _, enc_state = tf.contrib.rnn.static_rnn(cell, act_pre, dtype=tf.float32, scope=scope)
+      enc_cell, act_pre = self._known_inputs(cell, act_pre)
+      _, enc_state = tf.contrib.rnn.static_rnn(enc_cell, act_pre, dtype=tf.float32, scope=scope)
       variable_scope.get_variable_scope().reuse_variables()
       outputs, dec_state = tf.contrib.legacy_seq2seq.rnn_decoder(act_post_in, enc_state, cell,
                                                                  loop_function=lf, scope=scope)
@@ -721,9 +625,28 @@ class Seq2SeqModel(object):
     else:
       raise(ValueError, "unknown decoder architecture: %s" % decoder_architecture)
     with tf.variable_scope(name) as scope:
+      if lf is None:
+        cell, act_post_in = self._known_inputs(cell, act_post_in)
       outputs, dec_state = tf.contrib.legacy_seq2seq.rnn_decoder(act_post_in, enc_state, cell, loop_function=lf, scope=scope)
     return dec_state
 
+  def _known_inputs(self, cell, inputs):
+    """
+    Cell and inputs to run over a sequence known in advance. With hoist_inputs,
+    the input half of the graph convolutions of all the steps is computed here,
+    in the current variable scope, and the returned cell only diffuses the state.
+
+    Args
+      cell: the DCGRUCell, or MultiRNNCell of them, of the sequence
+      inputs: list of the input tensors of every step
+    Returns
+      cell: the cell to step with
+      inputs: the inputs to feed it
+    """
+    if self.hoist_inputs and isinstance(cell, DCGRUCell):
+      return HoistedInputCell(cell), cell.hoist_inputs(inputs)
+    return cell, inputs
+
 
   def dense(self, state_fw, state_bw, reuse=False):
     with tf.variable_scope('train_d') as scope:  # name control linear
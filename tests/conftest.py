@@ -0,0 +1,38 @@
+"""Fixtures of the tests. The modules of the repository are imported from its root."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert( 0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+
+ACTIONS = ["walking", "eating"]
+
+
+def random_poses( rng, nframes, ndims=99 ):
+  """Smooth random sequence of poses, with a few constant dimensions like the real data"""
+  poses = np.cumsum( rng.randn(nframes, ndims) * 0.05, axis=0 ) + rng.randn( ndims )
+  poses[:, [0, 40, 41]] = 0.25
+  return poses
+
+
+@pytest.fixture
+def dataset_dir( tmpdir ):
+  """
+  A small collection in the S{subject}/{action}_{subaction}.txt layout of
+  H3.6M: subjects 1 and 5, the ACTIONS, subactions 1 and 2.
+  """
+  rng = np.random.RandomState( 0 )
+  for subj in (1, 5):
+    os.makedirs( os.path.join(str(tmpdir), 'S{0}'.format(subj)) )
+    for action in ACTIONS:
+      for subact in (1, 2):
+        filename = os.path.join( str(tmpdir), 'S{0}'.format(subj), '{0}_{1}.txt'.format(action, subact) )
+        np.savetxt( filename, random_poses(rng, 300 + 40 * subact), delimiter=',', fmt='%.6f' )
+  return str( tmpdir )
@@ -0,0 +1,74 @@
+"""Pose codecs of data_utils and their error bounds."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import h5py
+import numpy as np
+import pytest
+
+import data_utils
+from conftest import random_poses
+
+
+@pytest.mark.parametrize( "codec, delta", [('int16', True), ('int16', False), ('float16', False)] )
+def test_decode_within_error_bound( codec, delta ):
+  poses = random_poses( np.random.RandomState(1), 500 )
+  encoded = data_utils.encode_poses( poses, codec, delta )
+  decoded = data_utils.decode_poses( encoded, np.float64 )
+
+  bound = data_utils.pose_error_bound( encoded, np.float64 )
+  assert np.all( np.abs(decoded - poses) <= bound )
+  # Constant dimensions decode exactly
+  assert np.array_equal( decoded[:, 0], poses[:, 0] )
+
+
+def test_int16_delta_wraps_around():
+  # Jumps over the whole range do not fit in int16 differences, and wrap
+  poses = np.array( [[-1.0, 3.0], [1.0, -3.0], [-1.0, 3.0], [0.5, 0.0]] )
+  encoded = data_utils.encode_poses( poses, 'int16', delta=True )
+  assert encoded['values'].dtype == np.int16
+
+  decoded = data_utils.decode_poses( encoded, np.float64 )
+  assert np.all( np.abs(decoded - poses) <= data_utils.pose_error_bound(encoded, np.float64) )
+
+
+def test_encode_rejects_bad_arguments():
+  poses = np.zeros( (10, 3) )
+  with pytest.raises( ValueError ):
+    data_utils.encode_poses( poses, 'int8' )
+  with pytest.raises( ValueError ):
+    data_utils.encode_poses( poses, 'float16', delta=True )
+
+
+@pytest.mark.parametrize( "codec", [None, 'int16', 'float16'] )
+def test_write_and_read_poses( tmpdir, codec ):
+  poses = random_poses( np.random.RandomState(2), 200 ).astype( np.float32 )
+  with h5py.File( str(tmpdir.join('poses.h5')), 'w' ) as f:
+    max_error = data_utils.write_encoded_poses( f, 'seq', poses, codec )
+  with h5py.File( str(tmpdir.join('poses.h5')), 'r' ) as f:
+    decoded = data_utils.read_poses( f['seq'] )
+    if codec is not None:
+      assert np.array_equal( f['seq'].attrs['max_error'], max_error )
+      assert f['seq'].chunks is not None and f['seq'].compression == 'gzip'
+
+  assert decoded.shape == poses.shape
+  assert np.all( np.abs(decoded - poses) <= max_error )
+
+
+def test_read_encoded_poses_undoes_delta( tmpdir ):
+  poses = random_poses( np.random.RandomState(3), 200 )
+  with h5py.File( str(tmpdir.join('poses.h5')), 'w' ) as f:
+    data_utils.write_encoded_poses( f, 'seq', poses, 'int16' )
+  with h5py.File( str(tmpdir.join('poses.h5')), 'r' ) as f:
+    assert f['seq'].attrs['delta']
+    encoded = data_utils.read_encoded_poses( f['seq'] )
+
+  absolute = data_utils.encode_poses( poses, 'int16', delta=False )
+  assert not encoded['delta']
+  assert np.array_equal( encoded['values'], absolute['values'] )
+  # Any window decodes on its own
+  window = dict( encoded, values=encoded['values'][50:60] )
+  assert np.allclose( data_utils.decode_poses(window, np.float64),
+                      data_utils.decode_poses(encoded, np.float64)[50:60] )
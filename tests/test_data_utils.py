@@ -0,0 +1,156 @@
+"""Normalization stats, the binary cache and the sequence arenas of data_utils."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+import data_utils
+from conftest import ACTIONS, random_poses
+
+
+def test_accumulator_merges_like_the_whole_data():
+  rng = np.random.RandomState( 0 )
+  frames = random_poses( rng, 1000 )
+  bounds = [0, 1, 130, 131, 600, 1000]
+
+  merged = data_utils.NormalizationAccumulator()
+  for begin, end in zip( bounds[:-1], bounds[1:] ):
+    chunk = data_utils.NormalizationAccumulator()
+    chunk.update( frames[begin:end] )
+    merged.merge( chunk )
+
+  assert merged.count == 1000
+  assert np.allclose( merged.mean, np.mean(frames, axis=0) )
+  assert np.allclose( merged.std, np.std(frames, axis=0) )
+
+  data_mean, data_std, dim_to_ignore, dim_to_use = data_utils.normalization_stats( merged )
+  expected = data_utils.normalization_stats( frames )
+  assert np.allclose( data_mean, expected[0] ) and np.allclose( data_std, expected[1] )
+  assert list(dim_to_ignore) == list(expected[2]) == [0, 40, 41]
+  assert list(dim_to_use) == list(expected[3])
+
+
+def normalized_training_set( dataset_dir, dtype=np.float64 ):
+  train_set, complete_train = data_utils.load_data( dataset_dir, [1], ACTIONS, False )
+  stats = data_utils.normalization_stats( complete_train )
+  return train_set, stats, data_utils.normalize_data( train_set, stats[0], stats[1], stats[3], dtype )
+
+
+def test_cache_matches_txt_files( dataset_dir, tmpdir ):
+  train_set, stats, _ = normalized_training_set( dataset_dir )
+  cache_dir = str( tmpdir.join('cache') )
+
+  cached, cached_stats = data_utils.load_data_cached( dataset_dir, [1], ACTIONS, False, cache_dir )
+  assert sorted( cached.keys() ) == sorted( train_set.keys() )
+  for key in train_set:
+    assert np.array_equal( cached[key], train_set[key] )
+  for array, expected in zip( cached_stats, stats ):
+    assert np.allclose( array, expected )
+
+  # Nothing to convert the second time, and a changed file is converted again
+  store_dir = data_utils.store_directory( cache_dir, False )
+  assert data_utils.ingest_data( dataset_dir, [1], ACTIONS, False, store_dir )[0] == []
+  changed = os.path.join( dataset_dir, 'S1', 'eating_2.txt' )
+  os.utime( changed, (0, 0) )
+  assert data_utils.ingest_data( dataset_dir, [1], ACTIONS, False, store_dir )[0] == [(1, 'eating', 2)]
+
+
+@pytest.mark.parametrize( "codec", ['int16', 'float16'] )
+def test_encoded_cache( dataset_dir, tmpdir, codec ):
+  train_set, _, _ = normalized_training_set( dataset_dir )
+  cache_dir = str( tmpdir.join('cache') )
+
+  cached, _ = data_utils.load_data_cached( dataset_dir, [1], ACTIONS, False, cache_dir, codec=codec )
+  store_dir = data_utils.store_directory( cache_dir, False )
+  with open( os.path.join(store_dir, 'manifest.json') ) as f:
+    manifest = json.load( f )
+
+  for subj, action, subact, _ in train_set:
+    entry = manifest['S{0}/{1}/{2}'.format(subj, action, subact)]
+    assert entry['codec'] == codec
+    assert os.path.isfile( os.path.join(store_dir, 'S{0}_{1}_{2}.h5'.format(subj, action, subact)) )
+    error = np.abs( cached[(subj, action, subact, 'even')] - train_set[(subj, action, subact, 'even')] )
+    assert np.max( error ) <= entry['max_error']
+
+
+def test_sequence_arena_batch( dataset_dir ):
+  _, _, normalized = normalized_training_set( dataset_dir )
+  arena = data_utils.SequenceArena( normalized, actions=ACTIONS )
+  source_seq_len, target_seq_len = 50, 10
+  total_frames = source_seq_len + target_seq_len
+
+  starts = arena.sample_starts( 32, total_frames, rng=np.random.RandomState(0) )
+  encoder_inputs, decoder_inputs, decoder_outputs, poses = arena.batch( starts, source_seq_len, target_seq_len )
+
+  ndims = arena.data.shape[1]
+  windows = arena.gather( starts, total_frames )
+  velocity = windows[:, 1:] - windows[:, :-1]
+  assert np.allclose( encoder_inputs[:, :, :ndims], velocity[:, :source_seq_len-2] )
+  assert np.allclose( decoder_inputs[:, :, :ndims], velocity[:, source_seq_len-2:total_frames-2] )
+  assert np.allclose( decoder_outputs[:, :, :ndims], velocity[:, source_seq_len-1:] )
+  assert np.array_equal( poses[:, :, :ndims], windows )
+  assert not np.any( encoder_inputs[:, :, ndims:] )
+
+  # One-hot encoding of the action of every window
+  sequence_idx = np.searchsorted( arena.offsets, starts, side='right' ) - 1
+  assert np.array_equal( np.argmax(poses[:, 0, ndims:], axis=1), arena.action_ids[sequence_idx] )
+  assert np.all( np.sum(poses[:, :, ndims:], axis=2) == 1 )
+
+  # Without the first dimensions, the batch is contiguous
+  cut = arena.batch( starts, source_seq_len, target_seq_len, first_dim=6 )
+  for full, part in zip( (encoder_inputs, decoder_inputs, decoder_outputs, poses), cut ):
+    assert part.flags.c_contiguous
+    assert np.array_equal( part, full[:, :, 6:] )
+
+
+def test_sequence_arena_window_starts( dataset_dir ):
+  _, _, normalized = normalized_training_set( dataset_dir )
+  arena = data_utils.SequenceArena( normalized )
+  total_frames = 60
+
+  starts = arena.window_starts( total_frames )
+  assert len( starts ) == np.sum( arena.lengths - total_frames - arena.margin )
+  for key in arena.keys():
+    i = arena.sequence_keys.index( key )
+    within = starts[ (starts >= arena.offsets[i]) & (starts < arena.offsets[i+1]) ] - arena.offsets[i]
+    assert np.array_equal( within, np.arange(arena.margin, len(normalized[key]) - total_frames) )
+
+  drawn = arena.sample_starts( 1000, total_frames, uniform_frames=True, rng=np.random.RandomState(1) )
+  assert np.all( np.isin(drawn, starts) )
+
+
+@pytest.mark.parametrize( "codec", ['int16', 'float16'] )
+def test_encoded_arena_matches_decoded( dataset_dir, tmpdir, codec ):
+  _, stats, normalized = normalized_training_set( dataset_dir )
+  data_mean, data_std, _, dim_to_use = stats
+  arena = data_utils.SequenceArena( normalized, actions=ACTIONS )
+
+  encoded, _ = data_utils.load_data_cached( dataset_dir, [1], ACTIONS, False, str(tmpdir), codec=codec, decode=False )
+  encoded_arena = data_utils.EncodedArena( encoded, data_mean, data_std, dim_to_use, dtype=np.float64, actions=ACTIONS )
+  assert encoded_arena.values.dtype == np.dtype( codec )
+  assert encoded_arena.values.shape == arena.data.shape
+
+  # The error bound of the manifest, in normalized units
+  with open( os.path.join(data_utils.store_directory(str(tmpdir), False), 'manifest.json') ) as f:
+    max_error = max( entry['max_error'] for entry in json.load(f).values() )
+  bound = max_error / np.min( data_std[dim_to_use] )
+
+  starts = arena.sample_starts( 32, 60, uniform_frames=True, rng=np.random.RandomState(2) )
+  batch = encoded_arena.batch( starts, 50, 10 )
+  expected = arena.batch( starts, 50, 10 )
+  for part, full in zip( batch, expected ):
+    assert part.shape == full.shape
+    assert np.max( np.abs(part - full) ) <= 2 * bound
+
+  key = encoded_arena.keys()[0]
+  assert np.max( np.abs(encoded_arena[key] - normalized[key]) ) <= bound
+
+  cut = encoded_arena.batch( starts, 50, 10, first_dim=6 )
+  for part, full in zip( cut, batch ):
+    assert np.array_equal( part, full[:, :, 6:] )
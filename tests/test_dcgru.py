@@ -0,0 +1,41 @@
+"""Magnitude pruning of the learned adjacency."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+pytest.importorskip( "tensorflow" )
+import dcgru
+
+
+@pytest.mark.parametrize( "sparsity", [0.0, 0.5, 0.9] )
+def test_magnitude_mask( sparsity ):
+  adj_mx = np.random.RandomState( 0 ).randn( 20, 20 )
+  mask = dcgru.magnitude_mask( adj_mx, sparsity )
+
+  # At least the asked fraction is kept, and it is the largest entries
+  assert np.sum( mask ) >= np.ceil( (1 - sparsity) * adj_mx.size )
+  top = np.sort( np.abs(adj_mx), axis=None )[-int(np.ceil((1 - sparsity) * adj_mx.size))]
+  assert np.all( mask[np.abs(adj_mx) >= top] )
+  # No node loses all its edges
+  assert np.all( np.any(mask, axis=0) ) and np.all( np.any(mask, axis=1) )
+
+
+def test_magnitude_mask_within_a_mask():
+  rng = np.random.RandomState( 1 )
+  adj_mx = rng.randn( 20, 20 )
+  skeleton = rng.rand( 20, 20 ) < 0.3
+  np.fill_diagonal( skeleton, True )
+
+  pruned = dcgru.magnitude_mask( adj_mx, 0.5, skeleton )
+  assert not np.any( pruned & ~skeleton )
+  assert np.sum( pruned ) >= np.ceil( 0.5 * np.sum(skeleton) )
+  assert np.sum( pruned ) < np.sum( skeleton )
+
+
+def test_magnitude_mask_rejects_bad_sparsity():
+  with pytest.raises( ValueError ):
+    dcgru.magnitude_mask( np.ones((3, 3)), 1.0 )
@@ -0,0 +1,89 @@
+"""Vectorized forward kinematics against the per-frame loops they replace."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+
+import numpy as np
+import pytest
+
+import data_utils
+import forward_kinematics
+
+
+def loop_revert_coordinate_space( channels, R0, T0 ):
+  """revert_coordinate_space as it was, one frame at a time"""
+  n, d = channels.shape
+
+  channels_rec = copy.copy(channels)
+  R_prev = R0
+  T_prev = T0
+  rootRotInd = np.arange(3,6)
+
+  for ii in range(n):
+    R_diff = data_utils.expmap2rotmat( channels[ii, rootRotInd] )
+    R = R_diff.dot( R_prev )
+
+    channels_rec[ii, rootRotInd] = data_utils.rotmat2expmap(R)
+    T = T_prev + ((R_prev.T).dot( np.reshape(channels[ii,:3],[3,1]))).reshape(-1)
+    channels_rec[ii,:3] = T
+    T_prev = T
+    R_prev = R
+
+  return channels_rec
+
+
+def random_expmaps( rng, nframes ):
+  channels = rng.randn( nframes, 99 ) * 0.3
+  channels[:, :3] *= 100
+  return channels
+
+
+def test_kinematic_tree_matches_fkl():
+  parent, offset, rotInd, expmapInd = forward_kinematics._some_variables()
+  tree = forward_kinematics.KinematicTree( parent, offset, rotInd, expmapInd )
+  angles = random_expmaps( np.random.RandomState(0), 20 )
+
+  xyz = tree.fkl( angles )
+  expected = np.stack( [forward_kinematics.fkl(frame, parent, offset, rotInd, expmapInd) for frame in angles] )
+  assert xyz.shape == (20, 96)
+  assert np.allclose( xyz, expected, atol=1e-8 )
+
+
+def test_kinematic_tree_rejects_unordered_parents():
+  parent, offset, rotInd, expmapInd = forward_kinematics._some_variables()
+  parent = parent.copy()
+  parent[1] = 5
+  with pytest.raises( ValueError ):
+    forward_kinematics.KinematicTree( parent, offset, rotInd, expmapInd )
+
+
+@pytest.mark.parametrize( "chunk_size", [1, 4, 64] )
+def test_prefix_products( chunk_size ):
+  D = data_utils.expmap2rotmat_batch( np.random.RandomState(1).randn(37, 3) )
+  P = forward_kinematics._prefix_products( D, chunk_size )
+
+  expected = D[0]
+  assert np.allclose( P[0], expected )
+  for k in range( 1, len(D) ):
+    expected = D[k].dot( expected )
+    assert np.allclose( P[k], expected )
+
+
+@pytest.mark.parametrize( "nframes, chunk_size", [(1, 64), (50, 64), (150, 64), (150, 7)] )
+def test_revert_coordinate_space_matches_loop( nframes, chunk_size ):
+  rng = np.random.RandomState( 2 )
+  channels = random_expmaps( rng, nframes )
+  R0 = data_utils.expmap2rotmat( rng.randn(3) )
+  T0 = rng.randn( 3 )
+
+  reverted = forward_kinematics.revert_coordinate_space( channels, R0, T0, chunk_size )
+  expected = loop_revert_coordinate_space( channels, R0, T0 )
+
+  assert np.allclose( reverted[:, :3], expected[:, :3], atol=1e-8 )
+  assert np.array_equal( reverted[:, 6:], expected[:, 6:] )
+  # Compare the root rotations, an exponential map is not unique
+  assert np.allclose( data_utils.expmap2rotmat_batch(reverted[:, 3:6]),
+                      data_utils.expmap2rotmat_batch(expected[:, 3:6]), atol=1e-8 )
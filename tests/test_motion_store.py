@@ -0,0 +1,62 @@
+"""Window reads of the out-of-core motion store."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+import data_utils
+import motion_store
+from conftest import ACTIONS
+
+
+@pytest.fixture
+def store( dataset_dir, tmpdir ):
+  filename = str( tmpdir.join('train.h5') )
+  # Small chunks, so windows straddle them
+  motion_store.convert_to_store( dataset_dir, [1], ACTIONS, False, filename, chunk_frames=32, compression='gzip' )
+  return filename
+
+
+def test_store_windows_match_the_arena( dataset_dir, store ):
+  train_set, complete_train = data_utils.load_data( dataset_dir, [1], ACTIONS, False )
+  data_mean, data_std, _, dim_to_use = data_utils.normalization_stats( complete_train )
+  normalized = data_utils.normalize_data( train_set, data_mean, data_std, dim_to_use, np.float32 )
+
+  # A cache of two chunks, so reads evict
+  chunk_mb = 32 * len( dim_to_use ) * 4 / 2.0**20
+  stored = motion_store.MotionStore( store, ACTIONS, True, cache_mb=2 * chunk_mb, euler=False, subjects=[1] )
+  try:
+    assert stored.cache_chunks == 2
+    for array, expected in zip( stored.stats, (data_mean, data_std) ):
+      assert np.allclose( array, expected )
+    arena = data_utils.SequenceArena( dict((key, normalized[key]) for key in stored.keys()), actions=ACTIONS )
+    assert np.array_equal( arena.offsets, stored.offsets )
+
+    for key in stored.keys():
+      assert np.allclose( stored[key], normalized[key], atol=1e-6 )
+
+    rng = np.random.RandomState( 0 )
+    for uniform_frames in (False, True):
+      starts = stored.sample_starts( 16, 60, uniform_frames, rng )
+      assert np.all( np.isin(starts, arena.window_starts(60)) )
+      for part, expected in zip( stored.batch(starts, 50, 10, first_dim=6), arena.batch(starts, 50, 10, first_dim=6) ):
+        assert np.allclose( part, expected, atol=1e-5 )
+    assert stored.reads > 0
+  finally:
+    stored.close()
+
+
+def test_store_mismatch( store ):
+  assert motion_store.store_mismatch( store, [1], ACTIONS, False ) is None
+  assert motion_store.store_mismatch( store, [1], list(reversed(ACTIONS)), False ) is None
+  assert "exponential map" in motion_store.store_mismatch( store, [1], ACTIONS, True )
+  assert "subjects" in motion_store.store_mismatch( store, [1, 6], ACTIONS, False )
+  assert "actions" in motion_store.store_mismatch( store, [1], ACTIONS[:1], False )
+
+  with pytest.raises( ValueError ):
+    motion_store.MotionStore( store, ACTIONS, True, euler=False, subjects=[1, 6] )
+  with pytest.raises( ValueError ):
+    motion_store.MotionStore( store, ACTIONS[:1], True )
@@ -0,0 +1,350 @@
+
+"""Rotation conversions, forward kinematics and the errors of srnn's seeds as TensorFlow ops."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+# Frames of the error reported for 80, 160, 320, 400, 560 and 1000 ms
+SRNN_HORIZONS = [(80, 1), (160, 3), (320, 7), (400, 9), (560, 13), (1000, 24)]
+
+# Distance under which a joint is counted by PCK, in mm, as in evaluate.py
+PCK_THRESHOLD = 20
+
+
+def expmap2rotmat( r ):
+  """
+  Same as data_utils.expmap2rotmat_batch.
+
+  Args
+    r: ...x3 tensor of exponential maps
+  Returns
+    R: ...x3x3 tensor of rotation matrices
+  """
+  # The norm of a zero rotation has no gradient, so it is taken of a tiny
+  # squared norm instead
+  theta = tf.sqrt( tf.maximum(tf.reduce_sum(tf.square(r), axis=-1, keepdims=True), 1e-24) )
+  r0 = r / (theta + np.finfo(np.float32).eps)
+
+  x, y, z = tf.unstack( r0, axis=-1 )
+  zeros = tf.zeros_like( x )
+  r0x = tf.stack([tf.stack([zeros, -z, y], axis=-1),
+                  tf.stack([z, zeros, -x], axis=-1),
+                  tf.stack([-y, x, zeros], axis=-1)], axis=-2)
+
+  theta = tf.expand_dims( theta, -1 )
+  R = tf.eye(3, dtype=r.dtype) + tf.sin(theta)*r0x + (1-tf.cos(theta))*tf.matmul( r0x, r0x )
+  return R
+
+
+def rotmat2euler( R ):
+  """
+  Same as data_utils.rotmat2euler_batch, with the gimbal lock rotations
+  handled with masks.
+
+  Args
+    R: ...x3x3 tensor of rotation matrices
+  Returns
+    eul: ...x3 tensor of Euler angles
+  """
+  R02 = R[..., 0, 2]
+  ones = tf.ones_like( R02 )
+  special = tf.logical_or( tf.equal(R02, 1), tf.equal(R02, -1) )
+
+  # Regular case, with cos(E2) set to 1 where it is not used
+  E2 = -tf.asin( R02 )
+  cosE2 = tf.where( special, ones, tf.cos(E2) )
+  E1 = tf.atan2( R[..., 1, 2]/cosE2, R[..., 2, 2]/cosE2 )
+  E3 = tf.atan2( R[..., 0, 1]/cosE2, R[..., 0, 0]/cosE2 )
+
+  # Special case, with E3 set arbitrarily to 0
+  dlta = tf.atan2( R[..., 0, 1], R02 )
+  E1 = tf.where( special, dlta, E1 )
+  E2 = tf.where( special, tf.where(tf.equal(R02, -1), ones*np.pi/2, -ones*np.pi/2), E2 )
+  E3 = tf.where( special, tf.zeros_like(R02), E3 )
+
+  eul = tf.stack( [E1, E2, E3], axis=-1 )
+  return eul
+
+
+def euler2rotmat( e ):
+  """
+  Same as data_utils.euler2rotmat_batch.
+
+  Args
+    e: ...x3 tensor of Euler angles
+  Returns
+    R: ...x3x3 tensor of rotation matrices
+  """
+  c1, c2, c3 = tf.unstack( tf.cos(e), axis=-1 )
+  s1, s2, s3 = tf.unstack( tf.sin(e), axis=-1 )
+  zeros = tf.zeros_like( c1 )
+  ones  = tf.ones_like( c1 )
+
+  def rotation( rows ):
+    return tf.stack( [tf.stack(row, axis=-1) for row in rows], axis=-2 )
+
+  Rx = rotation([[ones, zeros, zeros], [zeros, c1, -s1], [zeros, s1, c1]])
+  Ry = rotation([[c2, zeros, s2], [zeros, ones, zeros], [-s2, zeros, c2]])
+  Rz = rotation([[c3, -s3, zeros], [s3, c3, zeros], [zeros, zeros, ones]])
+  R = tf.matrix_transpose( tf.matmul(tf.matmul(Rz, Ry), Rx) )
+  return R
+
+
+def rotmat2expmap( R ):
+  """
+  Same as data_utils.rotmat2expmap_batch, through the quaternion of R. The
+  quaternions are not checked to have norm 1.
+
+  Args
+    R: ...x3x3 tensor of rotation matrices
+  Returns
+    r: ...x3 tensor of exponential maps
+  """
+  eps = np.finfo(np.float32).eps
+
+  # rotmat2quat
+  rotdiff = R - tf.matrix_transpose( R )
+  r = tf.stack( [-rotdiff[..., 1, 2], rotdiff[..., 0, 2], -rotdiff[..., 0, 1]], axis=-1 )
+  rnorm = tf.norm( r, axis=-1, keepdims=True )
+  r0 = r / (rnorm + eps)
+  costheta = (R[..., 0, 0] + R[..., 1, 1] + R[..., 2, 2] - 1) / 2
+  theta = tf.atan2( rnorm[..., 0] / 2, costheta )
+  q0 = tf.cos( theta/2 )
+  q = r0 * tf.expand_dims( tf.sin(theta/2), -1 )
+
+  # quat2expmap
+  sinhalftheta = tf.norm( q, axis=-1, keepdims=True )
+  r0 = q / (sinhalftheta + eps)
+  theta = 2 * tf.atan2( sinhalftheta[..., 0], q0 )
+  theta = tf.floormod( theta + 2*np.pi, 2*np.pi )
+
+  flip  = theta > np.pi
+  theta = tf.where( flip, 2 * np.pi - theta, theta )
+  sign  = tf.where( flip, -tf.ones_like(theta), tf.ones_like(theta) )
+  return r0 * tf.expand_dims( sign * theta, -1 )
+
+
+def expmap2euler_channels( channels ):
+  """
+  Same as data_utils.expmap2euler_channels.
+
+  Args
+    channels: ...x99 tensor of poses in exponential map
+  Returns
+    converted: ...x99 tensor with the rotations in Euler angles
+  """
+  leading = tf.shape( channels )[:-1]
+  rotations = tf.reshape( channels[..., 3:99], tf.concat([leading, [32, 3]], axis=0) )
+  euler = rotmat2euler( expmap2rotmat(rotations) )
+  converted = tf.concat( [channels[..., :3], tf.reshape(euler, tf.concat([leading, [96]], axis=0))], axis=-1 )
+  return converted
+
+
+def euler2expmap_channels( channels ):
+  """
+  Same as data_utils.euler2expmap_channels.
+
+  Args
+    channels: ...x99 tensor of poses in Euler angles
+  Returns
+    converted: ...x99 tensor with the rotations in exponential map
+  """
+  leading = tf.shape( channels )[:-1]
+  rotations = tf.reshape( channels[..., 3:99], tf.concat([leading, [32, 3]], axis=0) )
+  expmap = rotmat2expmap( euler2rotmat(rotations) )
+  converted = tf.concat( [channels[..., :3], tf.reshape(expmap, tf.concat([leading, [96]], axis=0))], axis=-1 )
+  return converted
+
+
+def fkl( angles, tree ):
+  """
+  Same as forward_kinematics.KinematicTree.fkl, on any number of leading
+  dimensions, e.g. (batch, time). The joints are worked out a level of the
+  tree at a time, and every op is differentiable.
+
+  Args
+    angles: ...x99 tensor with 3d position and 3d joint angles in expmap format
+    tree: forward_kinematics.KinematicTree with the skeleton
+  Returns
+    xyz: ...x96 tensor with the 3d points of the 32 joints
+  """
+  njoints = len( tree.parent )
+  leading = tf.shape( angles )[:-1]
+  flat = tf.reshape( angles, [-1, 99] )
+  padded = tf.concat( [flat, tf.zeros_like(flat[:, :1])], axis=1 )
+
+  rotations = tf.unstack( expmap2rotmat(tf.gather(padded, tree.expmapInd, axis=1)), num=njoints, axis=1 )
+  positions = tf.gather( padded, tree.positionInd, axis=1 ) + tree.offset.astype( angles.dtype.as_numpy_dtype )
+  positions = tf.unstack( positions, num=njoints, axis=1 )
+
+  xyz = [None] * njoints
+  xyz[0] = positions[0]
+  for joints in tree.levels:
+    parents = tree.parent[ joints ]
+    parent_rotations = tf.stack( [rotations[p] for p in parents], axis=1 )
+    parent_xyz = tf.stack( [xyz[p] for p in parents], axis=1 )
+    joint_positions = tf.expand_dims( tf.stack([positions[j] for j in joints], axis=1), 2 )
+
+    joint_xyz = tf.matmul( joint_positions, parent_rotations )[:, :, 0, :] + parent_xyz
+    joint_rotations = tf.matmul( tf.stack([rotations[j] for j in joints], axis=1), parent_rotations )
+    for k, j in enumerate( joints ):
+      xyz[j] = joint_xyz[:, k]
+      rotations[j] = joint_rotations[:, k]
+
+  xyz = tf.stack( xyz, axis=1 )
+  xyz = tf.stack( [xyz[..., 0], xyz[..., 2], xyz[..., 1]], axis=-1 )
+  return tf.reshape( xyz, tf.concat([leading, [3 * njoints]], axis=0) )
+
+
+def unnormalize( poses, data_mean, data_std, dim_to_use ):
+  """
+  Same as data_utils.unNormalizeData, on a batch of sequences. The used
+  dimensions are put in place by a 0/1 selection matrix, so the ignored ones
+  get their mean.
+
+  Args
+    poses: ...xd tensor of normalized poses, d >= len(dim_to_use). The
+      dimensions past dim_to_use, like a one-hot encoding, are dropped
+    data_mean: vector of mean used to normalize the data
+    data_std: vector of standard deviation used to normalize the data
+    dim_to_use: vector with dimensions used by the model
+  Returns
+    ...xD tensor of poses, D = len(data_mean)
+  """
+  dtype = poses.dtype.as_numpy_dtype
+  nused = len( dim_to_use )
+  selection = np.zeros( (nused, len(data_mean)), dtype=dtype )
+  selection[ np.arange(nused), dim_to_use ] = 1
+
+  restored = tf.tensordot( poses[..., :nused], selection, axes=1 )
+  return restored * data_std.astype( dtype ) + data_mean.astype( dtype )
+
+
+def euler_error( pred, gt ):
+  """
+  Euler angle error of srnn's seeds, ported from the evaluation in
+  translate.train. The global translation and rotation (first 6 entries) are
+  ignored, and so are the dimensions that do not move in the ground truth.
+
+  Args
+    pred: ...xNxTx99 tensor of predicted poses in Euler angles
+    gt: ...xNxTx99 tensor of ground truth poses in Euler angles
+  Returns
+    ...xT tensor with the l2 error of every frame, averaged over the N sequences
+  """
+  _, variance = tf.nn.moments( gt, axes=[-2], keep_dims=True )
+  moving = tf.cast( tf.sqrt(variance) > 1e-4, gt.dtype )
+  moving = tf.concat( [tf.zeros_like(moving[..., :6]), moving[..., 6:]], axis=-1 )
+
+  euc_error = tf.sqrt( tf.reduce_sum(moving * tf.square(gt - pred), axis=-1) )
+  return tf.reduce_mean( euc_error, axis=-2 )
+
+
+class SrnnEvaluation(object):
+  """
+  Euler angle error, MPJPE and PCK of the model on srnn's seeds of all the
+  actions, computed in the graph from the outputs of the model. The seeds of
+  all the actions go through the model as one batch, so a single session.run
+  gives the errors and their summaries.
+  """
+
+  def __init__(self, model, actions, srnn_batches, srnn_inputs, srnn_gts_euler, srnn_gts_expmap, tree,
+               data_mean, data_std, dim_to_use, velocity, from_exp, dtype=tf.float64):
+    """
+    Args
+      model: Seq2SeqModel to evaluate
+      actions: list of strings with the actions to evaluate
+      srnn_batches: dictionary with k:v, k=action, v=tuple of srnn's seeds, as
+        given by translate.get_srnn_batches
+      srnn_inputs: same as srnn_batches, with the contiguous batches the model
+        is fed, also given by translate.get_srnn_batches
+      srnn_gts_euler: dictionary with k:v, k=action, v=list of ground truth
+        sequences in Euler angles, as given by translate.get_srnn_gts
+      srnn_gts_expmap: same as srnn_gts_euler, in exponential map
+      tree: forward_kinematics.KinematicTree with the skeleton of the joint errors
+      data_mean: vector of mean used to normalize the data
+      data_std: vector of standard deviation used to normalize the data
+      dim_to_use: vector with dimensions used by the model
+      velocity: whether the model predicts velocities
+      from_exp: whether the model predicts exponential maps. Otherwise it
+        predicts Euler angles, which are converted to exponential maps for the
+        joint positions
+      dtype: type the predictions are converted and compared in
+    """
+    self.model = model
+    self.actions = list( actions )
+    target_seq_len = model.target_seq_len
+    feed_dtype = model.action_prefix_fw.dtype.as_numpy_dtype
+
+    # The seeds of all the actions, one after the other. np.concatenate gives
+    # contiguous arrays, which are fed as they are at every run
+    _, _, postfix_output, poses = [
+      np.concatenate( [srnn_batches[ action ][ i ] for action in self.actions] ) for i in range(4)]
+    prefix, postfix_input, postfix_output_fed, poses_fed = [
+      np.concatenate( [srnn_inputs[ action ][ i ] for action in self.actions] ).astype( feed_dtype, copy=False )
+      for i in range(4)]
+    self.feed = {model.action_prefix_fw: prefix,
+                 model.action_postfix_input_fw: postfix_input,
+                 model.action_postfix_output_fw: postfix_output_fed,
+                 model.action_pose_fw: poses_fed}
+
+    with tf.name_scope("srnn_evaluation"):
+      # The model does not predict the global translation and rotation, the
+      # ground truth ones are put back like in revert_output_format
+      pred = tf.cast( tf.stack(model.outputs, axis=1), dtype )
+      pred = tf.concat( [tf.constant(postfix_output[:, :, :6], dtype=dtype), pred], axis=-1 )
+      if velocity:
+        first_frame = poses[:, model.source_seq_len-1:model.source_seq_len, :]
+        pred = tf.cumsum( pred, axis=1 ) + tf.constant( first_frame, dtype=dtype )
+
+      pred = unnormalize( pred, data_mean, data_std, dim_to_use )
+      pred_euler  = expmap2euler_channels( pred ) if from_exp else pred
+      pred_expmap = pred if from_exp else euler2expmap_channels( pred )
+
+      gt = np.stack( [np.stack(srnn_gts_euler[ action ]) for action in self.actions] )
+      gt_expmap = np.stack( [np.stack(srnn_gts_expmap[ action ]) for action in self.actions] )
+
+      # Error of every action, averaged over its seeds
+      self.errors = euler_error( tf.reshape(pred_euler, gt.shape), tf.constant(gt, dtype=dtype) )
+
+      # Distance of every joint to the ground truth. The prediction shares the
+      # global translation and rotation of the ground truth, so the distances
+      # are the same as after revert_coordinate_space in evaluate.py
+      gt_xyz = tree.fkl( gt_expmap.reshape(-1, gt_expmap.shape[-1]) ).reshape( gt.shape[:-1] + (-1, 3) )
+      pred_xyz = tf.reshape( fkl(tf.reshape(pred_expmap, gt.shape), tree), gt_xyz.shape )
+      distance = tf.norm( pred_xyz - tf.constant(gt_xyz, dtype=dtype), axis=-1 )
+      self.mpjpe = tf.reduce_mean( distance, axis=[1, 3] )
+      self.pck = tf.reduce_mean( tf.cast(distance < PCK_THRESHOLD, dtype), axis=[1, 3] )
+
+    # Out of the srnn_evaluation scope, and in the per-action scopes the model
+    # used to create them in, so the tags are the ones of earlier runs:
+    # euler_error_<action>/euler_error_<action>/srnn_seeds_XXXX
+    summaries = []
+    for name, error in [('euler_error', self.errors), ('mpjpe', self.mpjpe), ('pck', self.pck)]:
+      for a, action in enumerate( self.actions ):
+        with tf.name_scope( '{0}_{1}'.format(name, action) ):
+          for ms, frame in SRNN_HORIZONS:
+            if frame < target_seq_len:
+              summaries.append( tf.summary.scalar(
+                '{0}_{1}/srnn_seeds_{2:04d}'.format(name, action, ms), error[a, frame] ) )
+    self.summary = tf.summary.merge( summaries )
+
+  def run(self, session):
+    """
+    Evaluate the model on the seeds of all the actions.
+
+    Args
+      session: tensorflow session to use
+    Returns
+      mse_loss: mean squared error of the model on all the seeds
+      errors: (number of actions) x target_seq_len matrix with the Euler angle
+        error of every action at every frame
+      mpjpe: same as errors, with the mean distance of the joints in mm
+      pck: same as errors, with the fraction of joints closer than PCK_THRESHOLD
+      summary: summaries of the errors at 80, 160, 320, 400, 560 and 1000 ms
+    """
+    return session.run( [self.model.mse_loss_fw, self.errors, self.mpjpe, self.pck, self.summary], self.feed )
@@ -6,6 +6,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import hashlib
 import math
 import os
 import random
@@ -16,8 +18,14 @@ import numpy as np
 from six.moves import xrange # pylint: disable=redefined-builtin
 import tensorflow as tf
 
+import batch_producer
+import dcgru
+import input_pipeline
+import motion_store
 import data_utils
+import forward_kinematics
 import prediction_model
+import tf_kinematics
 
 
 # Learning
@@ -27,6 +35,11 @@ tf.app.flags.DEFINE_integer("learning_rate_step", 10000, "Every this many steps,
 tf.app.flags.DEFINE_float("max_gradient_norm", 1, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_integer("batch_size", 16, "Batch size to use during training.")
 tf.app.flags.DEFINE_integer("iterations", 50000, "Iterations to train for.")
+tf.app.flags.DEFINE_boolean("uniform_frames", False, "Sample training windows uniformly over all frames instead of first picking a sequence. Applies to all the input paths, --tf_data included.")
+tf.app.flags.DEFINE_integer("producers", 0, "Number of processes assembling training batches. 0 builds them in the training loop.")
+tf.app.flags.DEFINE_integer("prefetch", 8, "Maximum number of batches the producers keep ready.")
+tf.app.flags.DEFINE_boolean("tf_data", False, "Cut the training windows with a tf.data pipeline in the graph instead of feeding batches.")
+tf.app.flags.DEFINE_integer("seed", -1, "Seed of the batch producers, for reproducible batches. Negative for a random seed.")
 # Architecture
 tf.app.flags.DEFINE_integer("size", 64, "Size of each model layer.")
 tf.app.flags.DEFINE_integer("num_layers", 1, "Number of layers in the model.")
@@ -34,18 +47,36 @@ tf.app.flags.DEFINE_integer("seq_length_in", 50, "Number of frames to feed into
 tf.app.flags.DEFINE_integer("seq_length_out", 25, "Number of frames that the decoder has to predict. 25fps")
 tf.app.flags.DEFINE_integer("max_diffusion_step", 3, "Number of maximum diffusion steps in the model.")
 tf.app.flags.DEFINE_string("filter_type", "dual_random_walk", "laplacian/random_walk/dual_random_walk")
+tf.app.flags.DEFINE_boolean("stacked_diffusion", False, "Precompute the diffusion polynomials of the graph once per step, and apply them with one matmul per graph convolution.")
+tf.app.flags.DEFINE_boolean("hoist_inputs", False, "Diffuse the known input sequences of the encoders and the supervised decoders before the recurrence, and only the state at every step. Needs --num_layers 1.")
+tf.app.flags.DEFINE_boolean("fused_cell", False, "Diffuse the inputs of every step once, for both the gates and the candidate of the cells.")
+tf.app.flags.DEFINE_boolean("skeleton_adjacency", False, "Restrict the learned adjacency to the links of the kinematic tree, with sparse diffusion supports.")
+tf.app.flags.DEFINE_string("adjacency_mask", "", "Mask .npy of a model written by --prune. The model is loaded from the checkpoint next to it, and runs with sparse diffusion supports.")
 tf.app.flags.DEFINE_boolean("omit_one_hot", True, "Whether to remove one-hot encoding from the data")
 tf.app.flags.DEFINE_boolean("train_on_euler", False, "Train using euler angle")
 tf.app.flags.DEFINE_boolean("velocity", True, "Train using velocity")
+tf.app.flags.DEFINE_boolean("float32_data", False, "Keep the normalized data and the batches in float32 instead of float64")
 tf.app.flags.DEFINE_string("action","all", "The action to train on. all means all the actions, all_periodic means walking, eating and smoking")
 # Directories
 tf.app.flags.DEFINE_string("data_dir", os.path.normpath("./data/h3.6m/dataset"), "Data directory")
 tf.app.flags.DEFINE_string("train_dir", os.path.normpath("./experiments/"), "Training directory.")
+tf.app.flags.DEFINE_integer("load_workers", 0, "Number of processes parsing the dataset files. 0 reads them serially.")
+tf.app.flags.DEFINE_string("train_store", "", "HDF5 store to read the training windows from as they are sampled, instead of loading the training set into memory. Created from data_dir if missing. An existing store that holds other subjects, actions or angles is an error, it is never overwritten.")
+tf.app.flags.DEFINE_string("store_compression", "", "Compression of a new train_store: gzip, lzf or empty for none.")
+tf.app.flags.DEFINE_integer("store_cache_mb", 256, "Size of the cache of normalized train_store chunks, in megabytes.")
+tf.app.flags.DEFINE_string("cache_codec", "", "Keep the sequences of the binary cache encoded: int16 (delta encoded on disk) or float16. The training set stays encoded in memory and only the sampled windows are decoded. Empty for raw memory-mapped sequences.")
+tf.app.flags.DEFINE_string("cache_dir", os.path.normpath("./data/h3.6m/cache"), "Directory of the binary dataset cache. Empty to parse the txt files on every run.")
 # Evaluations
 tf.app.flags.DEFINE_boolean("eval_pose", True, "Training evaluation on pose")
 tf.app.flags.DEFINE_integer("test_every", 1000, "How often to compute error on the test set.")
 tf.app.flags.DEFINE_integer("save_every", 1000, "How often to compute error on the test set.")
+tf.app.flags.DEFINE_boolean("srnn_seed_cache", True, "Save the batches of srnn's seeds in train_dir, so later runs do not read the test set.")
+tf.app.flags.DEFINE_boolean("ingest", False, "Convert new or changed txt files into the binary store in cache_dir, and report whether the used dimensions changed.")
 tf.app.flags.DEFINE_boolean("sample", False, "Set to True for sampling.")
+tf.app.flags.DEFINE_string("sample_codec", "", "Save the poses of samples.h5 encoded and compressed: int16 (delta encoded) or float16. Empty for raw floats.")
+tf.app.flags.DEFINE_boolean("prune", False, "Magnitude-prune the learned adjacency of checkpoint --load, measure the error on srnn's seeds, and save the pruned model in train_dir.")
+tf.app.flags.DEFINE_float("prune_sparsity", 0.9, "Fraction of the entries of the adjacency that --prune removes.")
+tf.app.flags.DEFINE_float("prune_error_budget", 0, "When positive, --prune removes as many entries as keeps the increase of the mean Euler angle error on srnn's seeds within this budget, instead of --prune_sparsity.")
 tf.app.flags.DEFINE_boolean("use_cpu", False, "Whether to use the CPU")
 tf.app.flags.DEFINE_integer("load", 0, "Try to load a previous checkpoint.")
 
@@ -60,9 +91,23 @@ train_dir = os.path.normpath(os.path.join( FLAGS.train_dir, FLAGS.action,
 
 summaries_dir = os.path.normpath(os.path.join( train_dir, "log" )) # Directory for TB summaries
 
-def create_model(session, actions, sampling=False):
+# Subject of the test set and of srnn's seeds
+TEST_SUBJECT_IDS = [5]
+
+def create_model(session, actions, sampling=False, input_batch=None, dim_to_use=None):
   """Create translation model and initialize or load parameters in session."""
 
+  adjacency_mask = None
+  checkpoint_dir = train_dir
+  if FLAGS.skeleton_adjacency and FLAGS.adjacency_mask:
+    raise ValueError("--skeleton_adjacency and --adjacency_mask are exclusive")
+  if FLAGS.skeleton_adjacency:
+    adjacency_mask = forward_kinematics.skeleton_adjacency( dim_to_use, 0 if FLAGS.omit_one_hot else len(actions) )
+  if FLAGS.adjacency_mask:
+    # A pruned model, saved next to its mask
+    adjacency_mask = np.load( FLAGS.adjacency_mask )
+    checkpoint_dir = os.path.dirname( os.path.abspath(FLAGS.adjacency_mask) )
+
   model = prediction_model.Seq2SeqModel(
       FLAGS.seq_length_in if not sampling else 50,
       FLAGS.seq_length_out if not sampling else 25,
@@ -78,21 +123,29 @@ def create_model(session, actions, sampling=False):
       FLAGS.filter_type,
       not FLAGS.omit_one_hot,
       FLAGS.eval_pose,
-      dtype=tf.float32)
+      dtype=tf.float32,
+      data_dtype=np.float32 if FLAGS.float32_data else np.float64,
+      input_batch=input_batch,
+      stacked_diffusion=FLAGS.stacked_diffusion,
+      hoist_inputs=FLAGS.hoist_inputs,
+      fused_cell=FLAGS.fused_cell,
+      adjacency_mask=adjacency_mask)
+
+  session.run(tf.local_variables_initializer())
 
   if FLAGS.load <= 0:
     print("Creating model with fresh parameters.")
     session.run(tf.global_variables_initializer())
     return model
 
-  ckpt = tf.train.get_checkpoint_state( train_dir, latest_filename="checkpoint")
-  print( "train_dir", train_dir )
+  ckpt = tf.train.get_checkpoint_state( checkpoint_dir, latest_filename="checkpoint")
+  print( "train_dir", checkpoint_dir )
 
   if ckpt and ckpt.model_checkpoint_path:
     # Check if the specific checkpoint exists
     if FLAGS.load > 0:
-      if os.path.isfile(os.path.join(train_dir,"checkpoint-{0}.index".format(FLAGS.load))):
-        ckpt_name = os.path.normpath(os.path.join( os.path.join(train_dir,"checkpoint-{0}".format(FLAGS.load)) ))
+      if os.path.isfile(os.path.join(checkpoint_dir,"checkpoint-{0}.index".format(FLAGS.load))):
+        ckpt_name = os.path.normpath(os.path.join( os.path.join(checkpoint_dir,"checkpoint-{0}".format(FLAGS.load)) ))
       else:
         raise ValueError("Asked to load checkpoint {0}, but it does not seem to exist".format(FLAGS.load))
     else:
@@ -108,6 +161,30 @@ def create_model(session, actions, sampling=False):
   return model
 
 
+@contextlib.contextmanager
+def training_batch_producer( train_set ):
+  """
+  Worker processes assembling the training batches with --producers, stopped
+  on exit, or None without them.
+
+  Args
+    train_set: data_utils.SequenceArena with the normalized training set
+  Yields
+    producer: a batch_producer.BatchProducer, or None
+  """
+  if FLAGS.producers <= 0:
+    yield None
+    return
+
+  producer = batch_producer.BatchProducer( train_set, FLAGS.batch_size, FLAGS.seq_length_in, FLAGS.seq_length_out,
+    FLAGS.producers, FLAGS.prefetch, FLAGS.uniform_frames, None if FLAGS.seed < 0 else FLAGS.seed,
+    np.float32 if FLAGS.float32_data else np.float64, first_dim=6 )
+  try:
+    yield producer
+  finally:
+    producer.close()
+
+
 def train():
   """Train a seq2seq model on human motion"""
 
@@ -115,26 +192,68 @@ def train():
 
   number_of_actions = len( actions )
 
-  train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
-    actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.train_on_euler )
+  train_set, _, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
+    actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.train_on_euler, FLAGS.cache_dir, FLAGS.load_workers,
+    np.float32 if FLAGS.float32_data else None, FLAGS.train_store, FLAGS.store_compression or None, FLAGS.store_cache_mb,
+    load_test=False, cache_codec=FLAGS.cache_codec or None )
+
+  if FLAGS.tf_data and FLAGS.producers > 0:
+    raise ValueError("--tf_data and --producers are exclusive")
+  if FLAGS.train_store and (FLAGS.tf_data or FLAGS.producers > 0):
+    raise ValueError("--train_store reads batches in the training loop, and cannot be used with --tf_data or --producers")
+  if FLAGS.cache_dir and FLAGS.cache_codec and (FLAGS.tf_data or FLAGS.producers > 0):
+    raise ValueError("--cache_codec decodes batches in the training loop, and cannot be used with --tf_data or --producers")
+
+  if not isinstance( train_set, data_utils.SequenceArena ):
+    # Contiguous copy of the training sequences for fast batch sampling. The
+    # tf.data pipeline computes the velocities in the graph.
+    train_set = data_utils.SequenceArena( train_set, velocity=not FLAGS.tf_data,
+      actions=None if FLAGS.omit_one_hot else actions )
 
   # Limit TF to take a fraction of the GPU memory
   gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=1)
   device_count = {"GPU": 0} if FLAGS.use_cpu else {"GPU": 1}
 
-  with tf.Session(config=tf.ConfigProto( gpu_options=gpu_options, device_count = device_count )) as sess:
+  # Assemble the training batches in worker processes, if asked to
+  with training_batch_producer( train_set ) as producer, \
+       tf.Session(config=tf.ConfigProto( gpu_options=gpu_options, device_count = device_count )) as sess:
 
     # === Create the model ===
     print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
 
-    model = create_model( sess, actions )
+    pipeline = None
+    if FLAGS.tf_data:
+      pipeline = input_pipeline.WindowPipeline( train_set, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.batch_size,
+        prefetch=FLAGS.prefetch, seed=None if FLAGS.seed < 0 else FLAGS.seed, uniform_frames=FLAGS.uniform_frames )
+
+    model = create_model( sess, actions, input_batch=None if pipeline is None else pipeline.next_batch,
+                          dim_to_use=dim_to_use )
     model.train_writer.add_graph( sess.graph )
     print( "Model created" )
 
+    if pipeline is not None:
+      pipeline.initialize( sess )
+
+    def next_batch():
+      """Inputs of the next training step, without the global translation and rotation."""
+      if pipeline is not None:
+        # The model reads the batch it copies from the pipeline
+        model.load_batch( sess )
+        return None, None, None, None
+      if producer is None:
+        return model.get_batch( train_set, actions, FLAGS.uniform_frames, first_dim=6 )
+      return producer.get()
+
     # === Read and denormalize the gt with srnn's seeds, as we'll need them
     # many times for evaluation in Euler Angles ===
-    srnn_gts_euler = get_srnn_gts( actions, model, test_set, data_mean,
+    srnn_batches, srnn_inputs = get_srnn_batches( actions, model, data_mean, data_std, dim_to_use )
+    srnn_gts_euler = get_srnn_gts( actions, srnn_batches, data_mean,
                               data_std, dim_to_ignore, not FLAGS.omit_one_hot, from_exp=not FLAGS.train_on_euler )
+    srnn_gts_expmap = get_srnn_gts( actions, srnn_batches, data_mean, data_std, dim_to_ignore,
+                                    not FLAGS.omit_one_hot, from_exp=not FLAGS.train_on_euler, to_euler=False )
+    tree = forward_kinematics.KinematicTree( *forward_kinematics._some_variables() )
+    srnn_eval = tf_kinematics.SrnnEvaluation( model, actions, srnn_batches, srnn_inputs, srnn_gts_euler, srnn_gts_expmap, tree,
+      data_mean, data_std, dim_to_use, FLAGS.velocity, from_exp=not FLAGS.train_on_euler )
 
     #=== This is the training loop ===
     current_step = 0 if FLAGS.load <= 0 else FLAGS.load + 1
@@ -143,14 +262,19 @@ def train():
     for _ in xrange( FLAGS.iterations ):
 
       # === Training step ===
-      action_prefix, action_postfix_input, action_postfix_output, action_poses = model.get_batch(train_set, not FLAGS.omit_one_hot)
+      action_prefix, action_postfix_input, action_postfix_output, action_poses = next_batch()
 
-      _, step_mse_fw_loss, step_mse_bw_loss, mse_loss_summary, lr_summary = model.step( sess, action_prefix[:,:,6:], action_postfix_input[:,:,6:], action_postfix_output[:,:,6:], action_poses[:,:,6:], False )
+      _, step_mse_fw_loss, step_mse_bw_loss, mse_loss_summary, lr_summary = model.step( sess, action_prefix, action_postfix_input, action_postfix_output, action_poses, False )
       model.train_writer.add_summary( mse_loss_summary, current_step)
       model.train_writer.add_summary( lr_summary, current_step )
 
+      if producer is not None:
+        queue_depth = producer.queue_depth()
+        model.train_writer.add_summary( tf.Summary(value=[tf.Summary.Value(tag='input/queue_depth', simple_value=queue_depth)]), current_step )
+
       if current_step % 10 == 0:
-        print("step {0:04d}; mse_loss_fw: {1:.4f}; mse_loss_bw: {2:.4f}".format(current_step, step_mse_fw_loss, step_mse_bw_loss))
+        print("step {0:04d}; mse_loss_fw: {1:.4f}; mse_loss_bw: {2:.4f}".format(current_step, step_mse_fw_loss, step_mse_bw_loss), end="")
+        print("; queue depth: {0}".format(queue_depth) if producer is not None else "")
       current_step += 1
 
       # === step decay ===
@@ -163,8 +287,8 @@ def train():
         # === Validation with randomly chosen seeds ===
         forward_only = True
 
-        action_prefix, action_postfix_input, action_postfix_output, action_poses = model.get_batch(train_set, not FLAGS.omit_one_hot)
-        step_mse_loss_fw, mse_loss_summary = model.step(sess, action_prefix[:,:,6:], action_postfix_input[:,:,6:], action_postfix_output[:,:,6:], action_poses[:,:,6:], forward_only)
+        action_prefix, action_postfix_input, action_postfix_output, action_poses = next_batch()
+        step_mse_loss_fw, mse_loss_summary = model.step(sess, action_prefix, action_postfix_input, action_postfix_output, action_poses, forward_only)
         val_mse_loss_fw = step_mse_loss_fw
         model.test_writer.add_summary(mse_loss_summary, current_step)
 
@@ -175,277 +299,26 @@ def train():
         print()
 
         # === Validation with srnn's seeds ===
-        for action in actions:
-
-          # Evaluate the model on the test batches
-          action_prefix, action_postfix_input, action_postfix_output, action_poses = model.get_batch_srnn( test_set, action, FLAGS.velocity )
-
-          srnn_mse_loss_fw, _, srnn_poses = model.step(sess, action_prefix[:,:,6:], action_postfix_input[:,:,6:], action_postfix_output[:,:,6:], action_poses[:,:,6:], True, True)
-          srnn_poses = np.concatenate((np.transpose(action_postfix_output[:, :, :6], [1, 0, 2]), srnn_poses), axis=-1)
-          # Denorm the output
-          srnn_pred = data_utils.revert_output_format( srnn_poses, action_poses[:,FLAGS.seq_length_in-1,:],
-            data_mean, data_std, dim_to_ignore, actions, not FLAGS.omit_one_hot, FLAGS.velocity )
-
-          # Save the errors here
-          mean_errors = np.zeros( (len(srnn_pred), srnn_pred[0].shape[0]) )
-
-          # Training is done in exponential map, but the error is reported in
-          # Euler angles, as in previous work.
-          # See https://github.com/asheshjain399/RNNexp/issues/6#issuecomment-247769197
-          N_SEQUENCE_TEST = 8
-          for i in np.arange(N_SEQUENCE_TEST):
-            eulerchannels_pred = srnn_pred[i]
-
-            if not FLAGS.train_on_euler:
-                # Convert from exponential map to Euler angles
-                for j in np.arange( eulerchannels_pred.shape[0] ):
-                  for k in np.arange(3,97,3):
-                    eulerchannels_pred[j,k:k+3] = data_utils.rotmat2euler(
-                      data_utils.expmap2rotmat( eulerchannels_pred[j,k:k+3] ))
-
-            # The global translation (first 3 entries) and global rotation
-            # (next 3 entries) are also not considered in the error, so the_key
-            # are set to zero.
-            # See https://github.com/asheshjain399/RNNexp/issues/6#issuecomment-249404882
-            gt_i=np.copy(srnn_gts_euler[action][i])
-            gt_i[:,0:6] = 0
-
-            # Now compute the l2 error. The following is numpy port of the error
-            # function provided by Ashesh Jain (in matlab), available at
-            # https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/dataParser/Utils/motionGenerationError.m#L40-L54
-            idx_to_use = np.where( np.std( gt_i, 0 ) > 1e-4 )[0]
-            
-            euc_error = np.power( gt_i[:,idx_to_use] - eulerchannels_pred[:,idx_to_use], 2)
-            euc_error = np.sum(euc_error, 1)
-            euc_error = np.sqrt( euc_error )
-            mean_errors[i,:] = euc_error
-
-          # This is simply the mean error over the N_SEQUENCE_TEST examples
-          mean_mean_errors = np.mean( mean_errors, 0 )
-
-          # Pretty print of the results for 80, 160, 320, 400, 560 and 1000 ms
-          print("{0: <16} |".format(action), end="")
-          for ms in [1,3,7,9,13,24]:
-            if FLAGS.seq_length_out >= ms+1:
-              print(" {0:.3f} |".format( mean_mean_errors[ms] ), end="")
-            else:
-              print("   n/a |", end="")
-          print()
-
-          # Ugly massive if-then to log the error to tensorboard :shrug:
-          if action == "walking":
-            summaries = sess.run(
-              [model.walking_err80_summary,
-               model.walking_err160_summary,
-               model.walking_err320_summary,
-               model.walking_err400_summary,
-               model.walking_err560_summary,
-               model.walking_err1000_summary],
-              {model.walking_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.walking_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.walking_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.walking_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.walking_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.walking_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "eating":
-            summaries = sess.run(
-              [model.eating_err80_summary,
-               model.eating_err160_summary,
-               model.eating_err320_summary,
-               model.eating_err400_summary,
-               model.eating_err560_summary,
-               model.eating_err1000_summary],
-              {model.eating_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.eating_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.eating_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.eating_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.eating_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.eating_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "smoking":
-            summaries = sess.run(
-              [model.smoking_err80_summary,
-               model.smoking_err160_summary,
-               model.smoking_err320_summary,
-               model.smoking_err400_summary,
-               model.smoking_err560_summary,
-               model.smoking_err1000_summary],
-              {model.smoking_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.smoking_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.smoking_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.smoking_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.smoking_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.smoking_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "discussion":
-            summaries = sess.run(
-              [model.discussion_err80_summary,
-               model.discussion_err160_summary,
-               model.discussion_err320_summary,
-               model.discussion_err400_summary,
-               model.discussion_err560_summary,
-               model.discussion_err1000_summary],
-              {model.discussion_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.discussion_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.discussion_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.discussion_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.discussion_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.discussion_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "directions":
-            summaries = sess.run(
-              [model.directions_err80_summary,
-               model.directions_err160_summary,
-               model.directions_err320_summary,
-               model.directions_err400_summary,
-               model.directions_err560_summary,
-               model.directions_err1000_summary],
-              {model.directions_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.directions_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.directions_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.directions_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.directions_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.directions_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "greeting":
-            summaries = sess.run(
-              [model.greeting_err80_summary,
-               model.greeting_err160_summary,
-               model.greeting_err320_summary,
-               model.greeting_err400_summary,
-               model.greeting_err560_summary,
-               model.greeting_err1000_summary],
-              {model.greeting_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.greeting_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.greeting_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.greeting_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.greeting_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.greeting_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "phoning":
-            summaries = sess.run(
-              [model.phoning_err80_summary,
-               model.phoning_err160_summary,
-               model.phoning_err320_summary,
-               model.phoning_err400_summary,
-               model.phoning_err560_summary,
-               model.phoning_err1000_summary],
-              {model.phoning_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.phoning_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.phoning_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.phoning_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.phoning_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.phoning_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "posing":
-            summaries = sess.run(
-              [model.posing_err80_summary,
-               model.posing_err160_summary,
-               model.posing_err320_summary,
-               model.posing_err400_summary,
-               model.posing_err560_summary,
-               model.posing_err1000_summary],
-              {model.posing_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.posing_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.posing_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.posing_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.posing_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.posing_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "purchases":
-            summaries = sess.run(
-              [model.purchases_err80_summary,
-               model.purchases_err160_summary,
-               model.purchases_err320_summary,
-               model.purchases_err400_summary,
-               model.purchases_err560_summary,
-               model.purchases_err1000_summary],
-              {model.purchases_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.purchases_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.purchases_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.purchases_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.purchases_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.purchases_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "sitting":
-            summaries = sess.run(
-              [model.sitting_err80_summary,
-               model.sitting_err160_summary,
-               model.sitting_err320_summary,
-               model.sitting_err400_summary,
-               model.sitting_err560_summary,
-               model.sitting_err1000_summary],
-              {model.sitting_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.sitting_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.sitting_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.sitting_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.sitting_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.sitting_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "sittingdown":
-            summaries = sess.run(
-              [model.sittingdown_err80_summary,
-               model.sittingdown_err160_summary,
-               model.sittingdown_err320_summary,
-               model.sittingdown_err400_summary,
-               model.sittingdown_err560_summary,
-               model.sittingdown_err1000_summary],
-              {model.sittingdown_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.sittingdown_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.sittingdown_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.sittingdown_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.sittingdown_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.sittingdown_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "takingphoto":
-            summaries = sess.run(
-              [model.takingphoto_err80_summary,
-               model.takingphoto_err160_summary,
-               model.takingphoto_err320_summary,
-               model.takingphoto_err400_summary,
-               model.takingphoto_err560_summary,
-               model.takingphoto_err1000_summary],
-              {model.takingphoto_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.takingphoto_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.takingphoto_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.takingphoto_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.takingphoto_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.takingphoto_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "waiting":
-            summaries = sess.run(
-              [model.waiting_err80_summary,
-               model.waiting_err160_summary,
-               model.waiting_err320_summary,
-               model.waiting_err400_summary,
-               model.waiting_err560_summary,
-               model.waiting_err1000_summary],
-              {model.waiting_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.waiting_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.waiting_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.waiting_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.waiting_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.waiting_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "walkingdog":
-            summaries = sess.run(
-              [model.walkingdog_err80_summary,
-               model.walkingdog_err160_summary,
-               model.walkingdog_err320_summary,
-               model.walkingdog_err400_summary,
-               model.walkingdog_err560_summary,
-               model.walkingdog_err1000_summary],
-              {model.walkingdog_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.walkingdog_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.walkingdog_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.walkingdog_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.walkingdog_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.walkingdog_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-          elif action == "walkingtogether":
-            summaries = sess.run(
-              [model.walkingtogether_err80_summary,
-               model.walkingtogether_err160_summary,
-               model.walkingtogether_err320_summary,
-               model.walkingtogether_err400_summary,
-               model.walkingtogether_err560_summary,
-               model.walkingtogether_err1000_summary],
-              {model.walkingtogether_err80: mean_mean_errors[1] if FLAGS.seq_length_out >= 2 else None,
-               model.walkingtogether_err160: mean_mean_errors[3] if FLAGS.seq_length_out >= 4 else None,
-               model.walkingtogether_err320: mean_mean_errors[7] if FLAGS.seq_length_out >= 8 else None,
-               model.walkingtogether_err400: mean_mean_errors[9] if FLAGS.seq_length_out >= 10 else None,
-               model.walkingtogether_err560: mean_mean_errors[13] if FLAGS.seq_length_out >= 14 else None,
-               model.walkingtogether_err1000: mean_mean_errors[24] if FLAGS.seq_length_out >= 25 else None})
-
-          for i in np.arange(len( summaries )):
-            model.test_writer.add_summary(summaries[i], current_step)
+        # Training is done in exponential map, but the error is reported in
+        # Euler angles, as in previous work. The seeds of all the actions are
+        # evaluated at once, and the error computed in the graph, see tf_kinematics.
+        # See https://github.com/asheshjain399/RNNexp/issues/6#issuecomment-247769197
+        srnn_mse_loss_fw, srnn_errors, srnn_mpjpe, srnn_pck, srnn_summary = srnn_eval.run( sess )
+        model.test_writer.add_summary( srnn_summary, current_step )
+
+        for title, table in [(None, srnn_errors), ("MPJPE (mm)", srnn_mpjpe), ("PCK", srnn_pck)]:
+          if title is not None:
+            print(title)
+          for action, mean_mean_errors in zip( actions, table ):
+
+            # Pretty print of the results for 80, 160, 320, 400, 560 and 1000 ms
+            print("{0: <16} |".format(action), end="")
+            for ms in [1,3,7,9,13,24]:
+              if FLAGS.seq_length_out >= ms+1:
+                print(" {0:.3f} |".format( mean_mean_errors[ms] ), end="")
+              else:
+                print("   n/a |", end="")
+            print()
 
 
         print()
@@ -466,15 +339,80 @@ def train():
         sys.stdout.flush()
 
 
-def get_srnn_gts( actions, model, test_set, data_mean, data_std, dim_to_ignore, one_hot, from_exp=True, to_euler=True ):
+def get_srnn_batches( actions, model, data_mean, data_std, dim_to_use ):
+  """
+  Batches of srnn's seeds for all the actions. They are the same at every
+  evaluation, so they are built once and, with --srnn_seed_cache, saved next
+  to the checkpoints. The test set is only read if they are not saved yet.
+
+  Args
+    actions: a list of actions to get the batches for.
+    model: model the batches are built for (we only use the "get_batch_srnn" method).
+    data_mean: d-long vector with the mean of the training data.
+    data_std: d-long vector with the standard deviation of the training data.
+    dim_to_use: dimensions that we are actually using in the model.
+  Returns
+    srnn_batches: a dictionary where the keys are actions, and the values are
+      the tuples returned by get_batch_srnn for them.
+    srnn_inputs: same as srnn_batches, without the global translation and
+      rotation. These are the contiguous batches the model is fed with.
+  """
+  nparts = 4 if FLAGS.velocity else 3
+
+  cache_file = None
+  if FLAGS.srnn_seed_cache:
+    # Key the saved batches by everything that changes their content
+    sha = hashlib.sha1()
+    sha.update( '{0}:{1}:{2}:{3}:{4}:{5}:{6}:{7}'.format( model.source_seq_len, model.target_seq_len, FLAGS.velocity,
+      FLAGS.omit_one_hot, FLAGS.train_on_euler, np.dtype(model.data_dtype).str, ','.join(actions),
+      model.input_size ).encode('utf-8') )
+    for array in (data_mean, data_std, np.asarray(dim_to_use, dtype=np.int64)):
+      sha.update( np.ascontiguousarray(array).tobytes() )
+    # and by the test files they are cut from, as read_test_data reads them
+    sha.update( '{0}:{1}:{2}'.format( os.path.abspath(FLAGS.data_dir), bool(FLAGS.cache_dir),
+      FLAGS.cache_codec ).encode('utf-8') )
+    for subj, action_idx, subact in data_utils.find_sequences( FLAGS.data_dir, TEST_SUBJECT_IDS, actions ):
+      stat = os.stat( '{0}/S{1}/{2}_{3}.txt'.format(FLAGS.data_dir, subj, actions[action_idx], subact) )
+      sha.update( '{0}:{1}:{2}:{3}:{4}'.format( subj, actions[action_idx], subact, stat.st_size,
+        stat.st_mtime ).encode('utf-8') )
+    cache_file = os.path.join( train_dir, 'srnn_seeds_{0}.npz'.format(sha.hexdigest()[:16]) )
+
+    if os.path.isfile( cache_file ):
+      print("Loading srnn's seeds from {0}".format( cache_file ))
+      with np.load( cache_file ) as cached:
+        return [dict( (action, tuple(cached['{0}{1}_{2}'.format(prefix, action, i)] for i in range(nparts)))
+                      for action in actions ) for prefix in ('', 'inputs_')]
+
+  test_set = read_test_data( actions, FLAGS.data_dir, FLAGS.train_on_euler, data_mean, data_std,
+    dim_to_use, FLAGS.cache_dir, FLAGS.load_workers, np.float32 if FLAGS.float32_data else None, FLAGS.cache_codec or None )
+  srnn_batches = dict( (action, model.get_batch_srnn(test_set, action, FLAGS.velocity, actions)) for action in actions )
+  srnn_inputs = dict( (action, model.get_batch_srnn(test_set, action, FLAGS.velocity, actions, first_dim=6))
+                      for action in actions )
+
+  if cache_file is not None:
+    if not os.path.isdir( train_dir ):
+      os.makedirs( train_dir )
+    arrays = {}
+    for prefix, batches in [('', srnn_batches), ('inputs_', srnn_inputs)]:
+      for action in actions:
+        for i, part in enumerate( batches[action] ):
+          arrays['{0}{1}_{2}'.format(prefix, action, i)] = part
+    # np.savez appends .npz to names without it
+    tmp_file = cache_file[:-len('.npz')] + '.tmp.npz'
+    np.savez( tmp_file, **arrays )
+    os.rename( tmp_file, cache_file )
+
+  return srnn_batches, srnn_inputs
+
+
+def get_srnn_gts( actions, srnn_batches, data_mean, data_std, dim_to_ignore, one_hot, from_exp=True, to_euler=True ):
   """
   Get the ground truths for srnn's sequences, and convert to Euler angles.
   (the error is always computed in Euler angles).
 
   Args
     actions: a list of actions to get ground truths for.
-    model: training model we are using (we only use the "get_batch" method).
-    test_set: dictionary with normalized training data.
+    srnn_batches: the batches of srnn's seeds given by get_srnn_batches.
     data_mean: d-long vector with the mean of the training data.
     data_std: d-long vector with the standard deviation of the training data.
     dim_to_ignore: dimensions that we are not using to train/predict.
@@ -490,20 +428,21 @@ def get_srnn_gts( actions, model, test_set, data_mean, data_std, dim_to_ignore,
   for action in actions:
 
     srnn_gt = []
-    _, _, srnn = model.get_batch_srnn( test_set, action, False )
+    if FLAGS.velocity:
+      # The poses after the seed, which get_batch_srnn gives as decoder outputs without velocity
+      target_seq_len = srnn_batches[ action ][2].shape[1]
+      srnn = srnn_batches[ action ][3][:, -target_seq_len:, :]
+    else:
+      srnn = srnn_batches[ action ][2]
 
     for i in np.arange( srnn.shape[0] ):
       denormed = data_utils.unNormalizeData(srnn[i,:,:], data_mean, data_std, dim_to_ignore, actions, one_hot )
 
       if from_exp and to_euler:
-        for j in np.arange( denormed.shape[0] ):
-          for k in np.arange(3,97,3):
-            denormed[j,k:k+3] = data_utils.rotmat2euler( data_utils.expmap2rotmat( denormed[j,k:k+3] ))
+        denormed = data_utils.expmap2euler_channels( denormed )
 
       if not from_exp and not to_euler: # from euler to exp
-        for j in np.arange( denormed.shape[0] ):
-          for k in np.arange(3,97,3):
-            denormed[j,k:k+3] = data_utils.rotmat2expmap( data_utils.euler2rotmat( denormed[j,k:k+3] ))
+        denormed = data_utils.euler2expmap_channels( denormed )
 
       srnn_gt.append( denormed )
 
@@ -525,20 +464,23 @@ def sample():
   device_count = {"GPU": 0} if FLAGS.use_cpu else {"GPU": 1}
   with tf.Session(config=tf.ConfigProto( device_count = device_count )) as sess:
 
+    # Load all the data
+    _, _, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
+      actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.train_on_euler, FLAGS.cache_dir, FLAGS.load_workers,
+      np.float32 if FLAGS.float32_data else None, FLAGS.train_store, FLAGS.store_compression or None, FLAGS.store_cache_mb,
+      load_test=False, cache_codec=FLAGS.cache_codec or None )
+
     # === Create the model ===
     print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
     sampling     = True
-    model = create_model(sess, actions, sampling)
+    model = create_model(sess, actions, sampling, dim_to_use=dim_to_use)
     print("Model created")
 
-    # Load all the data
-    train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
-      actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.train_on_euler )
-
     # === Read and denormalize the gt with srnn's seeds, as we'll need them many times for evaluation in Euler Angles ===
-    srnn_gts_expmap = get_srnn_gts( actions, model, test_set, data_mean,
+    srnn_batches, srnn_inputs = get_srnn_batches( actions, model, data_mean, data_std, dim_to_use )
+    srnn_gts_expmap = get_srnn_gts( actions, srnn_batches, data_mean,
                               data_std, dim_to_ignore, not FLAGS.omit_one_hot, from_exp=not FLAGS.train_on_euler, to_euler=False )
-    srnn_gts_euler = get_srnn_gts( actions, model, test_set, data_mean,
+    srnn_gts_euler = get_srnn_gts( actions, srnn_batches, data_mean,
                               data_std, dim_to_ignore, not FLAGS.omit_one_hot, from_exp=not FLAGS.train_on_euler )
 
     # Clean and create a new h5 file of samples
@@ -552,11 +494,12 @@ def sample():
     for action in actions:
 
       # Make prediction with srnn' seeds
-      action_prefix, action_postfix_input, action_postfix_output, action_poses = model.get_batch_srnn( test_set, action, FLAGS.velocity )
+      action_prefix, action_postfix_input, action_postfix_output, action_poses = srnn_batches[ action ]
 
       forward_only = True
       srnn_seeds = True
-      srnn_mse_loss_fw, _, srnn_poses = model.step(sess, action_prefix[:,:,6:], action_postfix_input[:,:,6:], action_postfix_output[:,:,6:], action_poses[:,:,6:], forward_only, srnn_seeds)
+      input_prefix, input_postfix_input, input_postfix_output, input_poses = srnn_inputs[ action ]
+      srnn_mse_loss_fw, _, srnn_poses = model.step(sess, input_prefix, input_postfix_input, input_postfix_output, input_poses, forward_only, srnn_seeds)
 
       srnn_poses = np.concatenate((np.transpose(action_postfix_output[:, :, :6], [1, 0, 2]), srnn_poses), axis=-1)
       # denorm
@@ -564,33 +507,30 @@ def sample():
 
       # change to expmap
       if FLAGS.train_on_euler:
-          for i in np.arange(8):
-              for j in np.arange(srnn_pred[i].shape[0]):
-                  for k in np.arange(3, 97, 3):
-                      srnn_pred[i][j, k:k + 3] = data_utils.rotmat2expmap(
-                          data_utils.euler2rotmat(srnn_pred[i][j, k:k + 3]))
+          srnn_pred = [data_utils.euler2expmap_channels( pred ) for pred in srnn_pred]
 
       # Save the samples
+      max_error = 0
       with h5py.File( SAMPLES_FNAME, 'a' ) as hf:
         for i in np.arange(8):
           # Save conditioning ground truth
           node_name = 'expmap/gt/{1}_{0}'.format(i, action)
-          hf.create_dataset( node_name, data=srnn_gts_expmap[action][i] )
+          error = data_utils.write_encoded_poses( hf, node_name, srnn_gts_expmap[action][i], FLAGS.sample_codec or None )
+          max_error = max( max_error, np.max(error) )
           # Save prediction
           node_name = 'expmap/preds/{1}_{0}'.format(i, action)
-          hf.create_dataset( node_name, data=srnn_pred[i] )
+          error = data_utils.write_encoded_poses( hf, node_name, srnn_pred[i], FLAGS.sample_codec or None )
+          max_error = max( max_error, np.max(error) )
+      if FLAGS.sample_codec:
+        print("Saved {0} samples with {1}, max error {2:.2e}".format( action, FLAGS.sample_codec, max_error ))
 
       # Compute and save the errors here
       mean_errors = np.zeros( (len(srnn_pred), srnn_pred[0].shape[0]) )
 
       for i in np.arange(8):
 
-        eulerchannels_pred = srnn_pred[i]
         # change back to euler
-        for j in np.arange( eulerchannels_pred.shape[0] ):
-          for k in np.arange(3,97,3):
-            eulerchannels_pred[j,k:k+3] = data_utils.rotmat2euler(
-              data_utils.expmap2rotmat( eulerchannels_pred[j,k:k+3] ))
+        eulerchannels_pred = data_utils.expmap2euler_channels( srnn_pred[i] )
 
         eulerchannels_pred[:,0:6] = 0
 
@@ -619,6 +559,120 @@ def sample():
   return
 
 
+def prune():
+  """Magnitude-prune the learned adjacency of a trained model, and save it to run with sparse supports"""
+
+  if FLAGS.load <= 0:
+    raise ValueError("--prune needs a checkpoint to --load")
+
+  actions = define_actions( FLAGS.action )
+
+  device_count = {"GPU": 0} if FLAGS.use_cpu else {"GPU": 1}
+  with tf.Session(config=tf.ConfigProto( device_count = device_count )) as sess:
+
+    _, _, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
+      actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.train_on_euler, FLAGS.cache_dir, FLAGS.load_workers,
+      np.float32 if FLAGS.float32_data else None, FLAGS.train_store, FLAGS.store_compression or None, FLAGS.store_cache_mb,
+      load_test=False, cache_codec=FLAGS.cache_codec or None )
+
+    model = create_model( sess, actions, True, dim_to_use=dim_to_use )
+    print("Model created")
+
+    srnn_batches, srnn_inputs = get_srnn_batches( actions, model, data_mean, data_std, dim_to_use )
+    srnn_gts_euler = get_srnn_gts( actions, srnn_batches, data_mean,
+                              data_std, dim_to_ignore, not FLAGS.omit_one_hot, from_exp=not FLAGS.train_on_euler )
+    srnn_gts_expmap = get_srnn_gts( actions, srnn_batches, data_mean, data_std, dim_to_ignore,
+                                    not FLAGS.omit_one_hot, from_exp=not FLAGS.train_on_euler, to_euler=False )
+    tree = forward_kinematics.KinematicTree( *forward_kinematics._some_variables() )
+    srnn_eval = tf_kinematics.SrnnEvaluation( model, actions, srnn_batches, srnn_inputs, srnn_gts_euler, srnn_gts_expmap, tree,
+      data_mean, data_std, dim_to_use, FLAGS.velocity, from_exp=not FLAGS.train_on_euler )
+    frames = [frame for _, frame in tf_kinematics.SRNN_HORIZONS if frame < model.target_seq_len]
+
+    adj_mx = sess.run( model.adj_mx )
+    pruned_adj_mx = tf.placeholder( model.adj_mx.dtype, adj_mx.shape )
+    assign_adj_mx = model.adj_mx.assign( pruned_adj_mx )
+
+    def evaluate( mask ):
+      """Mean Euler angle error and MPJPE at srnn's horizons, with the entries out of mask removed"""
+      # The dense supports of the masked adjacency are the sparse supports of the mask
+      sess.run( assign_adj_mx, {pruned_adj_mx: adj_mx * mask} )
+      _, errors, mpjpe, _, _ = srnn_eval.run( sess )
+      return np.mean( errors[:, frames] ), np.mean( mpjpe[:, frames] )
+
+    unpruned_error, unpruned_mpjpe = evaluate( np.ones(adj_mx.shape, dtype=bool) )
+
+    print("{0: <10} | {1: >6} | {2: >11} | {3: >10}".format("sparsity", "edges", "euler error", "mpjpe (mm)"))
+    edges = adj_mx.size if model.adjacency_mask is None else np.sum( model.adjacency_mask )
+    print("{0: <10} | {1: >6d} | {2: >11.3f} | {3: >10.1f}".format("unpruned", edges, unpruned_error, unpruned_mpjpe))
+
+    if FLAGS.prune_error_budget > 0:
+      sparsities = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98]
+    else:
+      sparsities = [FLAGS.prune_sparsity]
+
+    # Prune more until the error goes over the budget
+    best = None
+    for sparsity in sparsities:
+      # A model with sparse supports only ever trained the entries of its mask
+      mask = dcgru.magnitude_mask( adj_mx, sparsity, model.adjacency_mask )
+      error, mpjpe = evaluate( mask )
+      print("{0: <10.2f} | {1: >6d} | {2: >+11.3f} | {3: >+10.1f}".format(
+        sparsity, np.sum(mask), error - unpruned_error, mpjpe - unpruned_mpjpe))
+      if FLAGS.prune_error_budget > 0 and error - unpruned_error > FLAGS.prune_error_budget:
+        break
+      best = sparsity, mask
+
+    if best is None:
+      raise ValueError("Pruning {0:.0%} of the adjacency already goes over the error budget".format(sparsities[0]))
+    sparsity, mask = best
+
+    # The pruned model: its checkpoint, with the removed entries at zero, next to its mask
+    pruned_dir = os.path.normpath(os.path.join( train_dir, 'pruned_{0:.2f}'.format(sparsity) ))
+    if not os.path.isdir( pruned_dir ):
+      os.makedirs( pruned_dir )
+    mask_path = os.path.join( pruned_dir, 'adjacency_mask.npy' )
+    np.save( mask_path, mask )
+    sess.run( assign_adj_mx, {pruned_adj_mx: adj_mx * mask} )
+    model.saver.save( sess, os.path.join(pruned_dir, 'checkpoint'), global_step=FLAGS.load )
+    print("Saved the model pruned at {0:.2f}, run it with --load {1} --adjacency_mask {2}".format(
+      sparsity, FLAGS.load, mask_path))
+
+
+def ingest():
+  """Bring the binary store up to date with new or changed capture files"""
+
+  if not FLAGS.cache_dir:
+    raise ValueError("--ingest needs a --cache_dir")
+
+  actions = define_actions( FLAGS.action )
+  store_dir = data_utils.store_directory( FLAGS.cache_dir, FLAGS.train_on_euler )
+
+  train_subject_ids = [1,6,7,8,9,11]
+
+  converted, before, after = data_utils.ingest_data( FLAGS.data_dir, train_subject_ids, actions,
+    FLAGS.train_on_euler, store_dir, FLAGS.load_workers, FLAGS.cache_codec or None )
+  converted_test, _, _ = data_utils.ingest_data( FLAGS.data_dir, TEST_SUBJECT_IDS, actions,
+    FLAGS.train_on_euler, store_dir, FLAGS.load_workers, FLAGS.cache_codec or None )
+
+  for subj, action, subact in converted + converted_test:
+    print("Ingested subject {0}, action {1}, subaction {2}".format(subj, action, subact))
+  print("Ingested {0} files into {1}".format(len(converted) + len(converted_test), store_dir))
+
+  # A change of the used dimensions changes the input size of the model
+  _, _, _, dim_to_use = data_utils.normalization_stats( after )
+  if before.count == 0:
+    print("New store: {0} dimensions in use".format(len(dim_to_use)))
+  else:
+    _, _, _, previous_dim_to_use = data_utils.normalization_stats( before )
+    if list(previous_dim_to_use) == list(dim_to_use):
+      print("Dimensions in use unchanged ({0})".format(len(dim_to_use)))
+    else:
+      print("Dimensions in use changed from {0} to {1}: added {2}, removed {3}".format(
+        len(previous_dim_to_use), len(dim_to_use),
+        sorted(set(dim_to_use) - set(previous_dim_to_use)),
+        sorted(set(previous_dim_to_use) - set(dim_to_use))))
+
+
 def define_actions( action ):
   """
   Define the list of actions we are using.
@@ -648,7 +702,8 @@ def define_actions( action ):
   raise( ValueError, "Unrecognized action: %d" % action )
 
 
-def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot, euler ):
+def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot, euler, cache_dir=None, load_workers=0, dtype=None, train_store=None,
+                   store_compression=None, store_cache_mb=256, load_test=True, cache_codec=None ):
   """
   Loads data for training/testing and normalizes it.
 
@@ -659,9 +714,21 @@ def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot, eu
     data_dir: directory to load the data from
     one_hot: whether to use one-hot encoding per action
     euler: whether use euler
+    cache_dir: directory of the binary dataset cache. If None, parse the txt files
+    load_workers: number of processes parsing the txt files
+    dtype: if given, e.g. np.float32, the data is normalized in place in this type
+    train_store: if given, path of an HDF5 store the training windows are read
+      from as they are sampled. It is created from data_dir if missing
+    store_compression: compression of a train_store created here: 'gzip',
+      'lzf' or None
+    store_cache_mb: size of the cache of normalized train_store chunks, in megabytes
+    load_test: whether to load the test set. See read_test_data to load it later
+    cache_codec: None, or the codec of encode_poses the binary cache keeps the
+      sequences in. The training set is then kept encoded in a data_utils.EncodedArena
   Returns
-    train_set: dictionary with normalized training data
-    test_set: dictionary with test data
+    train_set: dictionary with normalized training data, or a motion_store.MotionStore
+      or data_utils.EncodedArena
+    test_set: dictionary with test data, or None if load_test is False
     data_mean: d-long vector with the mean of the training data
     data_std: d-long vector with the standard dev of the training data
     dim_to_ignore: dimensions that are not used becaused stdev is too small
@@ -673,25 +740,86 @@ def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot, eu
            seq_length_in, seq_length_out))
 
   train_subject_ids = [1,6,7,8,9,11]
-  test_subject_ids = [5]
 
-  train_set, complete_train = data_utils.load_data( data_dir, train_subject_ids, actions, one_hot, euler )
-  test_set,  complete_test  = data_utils.load_data( data_dir, test_subject_ids,  actions, one_hot, euler )
+  if train_store:
+    # Out-of-core training set, normalized chunk by chunk as it is read
+    if not os.path.isfile( train_store ):
+      print("Converting subjects {0} to HDF5 store {1}".format(train_subject_ids, train_store))
+      motion_store.convert_to_store( data_dir, train_subject_ids, actions, euler, train_store,
+        compression=store_compression, num_workers=load_workers )
+    else:
+      # Never overwrite an existing store, it may be the only copy of its data
+      reason = motion_store.store_mismatch( train_store, train_subject_ids, actions, euler )
+      if reason is not None:
+        raise ValueError("The store {0} does not match the training set, as {1}. Remove it to rebuild it, "
+                         "or give another path".format(train_store, reason))
+    train_set = motion_store.MotionStore( train_store, actions, one_hot, store_cache_mb,
+      dtype=np.float32 if dtype is None else dtype, euler=euler, subjects=train_subject_ids )
+    data_mean, data_std, dim_to_ignore, dim_to_use = train_set.stats
+  elif cache_dir:
+    # Memory-mapped sequences and stored normalization stats
+    train_set, train_stats = data_utils.load_data_cached( data_dir, train_subject_ids, actions, euler, cache_dir, load_workers,
+      cache_codec, decode=False )
+    data_mean, data_std, dim_to_ignore, dim_to_use = train_stats
+    if cache_codec is not None:
+      # Encoded in memory, and decoded and normalized a window at a time
+      train_set = data_utils.EncodedArena( train_set, data_mean, data_std, dim_to_use,
+        dtype=np.float32 if dtype is None else dtype, actions=actions if one_hot else None )
+  else:
+    train_set, complete_train = data_utils.load_data( data_dir, train_subject_ids, actions, euler, load_workers )
 
-  # Compute normalization stats
-  data_mean, data_std, dim_to_ignore, dim_to_use = data_utils.normalization_stats(complete_train)
+    # Compute normalization stats
+    data_mean, data_std, dim_to_ignore, dim_to_use = data_utils.normalization_stats(complete_train)
 
   # Normalize -- subtract mean, divide by stdev
-  train_set = data_utils.normalize_data( train_set, data_mean, data_std, dim_to_use, actions, one_hot )
-  test_set  = data_utils.normalize_data( test_set,  data_mean, data_std, dim_to_use, actions, one_hot )
+  if not isinstance( train_set, data_utils.SequenceArena ):
+    train_set = data_utils.normalize_data( train_set, data_mean, data_std, dim_to_use, dtype )
+
+  test_set = None
+  if load_test:
+    test_set = read_test_data( actions, data_dir, euler, data_mean, data_std, dim_to_use, cache_dir, load_workers, dtype,
+      cache_codec )
   print("done reading data.")
 
   return train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use
 
 
+def read_test_data( actions, data_dir, euler, data_mean, data_std, dim_to_use, cache_dir=None, load_workers=0, dtype=None,
+                    cache_codec=None ):
+  """
+  Loads the test subject and normalizes it with the stats of the training data.
+
+  Args
+    actions: list of strings (actions) to load
+    data_dir: directory to load the data from
+    euler: whether use euler
+    data_mean: d-long vector with the mean of the training data
+    data_std: d-long vector with the standard dev of the training data
+    dim_to_use: dimensions that we are actually using in the model
+    cache_dir: directory of the binary dataset cache. If None, parse the txt files
+    load_workers: number of processes parsing the txt files
+    dtype: if given, e.g. np.float32, the data is normalized in place in this type
+    cache_codec: None, or the codec of encode_poses the binary cache keeps the
+      sequences in. They are decoded when loaded
+  Returns
+    test_set: dictionary with normalized test data
+  """
+  if cache_dir:
+    test_set, _ = data_utils.load_data_cached( data_dir, TEST_SUBJECT_IDS, actions, euler, cache_dir, load_workers,
+      cache_codec )
+  else:
+    test_set, _ = data_utils.load_data( data_dir, TEST_SUBJECT_IDS, actions, euler, load_workers )
+
+  return data_utils.normalize_data( test_set, data_mean, data_std, dim_to_use, dtype )
+
+
 def main(_):
-  if FLAGS.sample:
+  if FLAGS.ingest:
+    ingest()
+  elif FLAGS.sample:
     sample()
+  elif FLAGS.prune:
+    prune()
   else:
     train()
 